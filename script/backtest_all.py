@@ -1,18 +1,30 @@
 #!/usr/bin/python3
 
 import pandas as pd
+import numpy as np
 import argparse
+import logging
 import os
-from datetime import datetime, timedelta
+from datetime import datetime
 import re
-import twstock
 import sys
 import json5
+import cProfile
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__ + "/..")))  # noqa
 from user_logger import user_logger  # noqa
 from utils import config  # noqa
-from utils.backtest_struct import StockPosition, TradeHistory, buy_rule_dict, sell_rule_dict  # noqa
+from utils import day_cache  # noqa
+from utils import trading_calendar  # noqa
+from utils import manifest  # noqa
+from utils import profiler  # noqa
+from utils import indicators  # noqa
+from utils import rule_expr  # noqa
+from utils.panel import Panel  # noqa
+from utils.ledger import TradeLedger, BUY, SELL  # noqa
+from utils.backtest_struct import Portfolio, TradeHistory, buy_rule_dict, sell_rule_dict  # noqa
+from utils.backtest_struct import buy_rule_vec_dict, sell_signal, liquidity_mask, scalar_signal  # noqa
+from utils.backtest_struct import DEFAULT_THRESHOLDS  # noqa
 
 
 args = None
@@ -53,6 +65,24 @@ def arg_parse():
     parser.add_argument('--start_date', dest='start_date', type=str,
                         metavar='*', default=config.SHIOAJI_START_DATE,
                         help=f'Add the start date. default {config.SHIOAJI_START_DATE}')  # 2018-12-07
+    parser.add_argument('--scalar_rules', dest='scalar_rules', action="store_true",
+                        default=False, help='逐日呼叫 backtest_struct 的規則, 用來對照向量化規則的結果')
+    parser.add_argument('--rules', dest='rules', type=str,
+                        metavar='*.json5', default=None, help='以運算式定義的規則檔 (見 utils/rules.json5), 同名時優先使用')
+    parser.add_argument('--concentrated_band', dest='concentrated_band', type=float, metavar='<FLOAT>',
+                        default=DEFAULT_THRESHOLDS['concentrated_band'], help='均線聚集的門檻')
+    parser.add_argument('--death_cross_deviation', dest='death_cross_deviation', type=float, metavar='<FLOAT>',
+                        default=DEFAULT_THRESHOLDS['death_cross_deviation'], help='ESMA20死亡交叉保留的誤差')
+    parser.add_argument('--stop_loss', dest='stop_loss', type=float, metavar='<FLOAT>',
+                        default=DEFAULT_THRESHOLDS['stop_loss'], help='市值跌破成本的這個倍數就賣')
+    parser.add_argument('--profile', dest='profile', action="store_true",
+                        default=False, help='統計各階段與各檔股票的執行時間')
+    parser.add_argument('--profile_output', dest='profile_output', type=str,
+                        metavar='*.json', default=None, help='各階段執行時間的輸出檔名')
+    parser.add_argument('--profile_top', dest='profile_top', type=int,
+                        metavar='<UNSIGNED INT>', default=10, help='列出最慢的幾檔股票')
+    parser.add_argument('--cprofile', dest='cprofile', type=str,
+                        metavar='*.prof', default=None, help='一併以 cProfile 記錄並寫到這個檔案')
 
     # 解析參數
     return parser.parse_args()
@@ -89,13 +119,23 @@ def decode_group():
     logger.info("回測群組:" + ",".join(stock_groups))
 
 
-def read_stock_data(data_dir, df_dict):
-    """
-    取得資料夾中的所有 _day.csv 檔案 (日K)
+def select_stocks(data_dir):
     """
-    day_files = [f for f in os.listdir(data_dir) if f.endswith("_day.csv")]
+    依 --group 與 --code 選出要回測的股票。
+
+    有 process_kbars 產生的 manifest.csv 時只讀清單; 沒有時才列出資料夾中的 _day.csv 並查詢 twstock。
 
-    for f in day_files:
+    Returns:
+        pd.DataFrame: 選到的股票清單, 欄位與 manifest.MANIFEST_COLUMNS 相同 (沒有清單時日期與雜湊值為空)。
+    """
+    stocks = manifest.read_manifest(data_dir)
+    if stocks is not None:
+        return manifest.select(stocks, stock_groups, args.code)
+
+    import twstock
+    logger.warning(f"找不到 {manifest.manifest_path(data_dir)}, 改為列出資料夾並查詢 twstock")
+    rows = []
+    for f in os.listdir(data_dir):
         match = re.search(r'(\d+)_day.csv', f)
         if match:
             code = match.group(1)
@@ -103,16 +143,117 @@ def read_stock_data(data_dir, df_dict):
                 continue
             if ((code in twstock.codes.keys()) and twstock.codes[code].type == "股票" and
                     (twstock.codes[code].group in stock_groups)):
-                logger.info(f'Reading {data_dir}/{f}')
-                df = pd.read_csv(f'{data_dir}/{f}')
-                df.set_index('ts', inplace=True)
-                df_dict[code] = df
+                rows.append({'code': code, 'path': f, 'group': twstock.codes[code].group,
+                             'type': twstock.codes[code].type})
+    return pd.DataFrame(rows, columns=manifest.MANIFEST_COLUMNS)
+
+
+def read_stock_data(data_dir, df_dict):
+    """
+    讀取選到的股票的日K, 以 day_schema 的精簡格式放在記憶體中。
+
+    Returns:
+        pd.DataFrame: select_stocks 選到的股票清單。
+    """
+    stocks = select_stocks(data_dir)
+    for code, f in zip(stocks['code'], stocks['path']):
+        logger.info(f'Reading {data_dir}/{f}')
+        with profiler.stage('read', code):
+            df_dict[code] = day_cache.read_day_data(f'{data_dir}/{f}', compact=True)
+    return stocks
+
+
+def apply_concentrated_band(df_dict, band):
+    """
+    以不同的均線聚集門檻重算每檔股票的聚集與聚集後突破欄位。
+
+    Args:
+        df_dict (dict): 股票代號對應的日K資料, 要有均線欄位。
+        band (float): 均線聚集的門檻。
+    """
+    for df in df_dict.values():
+        env = {}
+        indicators.set_concentrated(df, env, band)
+        indicators.set_breakthrough(df, env)
+
+
+def build_signals(panel, df_dict, buy_rule, sell_rule, investment_per_trade, scalar_rules=False, thresholds=None,
+                  rules=None):
+    """
+    每檔股票只算一次買賣規則, 放進 Panel 的 'buy'、'sell' 與 'price_unit' 欄位。
+
+    'buy' 已經包含流動性篩選 (成交金額、成交量與每張價格)。
+
+    Args:
+        panel (Panel): 由 df_dict 建立的 Panel。
+        df_dict (dict): 股票代號對應的日K資料。
+        buy_rule (str): buy_rule_dict 或 rules['buy'] 中的規則名稱。
+        sell_rule (str): sell_rule_dict 或 rules['sell'] 中的規則名稱。
+        investment_per_trade (int): 每次購買金額。
+        scalar_rules (bool): 改用逐日呼叫的規則計算, 用來對照向量化版本。
+        thresholds (dict): 向量化規則使用的門檻, 為 None 時使用預設值。
+        rules (dict): rule_expr.load_rules 讀入的運算式規則, 與內建規則同名時優先使用。
+    """
+    buy_expr = rules['buy'].get(buy_rule) if rules else None
+    sell_expr = rules['sell'].get(sell_rule) if rules else None
+    exprs = [rule for rule in (buy_expr, sell_expr) if rule is not None]
+    buy_signals = {}
+    sell_signals = {}
+    price_units = {}
+    for code, df in df_dict.items():
+        with profiler.stage('rules', code):
+            liquid, price_units[code] = liquidity_mask(df, investment_per_trade)
+            # 運算式規則的買賣訊號一起算, 共用相同的子運算式
+            expr_signals = dict(zip(exprs, rule_expr.evaluate(df, exprs, thresholds))) if exprs else {}
+            if buy_expr is not None:
+                buy_signals[code] = liquid & expr_signals[buy_expr]
+            elif scalar_rules:
+                buy_signals[code] = liquid & scalar_signal(buy_rule_dict[buy_rule], df)
+            else:
+                buy_signals[code] = liquid & buy_rule_vec_dict[buy_rule](df)
+            if sell_expr is not None:
+                sell_signals[code] = expr_signals[sell_expr]
+            elif scalar_rules:
+                sell_signals[code] = scalar_signal(sell_rule_dict[sell_rule], df)
+            else:
+                sell_signals[code] = sell_signal(sell_rule, df, thresholds)
 
+    with profiler.stage('panel'):
+        panel.add_aligned('buy', buy_signals, False)
+        panel.add_aligned('sell', sell_signals, False)
+        panel.add_aligned('price_unit', price_units, 0)
 
-def backtest(date_list, df_dict, ini_amount, investment_per_trade, stock_symbol_name_mapping, buy_rule, sell_rule, fake_break):
+
+def backtest(panel, df_dict, ini_amount, investment_per_trade, stock_symbol_name_mapping, buy_rule, sell_rule,
+             start_date, end_date, scalar_rules=False, thresholds=None, rules=None):
     """
     回測
+
+    Args:
+        panel (Panel): 由 df_dict 與交易日建立的 Panel, 只會讀取不會被修改。
+        df_dict (dict): 股票代號對應的日K資料。
+        ini_amount (int): 初始金額, 0 代表不限金額每次都買。
+        investment_per_trade (int): 每次購買金額。
+        stock_symbol_name_mapping (dict): 股號股名對照表。
+        buy_rule (str): buy_rule_dict 中的規則名稱。
+        sell_rule (str): sell_rule_dict 中的規則名稱。
+        start_date (datetime): 回測開始日期。
+        end_date (datetime): 回測結束日期。
+        scalar_rules (bool): 改用逐日呼叫的規則計算。
+        thresholds (dict): 賣出規則的誤差與停損等門檻, 為 None 時使用 DEFAULT_THRESHOLDS。
+        rules (dict): rule_expr.load_rules 讀入的運算式規則。
+
+    Returns:
+        dict: 回測結果摘要。
     """
+    # 訊號加在複本上, 同一個 Panel 可以給不同的規則與金額重複使用
+    panel = panel.copy()
+    thresholds = {**DEFAULT_THRESHOLDS, **(thresholds or {})}
+    build_signals(panel, df_dict, buy_rule, sell_rule, investment_per_trade, scalar_rules, thresholds, rules)
+    close = panel['Close']
+    volume = panel['Volume']
+    logger.info(f"Panel: {len(panel.dates)} 天 x {len(panel.codes)} 檔, {panel.nbytes / 2**20:.1f} MB")
+
     logger.info("開始回測")
     logger.info(f"每次購買金額 {investment_per_trade }")
     amount = ini_amount
@@ -122,163 +263,110 @@ def backtest(date_list, df_dict, ini_amount, investment_per_trade, stock_symbol_
     else:
         logger.info(f"初始金額 {amount}")
 
-    hold = {}
+    hold = Portfolio(panel.codes)
     trade = {}
+    ledger = TradeLedger(panel.dates, panel.codes)
     count_buy = 0
     count_sell = 0
     total_fee = 0
     win = 0
     lose = 0
+    log_candidates = logger.isEnabledFor(logging.DEBUG)
 
-    for date in date_list:
-        # 更新最後收盤價
-        for code in hold.keys():
-            df = df_dict[code]
-            if date in df.index:
-                hold[code].update_price(int(df.loc[date, 'Close'] * 1000), df.loc[date, 'Close'])
+    # Panel 的每一列就是一個交易日, 各股票的資料已經依日期對齊
+    for t in range(len(panel.dates)):
+        close_row = close[t]
+        volume_row = volume[t]
+        valid_row = panel.valid[t]
+        buy_row = panel['buy'][t]
+        sell_row = panel['sell'][t]
+        price_unit_row = panel['price_unit'][t]
 
-        # 買賣
-        logger.info(f"日期:{date}")
+        # 更新最後收盤價
+        with profiler.stage('mark_to_market'):
+            hold.mark_to_market(close_row, valid_row)
 
         # 賣
-        hold_codes = list(hold.keys())
-        i = 0
-        while i < len(hold_codes):
-            code = hold_codes[i]
-            df = df_dict[code]
-
-            if date in df.index and (sell_rule_dict[sell_rule](df, date) or (hold[code].value/hold[code].cost < 0.95)):
+        with profiler.stage('sell'):
+            for j in hold.sell_candidates(sell_row, valid_row, thresholds['stop_loss']):
+                code = panel.codes[j]
+                position = hold[code]
                 count_sell += 1
-                fee = int(hold[code].value * 0.004425)
-                hold[code].fee += fee
-                cost = hold[code].cost + hold[code].fee
-                profit = hold[code].value - cost
-                total_fee += hold[code].fee
+                fee = int(position.value * 0.004425)
+                hold.add_fee(j, fee)
+                profit = position.value - position.cost - position.fee
+                total_fee += position.fee
                 if profit > 0:
                     win += 1
                 else:
                     lose += 1
-                amount += (hold[code].value - fee)
-                logger.info("=======================")
-                logger.info(f"賣出 {stock_symbol_name_mapping[code]}({code})")
-                logger.info("-----------------------")
-                logger.info(f"張數：        {hold[code].num} 張")
-                logger.info(f"單價：        {hold[code].price:.2f} 元")
-                logger.info(f"總價：        {hold[code].value} 元")
-                logger.info(f"平均購買單價： {hold[code].purchase_price:.2f} 元")
-                logger.info(f"成本：        {hold[code].cost} 元")
-                logger.info(f"賣手續：      {fee} 元")
-                logger.info(f"總手續：      {hold[code].fee} 元")
-                logger.info(
-                    f"獲利：        {profit} 元 " +
-                    f"({profit/cost*100:.2f}) %")
+                amount += (position.value - fee)
 
                 # 更新歷史交易
                 if code in trade:
-                    trade[code].update(hold[code])
+                    trade[code].update(position)
                 else:
-                    tradeHistory = TradeHistory(hold[code])
-                    trade[code] = tradeHistory
-
-                hold.pop(code, None)
-
-                if ini_amount > 0:
-                    logger.info("-----------------------")
-                    logger.info(f"總持有現金： {amount} 元")
-                    logger.info("總持有股票：")
-                    propert = 0
-                    for hold_code in hold.keys():
-                        logger.info(
-                            f"    {stock_symbol_name_mapping[hold_code]}({hold_code}) 有 {hold[hold_code].num} 張 " +
-                            f"共 {hold[hold_code].value} 成本 {hold[hold_code].cost} " +
-                            f"獲利 {hold[hold_code].value - hold[hold_code].cost - hold[hold_code].fee}")
-                        propert += hold[hold_code].value
-                    logger.info(f"總資產： {amount+propert} 元")
-                logger.info("=======================")
-                logger.info("")
-            i += 1
+                    trade[code] = TradeHistory(position)
+                ledger.append(date=t, code=j, side=SELL, num=position.num, price=position.price,
+                              price_unit=position.price_unit, cost=position.cost, fee=fee,
+                              total_fee=position.fee, profit=profit, cash=amount,
+                              assets=amount+hold.market_value-position.value)
+                hold.close(j)
 
         # 找到可購買清單
         buy_list = []
         if ini_amount == 0 or amount >= investment_per_trade:
-            for code in df_dict.keys():
-                df = df_dict[code]
-
-                if date in df.index:
-                    # 單價
-                    price_unit = int(df.loc[date, 'Close'] * 1000)
-                    vol = int(df.loc[date, 'Volume'])
-
-                    item = (code, vol, price_unit)
-
-                    if (price_unit <= investment_per_trade and
-                        (price_unit * df.loc[date, 'Volume']) >= 50000000 and
-                        df.loc[date, 'Volume'] >= 1000 and
-                            buy_rule_dict[buy_rule](df, date)):
-                        buy_list.append(item)
+            # 預先算好的購買訊號已經包含價格與成交量的篩選
+            with profiler.stage('buy_scan'):
+                for j in np.flatnonzero(buy_row):
+                    buy_list.append((panel.codes[j], int(volume_row[j]), int(price_unit_row[j])))
 
             # 購買優先找成交金額大的
-            buy_list = sorted(buy_list, key=lambda x: (x[1]*x[2]), reverse=True)
+            with profiler.stage('sort'):
+                buy_list = sorted(buy_list, key=lambda x: (x[1]*x[2]), reverse=True)
 
         # 列出購買清單
-        if buy_list:
-            logger.info("**********")
-            logger.info("可買清單")
-            for (code, vol, price_unit) in buy_list:
-                logger.info(f"    {stock_symbol_name_mapping[code]:5}({code}) 量:{vol:6} 價:{(price_unit/1000):.2f}")
-
-            logger.info("**********")
+        if buy_list and log_candidates:
+            with profiler.stage('logging'):
+                logger.debug(f"日期:{panel.dates[t].strftime('%Y-%m-%d')} 可買清單")
+                for (code, vol, price_unit) in buy_list:
+                    logger.debug(f"    {stock_symbol_name_mapping[code]:5}({code}) "
+                                 f"量:{vol:6} 價:{(price_unit/1000):.2f}")
 
         # 買
-        for (code, vol, price_unit) in buy_list:
-            df = df_dict[code]
-
-            # 更新買入次數
-            count_buy += 1
-
-            # 買入張數
-            num_per_time = int(investment_per_trade/price_unit)
-
-            # 手續費
-            fee = int(price_unit * num_per_time * 0.001425)
-
-            # 更新持有張數和平均買入價
-            if code in hold.keys():
-                hold[code].add_position(price_unit, num_per_time, fee)
-            else:
-                stockPosition = StockPosition(price_unit, num_per_time, fee)
-                hold[code] = stockPosition
-
-            # 花費
-            cost = num_per_time * price_unit
-            amount -= (cost + fee)
-            if amount < (max_cash_needed * -1):
-                max_cash_needed = amount * -1
-            logger.info("=======================")
-            logger.info(f"買入 {stock_symbol_name_mapping[code]}({code})")
-            logger.info("-----------------------")
-            logger.info(f"張數： {num_per_time} 張")
-            logger.info(f"單價： {df.loc[date, 'Close']:.2f} 元")
-            logger.info(f"總價： {cost} 元")
-            logger.info(f"手續： {fee} 元")
-
-            if ini_amount > 0:
-                logger.info("-----------------------")
-                logger.info(f"總持有現金： {amount} 元")
-                logger.info("總持有股票：")
-                propert = 0
-                for hold_code in hold.keys():
-                    logger.info(
-                        f"    {stock_symbol_name_mapping[hold_code]}({hold_code}) 有 {hold[hold_code].num} 張 " +
-                        f"共 {hold[hold_code].value} 成本 {hold[hold_code].cost} " +
-                        f"獲利 {hold[hold_code].value - hold[hold_code].cost- hold[hold_code].fee}")
-                    propert += hold[hold_code].value
-                logger.info(f"總資產： {amount+propert} 元")
-            logger.info("=======================")
-            logger.info("")
-
-            if ini_amount > 0 and amount < investment_per_trade:
-                break
+        with profiler.stage('buy'):
+            for (code, vol, price_unit) in buy_list:
+                j = panel.code_pos[code]
+                # 更新買入次數
+                count_buy += 1
+
+                # 買入張數
+                num_per_time = int(investment_per_trade/price_unit)
+
+                # 手續費
+                fee = int(price_unit * num_per_time * 0.001425)
+
+                # 更新持有張數和平均買入價
+                hold.buy(j, price_unit, num_per_time, fee)
+
+                # 花費
+                cost = num_per_time * price_unit
+                amount -= (cost + fee)
+                if amount < (max_cash_needed * -1):
+                    max_cash_needed = amount * -1
+                ledger.append(date=t, code=j, side=BUY, num=num_per_time, price=close_row[j],
+                              price_unit=price_unit, cost=cost, fee=fee, total_fee=hold.fee[j],
+                              cash=amount, assets=amount+hold.market_value)
+
+                if ini_amount > 0 and amount < investment_per_trade:
+                    break
+
+    # 逐筆成交的報表在回測結束後才產生
+    if logger.isEnabledFor(logging.INFO):
+        with profiler.stage('logging'):
+            logger.info("逐筆交易紀錄")
+            for line in ledger.report_lines(stock_symbol_name_mapping, with_assets=ini_amount > 0):
+                logger.info(line)
 
     # 結算
     logger.info("=======================")
@@ -327,8 +415,8 @@ def backtest(date_list, df_dict, ini_amount, investment_per_trade, stock_symbol_
         else:
             total_returns = 0
     else:
-        logger.info(f"初始金額： {args.amount}")
-        total_returns = (float(amount+propert)/args.amount-1) * 100
+        logger.info(f"初始金額： {ini_amount}")
+        total_returns = (float(amount+propert)/ini_amount-1) * 100
     days_difference = (end_date - start_date).days
     annualized_returns = (total_returns / days_difference) * 365
 
@@ -344,6 +432,25 @@ def backtest(date_list, df_dict, ini_amount, investment_per_trade, stock_symbol_
     logger.info("=======================")
     logger.info("")
 
+    return {
+        'buy_rule': buy_rule,
+        'sell_rule': sell_rule,
+        'investment_per_trade': investment_per_trade,
+        'amount': ini_amount,
+        'days': days_difference,
+        'total_returns': total_returns,
+        'annualized_returns': annualized_returns,
+        'win_rate': float(win)/(win+lose)*100 if (win + lose) > 0 else float('nan'),
+        'win': win,
+        'lose': lose,
+        'count_buy': count_buy,
+        'count_sell': count_sell,
+        'total_fee': total_fee,
+        'max_cash_needed': max_cash_needed,
+        'total_profit': total_profit,
+        'total_assets': amount + propert,
+    }
+
 
 if __name__ == '__main__':
     args = arg_parse()  # 命令參數解析
@@ -351,12 +458,21 @@ if __name__ == '__main__':
     logger = user_logger.get_logger(args.log)  # 取得logger
     decode_group()
 
+    # 讀取運算式規則
+    rules = None
+    if args.rules:
+        try:
+            rules = rule_expr.load_rules(args.rules)
+        except (OSError, ValueError) as e:
+            logger.critical(f"無法讀取規則檔 {args.rules}: {e}")
+            exit()
+
     # 確定規則正確
-    if args.buy_rule not in buy_rule_dict.keys():
+    if args.buy_rule not in buy_rule_dict.keys() and not (rules and args.buy_rule in rules['buy']):
         logger.critical(f"{args.buy_rule}不是正確購買規則")
         exit()
 
-    if args.sell_rule not in sell_rule_dict.keys():
+    if args.sell_rule not in sell_rule_dict.keys() and not (rules and args.sell_rule in rules['sell']):
         logger.critical(f"{args.sell_rule}不是正確賣規則")
         exit()
 
@@ -367,9 +483,23 @@ if __name__ == '__main__':
         logger.critical(f"找不到{data_dir}")
         exit()
 
+    # 各階段執行時間與 cProfile
+    timer = profiler.enable() if args.profile or args.profile_output else None
+    cprofile = cProfile.Profile() if args.cprofile else None
+    if cprofile is not None:
+        cprofile.enable()
+
     # 取得股票列表資料
     df_dict = {}
-    read_stock_data(data_dir, df_dict)
+    stocks = read_stock_data(data_dir, df_dict)
+    thresholds = {
+        'concentrated_band': args.concentrated_band,
+        'death_cross_deviation': args.death_cross_deviation,
+        'stop_loss': args.stop_loss,
+    }
+    if args.concentrated_band != DEFAULT_THRESHOLDS['concentrated_band']:
+        with profiler.stage('thresholds'):
+            apply_concentrated_band(df_dict, args.concentrated_band)
 
     # 取得股號股名對照表
     stock_symbol_name_mapping = {}
@@ -380,27 +510,29 @@ if __name__ == '__main__':
     start_date_str = args.start_date
 
     start_date = datetime.strptime(start_date_str, '%Y-%m-%d')
-    end_date = start_date
-    for code in df_dict.keys():
-        df = df_dict[code]
-        last_date = datetime.strptime(df.index.max(), '%Y-%m-%d')
-        print(last_date)
-        if end_date < last_date:
-            end_date = last_date
+    calendar = trading_calendar.load_calendar(data_dir, df_dict, manifest.date_range(stocks))
+    calendar = calendar[calendar >= start_date]
+    end_date = max(start_date, calendar[-1].to_pydatetime()) if len(calendar) else start_date
 
     end_date_str = end_date.strftime('%Y-%m-%d')
 
-    delta = timedelta(days=1)
-    date_list = []
-    current_date = start_date
-    while current_date <= end_date:
-        current_date_str = current_date.strftime("%Y-%m-%d")
-        date_list.append(current_date_str)
-        current_date += delta
-
     # 回測
-    backtest(date_list, df_dict, args.amount, args.investment_per_trade,
-             stock_symbol_name_mapping, args.buy_rule, args.sell_rule, args.fake_break)
+    with profiler.stage('panel'):
+        panel = Panel.from_df_dict(df_dict, fields=('Close', 'Volume'), dates=calendar)
+    backtest(panel, df_dict, args.amount, args.investment_per_trade,
+             stock_symbol_name_mapping, args.buy_rule, args.sell_rule, start_date, end_date, args.scalar_rules,
+             thresholds, rules)
+
+    if cprofile is not None:
+        cprofile.disable()
+        cprofile.dump_stats(args.cprofile)
+        logger.info(f"cProfile 紀錄寫入 {args.cprofile}")
+    if timer is not None:
+        profiler.disable()
+        for line in timer.report_lines(args.profile_top):
+            logger.info(line)
+        if args.profile_output:
+            timer.write_json(args.profile_output, args.profile_top)
 
     end_time = datetime.now()
     logger.info(f"{start_date_str} 到 {end_date_str} 的回測結束")
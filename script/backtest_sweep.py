@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+"""
+一次比較多組買賣規則、每次購買金額與初始金額的回測結果。
+
+股票資料只讀一次並建成 Panel, 透過 ProcessPoolExecutor 的 initializer 交給子進程
+(Linux 上以 fork 繼承, 陣列不會被複製), 每個子進程平行跑其中幾組參數,
+最後把每組的總報酬、年化報酬、勝率、總手續費與所需最大現金寫成一張表。
+"""
+
+import argparse
+import itertools
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import json5
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__ + "/..")))  # noqa
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))  # noqa
+import backtest_all  # noqa
+from user_logger import user_logger  # noqa
+from utils import config  # noqa
+from utils import trading_calendar  # noqa
+from utils import manifest  # noqa
+from utils import rule_expr  # noqa
+from utils.panel import Panel  # noqa
+from utils.backtest_struct import buy_rule_dict, sell_rule_dict  # noqa
+
+# 摘要表的欄位順序
+SUMMARY_COLUMNS = ['buy_rule', 'sell_rule', 'investment_per_trade', 'amount', 'days',
+                   'total_returns', 'annualized_returns', 'win_rate', 'win', 'lose',
+                   'count_buy', 'count_sell', 'total_fee', 'max_cash_needed', 'total_profit', 'total_assets']
+
+# 子進程共用的回測資料, 由 init_worker 設定
+_shared = None
+
+
+def arg_parse():
+    """
+    解析參數設定並回傳解析結果。
+
+    Returns:
+        argparse.Namespace: 解析後的參數設定。
+    """
+
+    parser = argparse.ArgumentParser(description='backtest parameter sweep')
+    # 設定參數選項
+    parser.add_argument('--version', action='version', version='%(prog)s 0.1')
+    parser.add_argument('-l', '--log', dest='log', type=str,
+                        metavar='*.log', default=f"{config.DEFAULT_LOG_DIR}/backtest_sweep.log", help='log file name')
+    parser.add_argument('-o', '--output', dest='output', type=str,
+                        metavar='*.csv', default="backtest_sweep.csv", help='summary table file name')
+    parser.add_argument('--amount', dest='amount', type=str,
+                        metavar='<UNSIGNED INT>,...', default="0,2000000", help='initial amounts')
+    parser.add_argument('--investment_per_trade', dest='investment_per_trade', type=str,
+                        metavar='<UNSIGNED INT>,...', default="500000", help='investments per trade')
+    parser.add_argument('--group', dest='group', type=str,
+                        metavar='<UNSIGNED INT>|ALL', default="ALL", help='stock groups')
+    parser.add_argument('--buy_rule', dest='buy_rule', type=str,
+                        metavar='*,...|ALL', default="ALL", help='buy rules in backtest_struct')
+    parser.add_argument('--sell_rule', dest='sell_rule', type=str,
+                        metavar='*,...|ALL', default="ALL", help='sell rules in backtest_struct')
+    parser.add_argument('--code', dest='code', type=str,
+                        metavar='*', default=".*", help='Only test that code')
+    parser.add_argument('--start_date', dest='start_date', type=str,
+                        metavar='*', default=config.SHIOAJI_START_DATE,
+                        help=f'Add the start date. default {config.SHIOAJI_START_DATE}')  # 2018-12-07
+    parser.add_argument('--rules', dest='rules', type=str,
+                        metavar='*.json5', default=None, help='以運算式定義的規則檔, 其中的規則一併列入 ALL')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int,
+                        metavar='<UNSIGNED INT>', default=None, help='number of worker processes')
+
+    # 解析參數
+    return parser.parse_args()
+
+
+def parse_rules(rule_str, rule_dict, kind):
+    """
+    將以逗號分隔的規則名稱轉成 list, ALL 代表 rule_dict 中的所有規則。
+    """
+    if rule_str == "ALL":
+        return list(rule_dict)
+    rules = [rule for rule in rule_str.split(",") if rule]
+    for rule in rules:
+        if rule not in rule_dict:
+            raise ValueError(f"{rule}不是正確{kind}規則")
+    return rules
+
+
+def parse_ints(int_str):
+    """
+    將以逗號分隔的數字轉成 list。
+    """
+    return [int(value) for value in int_str.split(",") if value]
+
+
+def init_worker(panel, df_dict, stock_symbol_name_mapping, start_date, end_date, rules=None):
+    """
+    子進程的初始化, 保存共用的回測資料並關閉逐筆交易的紀錄。
+    """
+    global _shared
+    _shared = (panel, df_dict, stock_symbol_name_mapping, start_date, end_date, rules)
+    null_logger = logging.getLogger('backtest_sweep.worker')
+    null_logger.disabled = True
+    backtest_all.logger = null_logger
+
+
+def run_combination(combination):
+    """
+    在子進程中執行一組參數的回測。
+
+    Args:
+        combination (tuple): (buy_rule, sell_rule, investment_per_trade, amount)。
+
+    Returns:
+        dict: backtest_all.backtest 的回測結果摘要。
+    """
+    buy_rule, sell_rule, investment_per_trade, amount = combination
+    panel, df_dict, stock_symbol_name_mapping, start_date, end_date, rules = _shared
+    return backtest_all.backtest(panel, df_dict, amount, investment_per_trade, stock_symbol_name_mapping,
+                                 buy_rule, sell_rule, start_date, end_date, rules=rules)
+
+
+if __name__ == '__main__':
+    args = arg_parse()  # 命令參數解析
+    start_time = datetime.now()
+    logger = user_logger.get_logger(args.log)  # 取得logger
+
+    # decode_group 與 read_stock_data 使用 backtest_all 的全域設定
+    backtest_all.args = args
+    backtest_all.logger = logger
+    backtest_all.decode_group()
+
+    try:
+        rules = rule_expr.load_rules(args.rules) if args.rules else None
+        buy_rules = parse_rules(args.buy_rule, {**buy_rule_dict, **(rules['buy'] if rules else {})}, "購買")
+        sell_rules = parse_rules(args.sell_rule, {**sell_rule_dict, **(rules['sell'] if rules else {})}, "賣")
+    except (OSError, ValueError) as e:
+        logger.critical(e)
+        exit()
+    investments = parse_ints(args.investment_per_trade)
+    amounts = parse_ints(args.amount)
+
+    data_dir = config.DATA_DIR
+    if not os.path.exists(data_dir):
+        logger.critical(f"找不到{data_dir}")
+        exit()
+
+    # 股票資料只讀一次
+    df_dict = {}
+    stocks = backtest_all.read_stock_data(data_dir, df_dict)
+
+    with open(config.STOCK_SYMBOL_MAPPING, 'r', encoding='utf-8') as f:
+        stock_symbol_name_mapping = json5.load(f)
+
+    start_date = datetime.strptime(args.start_date, '%Y-%m-%d')
+    calendar = trading_calendar.load_calendar(data_dir, df_dict, manifest.date_range(stocks))
+    calendar = calendar[calendar >= start_date]
+    end_date = max(start_date, calendar[-1].to_pydatetime()) if len(calendar) else start_date
+    panel = Panel.from_df_dict(df_dict, fields=('Close', 'Volume'), dates=calendar)
+    logger.info(f"Panel: {len(panel.dates)} 天 x {len(panel.codes)} 檔, {panel.nbytes / 2**20:.1f} MB")
+
+    combinations = list(itertools.product(buy_rules, sell_rules, investments, amounts))
+    logger.info(f"共 {len(combinations)} 組參數")
+
+    # 回測資料只在建立子進程時傳一次, 之後每個任務只傳參數
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=init_worker,
+                             initargs=(panel, df_dict, stock_symbol_name_mapping, start_date, end_date,
+                                       rules)) as executor:
+        results = []
+        for summary in executor.map(run_combination, combinations):
+            logger.info(f"{summary['buy_rule']} / {summary['sell_rule']} "
+                        f"每次 {summary['investment_per_trade']} 初始 {summary['amount']}: "
+                        f"總報酬 {summary['total_returns']:.2f} % 年化 {summary['annualized_returns']:.2f} %")
+            results.append(summary)
+
+    summary_table = pd.DataFrame(results, columns=SUMMARY_COLUMNS)
+    summary_table.sort_values('annualized_returns', ascending=False, inplace=True)
+    summary_table.to_csv(args.output, index=False, float_format='%.4f')
+    logger.info(f"結果寫入 {args.output}")
+
+    end_time = datetime.now()
+    total_time = (end_time - start_time).total_seconds()
+    logger.info(f"程式共花費: {total_time} 秒")
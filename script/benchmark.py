@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+"""
+效能測試。
+
+以 utils.synthetic 的模擬資料量測各個日K指標、整個日K指標流程、process_min_file 與 backtest()
+的執行時間與每個項目自己配置的最高記憶體量, 結果寫成 JSON; 給 --baseline 時與之前的結果比較, 變慢超過
+--tolerance 的項目會列出來並以非 0 結束。
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__ + "/..")))  # noqa
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))  # noqa
+import backtest_all  # noqa
+import process_kbars  # noqa
+from utils import synthetic  # noqa
+from utils.panel import Panel  # noqa
+
+
+def arg_parse():
+    """
+    解析參數設定並回傳解析結果。
+
+    Returns:
+        argparse.Namespace: 解析後的參數設定。
+    """
+    parser = argparse.ArgumentParser(description='benchmark with synthetic data')
+    parser.add_argument('--stocks', dest='stocks', type=str,
+                        metavar='<UNSIGNED INT>,...', default="10,100", help='回測的股票數量, 例如 10,100,2000')
+    parser.add_argument('--days', dest='days', type=int,
+                        metavar='<UNSIGNED INT>', default=1500, help='日K的交易日數')
+    parser.add_argument('--min_days', dest='min_days', type=int,
+                        metavar='<UNSIGNED INT>', default=250, help='process_min_file 使用的分K交易日數')
+    parser.add_argument('--repeat', dest='repeat', type=int,
+                        metavar='<UNSIGNED INT>', default=3, help='每個項目重複的次數, 取最快的一次')
+    parser.add_argument('--seed', dest='seed', type=int,
+                        metavar='<INT>', default=0, help='模擬資料的亂數種子')
+    parser.add_argument('-o', '--output', dest='output', type=str,
+                        metavar='*.json', default="benchmark.json", help='結果檔名')
+    parser.add_argument('--baseline', dest='baseline', type=str,
+                        metavar='*.json', default=None, help='要比較的舊結果')
+    parser.add_argument('--tolerance', dest='tolerance', type=float,
+                        metavar='<FLOAT>', default=0.2, help='比舊結果慢多少比例以內不算變慢')
+    return parser.parse_args()
+
+
+def peak_alloc_mb(func, data):
+    """
+    執行一次 func, 回傳這次執行中新配置的記憶體最高值 (MB)。
+
+    以 tracemalloc 量測 (NumPy 的陣列也會被追蹤), 不受之前項目的影響;
+    tracemalloc 會拖慢執行, 所以與計時分開執行。
+    """
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        func(data)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return (peak - base) / 2**20
+
+
+def measure(name, func, repeat, setup=None, **info):
+    """
+    重複執行 func 並記錄時間, 再另外執行一次量測記憶體。
+
+    Args:
+        name (str): 項目名稱。
+        func (callable): 要量測的函式, 參數是 setup() 的回傳值。
+        repeat (int): 重複次數。
+        setup (callable): 每次執行前準備資料, 不計入時間。
+        **info: 一併記錄的參數, 例如股票數量。
+
+    Returns:
+        dict: 一筆量測結果。
+    """
+    seconds = []
+    for _ in range(repeat):
+        data = setup() if setup is not None else None
+        start = time.perf_counter()
+        func(data)
+        seconds.append(time.perf_counter() - start)
+    data = setup() if setup is not None else None
+    result = dict(name=name, **info, repeat=repeat, best=min(seconds), mean=float(np.mean(seconds)),
+                  peak_alloc_mb=peak_alloc_mb(func, data))
+    print(f"{name:40} {result['best']*1000:10.2f} ms {result['peak_alloc_mb']:10.2f} MB")
+    return result
+
+
+def bench_indicators(days, repeat, seed):
+    """
+    量測每個日K指標與整個日K指標流程。
+    """
+    day_data = synthetic.day_bars(days, seed)
+    results = []
+
+    # 依照流程的順序, 每個指標都在前面的欄位算好之後量測
+    env = {'ma_states': None}
+    prepared = day_data.copy()
+    for indicator in process_kbars.DAY_PIPELINE.steps:
+        before = prepared.copy()
+        before_env = dict(env)
+        results.append(measure(f'indicator.{indicator.name}',
+                                lambda data: indicator.func(*data), repeat,
+                                setup=lambda: (before.copy(), dict(before_env)), days=days))
+        indicator.func(prepared, env)
+
+    results.append(measure('pipeline.day', process_kbars.DAY_PIPELINE.run, repeat,
+                           setup=day_data.copy, days=days))
+    return results
+
+
+def bench_process_min_file(min_days, repeat, seed):
+    """
+    量測 process_min_file (讀分K、合成日K、計算指標與寫檔)。
+    """
+    with tempfile.TemporaryDirectory() as data_dir:
+        min_file = synthetic.write_minute_files(data_dir, 1, min_days, seed)[0]
+        return [measure('process_min_file', lambda _: process_kbars.process_min_file(min_file, data_dir), repeat,
+                        days=min_days, rows=min_days * synthetic.BARS_PER_DAY)]
+
+
+def bench_backtest(stocks, days, repeat, seed):
+    """
+    量測 backtest() 的回測迴圈。
+    """
+    df_dict = synthetic.day_universe(stocks, days, seed)
+    for df in df_dict.values():
+        process_kbars.DAY_PIPELINE.run(df)
+        for col in ('Previous Index', '前高 Index', '前低 Index'):
+            df[col] = pd.to_datetime(df[col])
+    calendar = synthetic.trading_days(days)
+    mapping = {code: code for code in df_dict}
+    start_date = calendar[0].to_pydatetime()
+    end_date = calendar[-1].to_pydatetime()
+
+    results = [measure('backtest.panel', lambda _: Panel.from_df_dict(df_dict, dates=calendar), repeat,
+                       stocks=stocks, days=days)]
+    panel = Panel.from_df_dict(df_dict, dates=calendar)
+    for amount in (0, 2000000):
+        results.append(measure(f'backtest.amount_{amount}',
+                               lambda _: backtest_all.backtest(panel, df_dict, amount, 500000, mapping,
+                                                               '過高買', '破底賣', start_date, end_date),
+                               repeat, stocks=stocks, days=days))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    與舊結果比較。
+
+    Returns:
+        list: 變慢的項目名稱。
+    """
+    def key(result):
+        return result['name'], result.get('stocks'), result.get('days')
+
+    old = {key(result): result for result in baseline['results']}
+    slower = []
+    print(f"{'項目':38} {'舊 (ms)':>10} {'新 (ms)':>10} {'比例':>7}")
+    for result in results:
+        if key(result) not in old:
+            continue
+        ratio = result['best'] / old[key(result)]['best']
+        mark = ''
+        if ratio > 1 + tolerance:
+            mark = ' 變慢'
+            slower.append(result['name'])
+        label = result['name'] + (f"[{result['stocks']}]" if 'stocks' in result else '')
+        print(f"{label:40} {old[key(result)]['best']*1000:10.2f} {result['best']*1000:10.2f} {ratio:7.2f}{mark}")
+    return slower
+
+
+if __name__ == '__main__':
+    args = arg_parse()  # 命令參數解析
+
+    # 回測時不輸出逐筆紀錄
+    null_logger = logging.getLogger('benchmark.backtest')
+    null_logger.disabled = True
+    backtest_all.logger = null_logger
+
+    results = []
+    results += bench_indicators(args.days, args.repeat, args.seed)
+    results += bench_process_min_file(args.min_days, args.repeat, args.seed)
+    for stocks in [int(value) for value in args.stocks.split(",") if value]:
+        results += bench_backtest(stocks, args.days, args.repeat, args.seed)
+
+    report = {
+        'created': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'args': vars(args),
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"結果寫入 {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        slower = compare(results, baseline, args.tolerance)
+        if slower:
+            print(f"變慢的項目: {', '.join(slower)}")
+            sys.exit(1)
@@ -0,0 +1,170 @@
+#!/usr/bin/python3
+"""
+一次評估規則檔中的所有運算式規則。
+
+每檔股票只讀一次, 所有規則在同一次 rule_expr.evaluate 中算出, 相同的子運算式只算一次,
+規則數變多時執行時間不會跟著倍增。每條規則統計訊號數、有訊號的股票數, 以及訊號後
+--horizon 根K棒的平均報酬與上漲比例 (買進規則已經包含流動性篩選), 結果寫成一張表,
+表現好的規則再以 backtest_all --rules 做完整的回測。
+"""
+
+import argparse
+import os
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__ + "/..")))  # noqa
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))  # noqa
+import backtest_all  # noqa
+from user_logger import user_logger  # noqa
+from utils import config  # noqa
+from utils import day_schema  # noqa
+from utils import rule_expr  # noqa
+from utils.backtest_struct import liquidity_mask  # noqa
+
+# 結果表的欄位順序
+SUMMARY_COLUMNS = ['kind', 'rule', 'signals', 'stocks', 'mean_return', 'win_rate', 'expression']
+
+
+def arg_parse():
+    """
+    解析參數設定並回傳解析結果。
+
+    Returns:
+        argparse.Namespace: 解析後的參數設定。
+    """
+    parser = argparse.ArgumentParser(description='evaluate expression rules over the universe')
+    parser.add_argument('-l', '--log', dest='log', type=str,
+                        metavar='*.log', default=f"{config.DEFAULT_LOG_DIR}/evaluate_rules.log",
+                        help='log file name')
+    parser.add_argument('-o', '--output', dest='output', type=str,
+                        metavar='*.csv', default="evaluate_rules.csv", help='result table file name')
+    parser.add_argument('--rules', dest='rules', type=str,
+                        metavar='*.json5', default=rule_expr.DEFAULT_RULES, help='規則檔')
+    parser.add_argument('--buy_rule', dest='buy_rule', type=str,
+                        metavar='*,...|ALL', default="ALL", help='要評估的買進規則')
+    parser.add_argument('--sell_rule', dest='sell_rule', type=str,
+                        metavar='*,...|ALL', default="ALL", help='要評估的賣出規則')
+    parser.add_argument('--horizon', dest='horizon', type=int,
+                        metavar='<UNSIGNED INT>', default=20, help='訊號後第幾根K棒計算報酬')
+    parser.add_argument('--investment_per_trade', dest='investment_per_trade', type=int,
+                        metavar='<UNSIGNED INT>', default=500000, help='流動性篩選使用的每次購買金額')
+    parser.add_argument('--group', dest='group', type=str,
+                        metavar='<UNSIGNED INT>|ALL', default="ALL", help='stock groups')
+    parser.add_argument('--code', dest='code', type=str,
+                        metavar='*', default=".*", help='Only test that code')
+    parser.add_argument('--start_date', dest='start_date', type=str,
+                        metavar='*', default=config.SHIOAJI_START_DATE,
+                        help=f'Add the start date. default {config.SHIOAJI_START_DATE}')
+    return parser.parse_args()
+
+
+def select_rules(rule_str, rules, kind):
+    """
+    將以逗號分隔的規則名稱轉成 Rule 的 list, ALL 代表規則檔中該種類的所有規則。
+    """
+    if rule_str == "ALL":
+        return list(rules.values())
+    names = [name for name in rule_str.split(",") if name]
+    for name in names:
+        if name not in rules:
+            raise ValueError(f"{name}不是規則檔中的{kind}規則")
+    return [rules[name] for name in names]
+
+
+def forward_returns(df, horizon):
+    """
+    每一天收盤後持有 horizon 根K棒的報酬, 最後 horizon 根為 NaN。
+    """
+    close = day_schema.values(df, 'Close')
+    returns = np.full(len(close), np.nan)
+    if 0 < horizon < len(close):
+        returns[:-horizon] = close[horizon:] / close[:-horizon] - 1
+    return returns
+
+
+if __name__ == '__main__':
+    args = arg_parse()  # 命令參數解析
+    start_time = datetime.now()
+    logger = user_logger.get_logger(args.log)  # 取得logger
+
+    try:
+        rules = rule_expr.load_rules(args.rules)
+        buy_rules = select_rules(args.buy_rule, rules['buy'], "購買")
+        sell_rules = select_rules(args.sell_rule, rules['sell'], "賣")
+    except (OSError, ValueError) as e:
+        logger.critical(e)
+        exit()
+    selected = buy_rules + sell_rules
+    total_nodes, unique_nodes = rule_expr.node_count(selected)
+    logger.info(f"{len(buy_rules)} 條買進規則, {len(sell_rules)} 條賣出規則, "
+                f"{total_nodes} 個運算節點, 去掉重複後 {unique_nodes} 個")
+
+    # decode_group 與 read_stock_data 使用 backtest_all 的全域設定
+    backtest_all.args = args
+    backtest_all.logger = logger
+    backtest_all.decode_group()
+
+    data_dir = config.DATA_DIR
+    if not os.path.exists(data_dir):
+        logger.critical(f"找不到{data_dir}")
+        exit()
+
+    df_dict = {}
+    backtest_all.read_stock_data(data_dir, df_dict)
+    start_date = pd.Timestamp(args.start_date)
+
+    signals = np.zeros(len(selected), dtype=np.int64)
+    stocks = np.zeros(len(selected), dtype=np.int64)
+    return_sum = np.zeros(len(selected))
+    return_count = np.zeros(len(selected), dtype=np.int64)
+    wins = np.zeros(len(selected), dtype=np.int64)
+    evaluate_seconds = 0
+    for code, df in df_dict.items():
+        t0 = time.perf_counter()
+        try:
+            results = rule_expr.evaluate(df, selected)
+        except KeyError as e:
+            logger.critical(f"{code}: {e}")
+            exit()
+        evaluate_seconds += time.perf_counter() - t0
+
+        in_range = (df.index >= start_date)
+        liquid, _ = liquidity_mask(df, args.investment_per_trade)
+        returns = forward_returns(df, args.horizon)
+        for i, signal in enumerate(results):
+            mask = signal & in_range
+            if i < len(buy_rules):
+                mask = mask & liquid
+            count = int(mask.sum())
+            signals[i] += count
+            stocks[i] += count > 0
+            valid = returns[mask]
+            valid = valid[~np.isnan(valid)]
+            return_sum[i] += valid.sum()
+            return_count[i] += len(valid)
+            wins[i] += int((valid > 0).sum())
+    logger.info(f"{len(df_dict)} 檔股票, 規則計算共花費 {evaluate_seconds:.3f} 秒")
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        table = pd.DataFrame({
+            'kind': ['buy'] * len(buy_rules) + ['sell'] * len(sell_rules),
+            'rule': [rule.name for rule in selected],
+            'signals': signals,
+            'stocks': stocks,
+            'mean_return': return_sum / return_count * 100,
+            'win_rate': wins / return_count * 100,
+            'expression': [rule.text for rule in selected],
+        }, columns=SUMMARY_COLUMNS)
+    for row in table.itertuples():
+        logger.info(f"{row.kind} {row.rule}: {row.signals} 個訊號 {row.stocks} 檔, "
+                    f"{args.horizon} 根K棒後平均報酬 {row.mean_return:.2f} % 上漲比例 {row.win_rate:.2f} %")
+    table.to_csv(args.output, index=False, float_format='%.4f')
+    logger.info(f"結果寫入 {args.output}")
+
+    total_time = (datetime.now() - start_time).total_seconds()
+    logger.info(f"程式共花費: {total_time} 秒")
@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+"""
+同時下載多檔股票的分K, 直接接在資料夾中的 _min.csv 後面。
+
+預設以 -k 的 key 檔登入 Shioaji 下載; --server 改從 HTTP 伺服器下載, --mock 則在同一個進程中
+啟動 utils.mock_server 提供模擬資料, 不需要網路與帳號。下載完成後執行 process_kbars -i 就只會
+處理新接上的分K。
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime
+
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__ + "/..")))  # noqa
+from user_logger import user_logger  # noqa
+from utils import config  # noqa
+from utils import fetcher  # noqa
+from utils.mock_server import MockServer  # noqa
+
+
+def arg_parse():
+    """
+    解析參數設定並回傳解析結果。
+
+    Returns:
+        argparse.Namespace: 解析後的參數設定。
+    """
+    parser = argparse.ArgumentParser(description='concurrent minute-bar fetcher')
+    parser.add_argument('-l', '--log', dest='log', type=str,
+                        metavar='*.log', default=f"{config.DEFAULT_LOG_DIR}/fetch_min_data.log", help='log file name')
+    parser.add_argument('--data_dir', dest='data_dir', type=str,
+                        metavar='*', default=config.DATA_DIR, help='本地資料緩存目錄')
+    parser.add_argument('--codes', dest='codes', type=str, metavar='2330,2317,...',
+                        default=None, help='要下載的股票代號, 預設為資料夾中已有 _min.csv 的股票')
+    parser.add_argument('--start_date', dest='start_date', type=str, metavar='YYYY-MM-DD',
+                        default=config.SHIOAJI_START_DATE, help='沒有 _min.csv 的股票從這一天開始下載')
+    parser.add_argument('--end_date', dest='end_date', type=str, metavar='YYYY-MM-DD',
+                        default=None, help='下載到這一天 (含), 預設為今天')
+    parser.add_argument('-j', '--concurrency', dest='concurrency', type=int, metavar='<UNSIGNED INT>',
+                        default=8, help='同時下載的股票數')
+    parser.add_argument('--rate', dest='rate', type=float, metavar='<FLOAT>',
+                        default=10, help='每秒最多的請求數, 0 代表不限制')
+    parser.add_argument('--burst', dest='burst', type=float, metavar='<FLOAT>',
+                        default=None, help='最多累積的突發請求數, 預設與 --rate 相同')
+    parser.add_argument('--retries', dest='retries', type=int, metavar='<UNSIGNED INT>',
+                        default=5, help='每個請求最多重試幾次')
+    parser.add_argument('--window_days', dest='window_days', type=int, metavar='<UNSIGNED INT>',
+                        default=fetcher.DEFAULT_WINDOW_DAYS, help='每個請求的日期區間長度')
+    parser.add_argument('-k', '--key', dest='key', type=str,
+                        metavar='*.key', default="api.key", help='key file name')
+    parser.add_argument('--server', dest='server', type=str, metavar='HOST:PORT',
+                        default=None, help='從 HTTP 伺服器下載, 不使用 Shioaji')
+    parser.add_argument('--mock', dest='mock', action='store_true',
+                        help='啟動本地的模擬伺服器並從它下載')
+    parser.add_argument('--mock_latency', dest='mock_latency', type=float, metavar='<FLOAT>',
+                        default=0, help='模擬伺服器每個請求延遲的秒數')
+    parser.add_argument('--mock_fail_rate', dest='mock_fail_rate', type=float, metavar='<FLOAT>',
+                        default=0, help='模擬伺服器隨機回傳錯誤的比例')
+    return parser.parse_args()
+
+
+def parse_address(address):
+    """
+    將 HOST:PORT 轉成 (host, port)。
+    """
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def local_codes(data_dir):
+    """
+    回傳資料夾中已有 _min.csv 的股票代號。
+    """
+    return sorted(f[:-len('_min.csv')] for f in os.listdir(data_dir) if f.endswith('_min.csv'))
+
+
+async def fetch(args, codes, end_date):
+    """
+    建立分K來源並下載所有股票。
+
+    Returns:
+        tuple: (每檔股票的 FetchResult, 模擬伺服器或 None)。
+    """
+    mock = None
+    if args.mock:
+        mock = MockServer(latency=args.mock_latency, fail_rate=args.mock_fail_rate)
+        client = fetcher.HttpClient(*await mock.start())
+    elif args.server:
+        client = fetcher.HttpClient(*parse_address(args.server))
+    else:
+        client = await asyncio.to_thread(fetcher.ShioajiClient.login, args.key)
+
+    minute_fetcher = fetcher.MinuteFetcher(client, args.data_dir, concurrency=args.concurrency, rate=args.rate,
+                                           burst=args.burst, retries=args.retries, window_days=args.window_days)
+    try:
+        results = await minute_fetcher.fetch_all(codes, args.start_date, end_date)
+    finally:
+        await client.close()
+        if mock is not None:
+            await mock.close()
+    return results, mock
+
+
+if __name__ == '__main__':
+    args = arg_parse()  # 命令參數解析
+    start_time = datetime.now()
+    logger = user_logger.get_logger(args.log)  # 取得logger
+
+    data_dir = args.data_dir
+    os.makedirs(data_dir, exist_ok=True)
+    codes = args.codes.split(',') if args.codes else local_codes(data_dir)
+    if not codes:
+        logger.critical(f"{data_dir}中沒有 _min.csv, 請以 --codes 指定股票代號")
+        exit()
+    end_date = pd.Timestamp(args.end_date) if args.end_date else pd.Timestamp.today().normalize()
+
+    t0 = time.perf_counter()
+    results, mock = asyncio.run(fetch(args, codes, end_date))
+    seconds = time.perf_counter() - t0
+
+    failed = 0
+    for result in results:
+        if result.error:
+            failed += 1
+            logger.error(f"{result.code} 下載失敗: {result.error} (已接上 {result.rows} 列)")
+        else:
+            logger.info(f"{result.code} 接上 {result.rows} 列, 請求 {result.requests} 次, 重試 {result.retries} 次, "
+                        f"最後一筆 {result.last_ts}")
+
+    requests = sum(result.requests + result.retries for result in results)
+    rows = sum(result.rows for result in results)
+    logger.info(f"{len(results)} 檔股票, 失敗 {failed} 檔, 共接上 {rows} 列")
+    logger.info(f"請求 {requests} 次, 花費 {seconds:.2f} 秒, 每秒 {requests / seconds if seconds else 0:.1f} 次")
+    if mock is not None:
+        logger.info(f"模擬伺服器收到 {mock.requests} 個請求, 回傳錯誤 {mock.failures} 次")
+    total_time = (datetime.now() - start_time).total_seconds()
+    logger.info(f"程式共花費: {total_time} 秒")
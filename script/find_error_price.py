@@ -32,15 +32,20 @@ Shioaji 台灣股市資料下載與 K 線分析專案
 """
 import os
 import argparse
-import pandas as pd
 import sys
 from concurrent.futures import ProcessPoolExecutor
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__+"/..")))  # noqa
 from utils import config  # noqa
+from utils import data_quality  # noqa
+from utils import manifest  # noqa
+from utils import trading_calendar  # noqa
 
 args = None
 
+# process_kbars 寫在資料夾中的清單檔, 不是K棒資料
+METADATA_FILES = {trading_calendar.CALENDAR_FILE, manifest.MANIFEST_FILE}
+
 
 def parse_arguments():
     """
@@ -54,51 +59,63 @@ def parse_arguments():
     parser.add_argument('--cache_dir', dest='cache_dir', type=str,
                         metavar='*', default=config.DATA_DIR, help='本地資料緩存目錄')
     parser.add_argument('--suffix', dest='suffix', type=str,
-                        metavar='*', default="", help='<>.csv <>這段後贅字')
+                        metavar='*', default="_min", help='<>.csv <>這段後贅字, 檢查項目以分K為準, 預設只檢查 _min.csv')
+    parser.add_argument('--chunksize', dest='chunksize', type=int,
+                        metavar='<UNSIGNED INT>', default=data_quality.DEFAULT_CHUNKSIZE, help='每次讀取的列數')
+    parser.add_argument('-o', '--output', dest='output', type=str,
+                        metavar='*.csv', default=None, help='將每個檔案的檢查結果寫成 CSV')
     return parser.parse_args()
 
 
-def check_stock_data(file_path):
+def check_stock_data(file_path, chunksize=data_quality.DEFAULT_CHUNKSIZE):
     """
-    檢查 CSV 檔案中是否存在股價資料錯誤，並列印出符合條件的行。
+    檢查 CSV 檔案中的股價資料。
 
     Args:
         file_path (str): CSV 檔案的路徑。
-    """
-    df = pd.read_csv(file_path)
-    error_row = None
+        chunksize (int): 每次讀取的列數。
 
-    for i in range(len(df)):
-        if df.loc[i, "Volume"] != 0:
-            if df.loc[i, "Low"] == 0 or df.loc[i, "Close"] == 0 or df.loc[i, "High"] == 0 or df.loc[i, "Open"] == 0:
-                error_row = i
-                break
-
-    if error_row is not None:
-        print(f"{file_path}: {error_row}")
+    Returns:
+        dict: data_quality.scan_min_file 的檢查結果。
+    """
+    return data_quality.scan_min_file(file_path, chunksize)
 
 
 def find_all_error_stock_data(cache_dir):
     """
-    找出 cache_dir 中 Low、Close、High 或 Open 為 0 的 CSV 檔案。
+    檢查 cache_dir 中所有的 CSV 檔案並列出有問題的檔案。
 
     Args:
         cache_dir (str): CSV 檔案所在的資料夾。
+
+    Returns:
+        tuple: data_quality.build_report 的 (摘要, 範例)。
     """
     # 檢查資料夾是否存在
     if not os.path.exists(cache_dir):
         print(f"找不到資料夾: {cache_dir}")
-        return
+        return None
 
-    # 列出資料夾中的所有 CSV 檔案
+    # 列出資料夾中檔名以 --suffix 結尾的 CSV 檔案, 略過交易日曆與股票清單
+    # 日K、週K 與 _<N>min 等 process_kbars 產生的檔案不是分K, 缺口與跳價的檢查不適用
     file_paths = [os.path.join(cache_dir, filename) for filename in os.listdir(
-        cache_dir) if filename.endswith(f"{args.suffix}.csv")]
+        cache_dir) if filename.endswith(f"{args.suffix}.csv") and filename not in METADATA_FILES]
 
     with ProcessPoolExecutor() as executor:
-        # 將任務提交到進程池中執行
-        executor.map(check_stock_data, file_paths)
+        # 將任務提交到進程池中執行, 所有結果都收回來彙整
+        results = executor.map(check_stock_data, file_paths, [args.chunksize]*len(file_paths))
+        summary, issues = data_quality.build_report(results)
+
+    bad = data_quality.has_issues(summary)
+    print(f"共檢查 {len(summary)} 個檔案, {len(bad)} 個有問題")
+    if len(bad):
+        print(bad.drop(columns=['first_ts', 'last_ts']).to_string(index=False))
+        print(issues.to_string(index=False))
+    return summary, issues
 
 
 if __name__ == "__main__":
     args = parse_arguments()  # 命令參數解析
-    find_all_error_stock_data(args.cache_dir)
+    report = find_all_error_stock_data(args.cache_dir)
+    if report is not None and args.output:
+        report[0].to_csv(args.output, index=False)
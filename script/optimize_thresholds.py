@@ -0,0 +1,210 @@
+#!/usr/bin/python3
+"""
+以 walk-forward 評估策略門檻的網格。
+
+均線聚集門檻、ESMA20死亡交叉誤差與停損三個門檻的所有組合一次回測 (utils.threshold_grid),
+交易日切成 --folds + 1 段: 第 f 折以前 f 段的年化報酬挑出最好的一組, 再看它在下一段的年化報酬。
+各折選出的門檻在各自測試期的結果串接起來就是 walk-forward 的樣本外成績, 測試期的資料不參與挑選。
+建議的門檻以全部資料挑選 (等於再往後一折的訓練期), 預期表現參考樣本外成績。
+所有組合的整段與各折結果寫成一張表, 選出的門檻可以用 backtest_all 的同名參數重跑完整的回測。
+"""
+
+import argparse
+import itertools
+import os
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__ + "/..")))  # noqa
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))  # noqa
+import backtest_all  # noqa
+from user_logger import user_logger  # noqa
+from utils import config  # noqa
+from utils import manifest  # noqa
+from utils import threshold_grid  # noqa
+from utils import trading_calendar  # noqa
+from utils.panel import Panel  # noqa
+from utils.backtest_struct import buy_rule_dict, sell_rule_dict, DEFAULT_THRESHOLDS  # noqa
+
+# 網格中的門檻
+GRID_THRESHOLDS = ('concentrated_band', 'death_cross_deviation', 'stop_loss')
+
+
+def parse_grid(grid_str):
+    """
+    將門檻的網格設定轉成陣列: 以逗號分隔的數值, 或 start:stop:num 代表 np.linspace(start, stop, num)。
+    """
+    if ':' in grid_str:
+        start, stop, num = grid_str.split(':')
+        return np.linspace(float(start), float(stop), int(num))
+    return np.array([float(value) for value in grid_str.split(',') if value])
+
+
+def arg_parse():
+    """
+    解析參數設定並回傳解析結果。
+
+    Returns:
+        argparse.Namespace: 解析後的參數設定。
+    """
+    parser = argparse.ArgumentParser(description='walk-forward threshold grid optimizer')
+    parser.add_argument('-l', '--log', dest='log', type=str,
+                        metavar='*.log', default=f"{config.DEFAULT_LOG_DIR}/optimize_thresholds.log",
+                        help='log file name')
+    parser.add_argument('-o', '--output', dest='output', type=str,
+                        metavar='*.csv', default="optimize_thresholds.csv", help='result table file name')
+    parser.add_argument('--investment_per_trade', dest='investment_per_trade', type=int,
+                        metavar='<UNSIGNED INT>', default=500000, help='investment per trade')
+    parser.add_argument('--group', dest='group', type=str,
+                        metavar='<UNSIGNED INT>|ALL', default="ALL", help='stock groups')
+    parser.add_argument('--buy_rule', dest='buy_rule', type=str,
+                        metavar='*', default="聚集買", help='buy rule in backtest_struct')
+    parser.add_argument('--sell_rule', dest='sell_rule', type=str,
+                        metavar='*', default="ESMA20死亡交叉", help='sell rule in backtest_struct')
+    parser.add_argument('--code', dest='code', type=str,
+                        metavar='*', default=".*", help='Only test that code')
+    parser.add_argument('--start_date', dest='start_date', type=str,
+                        metavar='*', default=config.SHIOAJI_START_DATE,
+                        help=f'Add the start date. default {config.SHIOAJI_START_DATE}')
+    parser.add_argument('--concentrated_band', dest='concentrated_band', type=parse_grid,
+                        metavar='a,b,...|start:stop:num', default='0.005:0.05:10', help='均線聚集門檻的網格')
+    parser.add_argument('--death_cross_deviation', dest='death_cross_deviation', type=parse_grid,
+                        metavar='a,b,...|start:stop:num', default='0:0.05:11', help='ESMA20死亡交叉誤差的網格')
+    parser.add_argument('--stop_loss', dest='stop_loss', type=parse_grid,
+                        metavar='a,b,...|start:stop:num', default='0.8:0.98:19', help='停損倍數的網格')
+    parser.add_argument('--folds', dest='folds', type=int,
+                        metavar='<UNSIGNED INT>', default=4, help='walk-forward 的折數')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = arg_parse()  # 命令參數解析
+    start_time = datetime.now()
+    logger = user_logger.get_logger(args.log)  # 取得logger
+
+    if args.buy_rule not in buy_rule_dict:
+        logger.critical(f"{args.buy_rule}不是正確購買規則")
+        exit()
+    if args.sell_rule not in sell_rule_dict:
+        logger.critical(f"{args.sell_rule}不是正確賣規則")
+        exit()
+
+    # decode_group 與 read_stock_data 使用 backtest_all 的全域設定
+    backtest_all.args = args
+    backtest_all.logger = logger
+    backtest_all.decode_group()
+
+    data_dir = config.DATA_DIR
+    if not os.path.exists(data_dir):
+        logger.critical(f"找不到{data_dir}")
+        exit()
+
+    df_dict = {}
+    stocks = backtest_all.read_stock_data(data_dir, df_dict)
+
+    start_date = datetime.strptime(args.start_date, '%Y-%m-%d')
+    calendar = trading_calendar.load_calendar(data_dir, df_dict, manifest.date_range(stocks))
+    calendar = calendar[calendar >= start_date]
+    if len(calendar) <= args.folds:
+        logger.critical(f"交易日只有 {len(calendar)} 天, 不夠分成 {args.folds + 1} 段")
+        exit()
+    panel = Panel.from_df_dict(df_dict, fields=('Close',), dates=calendar)
+
+    # 門檻網格, 同一個購買門檻 (或賣出誤差) 的組合共用同一份訊號
+    bands = args.concentrated_band
+    deviations = args.death_cross_deviation
+    stop_losses = args.stop_loss
+    grid = np.array(list(itertools.product(range(len(bands)), range(len(deviations)), range(len(stop_losses)))))
+    logger.info(f"{len(bands)} x {len(deviations)} x {len(stop_losses)} = {len(grid)} 組門檻, "
+                f"{len(panel.dates)} 天 x {len(panel.codes)} 檔")
+
+    t0 = time.perf_counter()
+    buy_signals = {}
+    sell_signals = {}
+    price_units = {}
+    for code, df in df_dict.items():
+        buy_signals[code], price_units[code] = threshold_grid.buy_signal_grid(
+            args.buy_rule, df, bands, args.investment_per_trade)
+        sell_signals[code] = threshold_grid.sell_signal_grid(args.sell_rule, df, deviations)
+    panel.add_aligned('price_unit', price_units, 0)
+    buy = threshold_grid.align_grid(panel, buy_signals)
+    sell = threshold_grid.align_grid(panel, sell_signals)
+    signal_seconds = time.perf_counter() - t0
+
+    # 一次回測所有組合, 記錄每一段最後一天的狀態
+    t0 = time.perf_counter()
+    ends = threshold_grid.walk_forward_blocks(len(panel.dates), args.folds)
+    states = threshold_grid.simulate(panel, buy, sell, grid[:, 0], grid[:, 1], stop_losses[grid[:, 2]],
+                                     args.investment_per_trade, ends)
+    simulate_seconds = time.perf_counter() - t0
+    logger.info(f"訊號花費 {signal_seconds:.2f} 秒, 回測花費 {simulate_seconds:.2f} 秒")
+
+    dates = panel.dates
+    final = states[-1]
+    total_returns, annualized = threshold_grid.annualized_returns(
+        final.equity, final.max_cash_needed, (dates[-1].to_pydatetime() - start_date).days)
+    table = pd.DataFrame({
+        'concentrated_band': bands[grid[:, 0]],
+        'death_cross_deviation': deviations[grid[:, 1]],
+        'stop_loss': stop_losses[grid[:, 2]],
+        'total_returns': total_returns,
+        'annualized_returns': annualized,
+        'total_profit': final.equity,
+        'max_cash_needed': final.max_cash_needed,
+        'count_buy': final.count_buy,
+        'count_sell': final.count_sell,
+    })
+
+    # walk-forward: 訓練期從頭到第 f 段結束, 測試期是下一段
+    tests = []
+    picks = []
+    for f in range(1, len(states)):
+        train, test = states[f - 1], states[f]
+        _, train_score = threshold_grid.annualized_returns(
+            train.equity, train.max_cash_needed, (dates[train.t].to_pydatetime() - start_date).days)
+        # 測試期的獲利除以測試期自己所需的最大現金
+        _, test_score = threshold_grid.annualized_returns(
+            test.equity - train.equity, test.block_cash_needed, (dates[test.t] - dates[train.t]).days)
+        table[f'train_{f}'] = train_score
+        table[f'test_{f}'] = test_score
+        tests.append(f'test_{f}')
+
+        best = int(np.argmax(train_score))
+        picks.append(best)
+        logger.info(f"第 {f} 折 訓練到 {dates[train.t]:%Y-%m-%d} 測試到 {dates[test.t]:%Y-%m-%d}: " +
+                    " ".join(f"{name}={table.loc[best, name]:.4g}" for name in GRID_THRESHOLDS) +
+                    f" 訓練 {train_score[best]:.2f} % 測試 {test_score[best]:.2f} %")
+    table['mean_test'] = table[tests].mean(axis=1)
+
+    # 樣本外成績: 各折選出的門檻在測試期的獲利加總, 除以各測試期所需現金的最大值
+    oos_profit = np.array([states[f].equity[best] - states[f - 1].equity[best] for f, best in enumerate(picks, 1)])
+    oos_cash = np.array([states[f].block_cash_needed[best] for f, best in enumerate(picks, 1)])
+    oos_total, oos_annualized = threshold_grid.annualized_returns(
+        oos_profit.sum(keepdims=True), oos_cash.max(keepdims=True), (dates[states[-1].t] - dates[states[0].t]).days)
+    logger.info(f"walk-forward 樣本外: {len(picks)} 折, 獲利 {oos_profit.sum()} 所需最大現金 {oos_cash.max()} "
+                f"總報酬 {oos_total[0]:.2f} % 年化 {oos_annualized[0]:.2f} %")
+
+    # 預設門檻在網格中時一併列出, 用來對照
+    default = np.ones(len(table), dtype=bool)
+    for name in GRID_THRESHOLDS:
+        default &= np.isclose(table[name], DEFAULT_THRESHOLDS[name])
+    if default.any():
+        row = table[default].iloc[0]
+        logger.info(f"預設門檻: 年化 {row['annualized_returns']:.2f} % 測試期平均 {row['mean_test']:.2f} %")
+    else:
+        logger.info("預設門檻不在網格中")
+
+    # 以全部資料挑選建議的門檻, 預期表現是上面的樣本外成績而不是全部資料的年化報酬
+    table.sort_values('annualized_returns', ascending=False, inplace=True, kind='stable')
+    best = table.iloc[0]
+    logger.info("建議門檻 (以全部資料挑選): " + " ".join(f"--{name} {best[name]:.4g}" for name in GRID_THRESHOLDS) +
+                f" 全部資料年化 {best['annualized_returns']:.2f} %, 預期參考樣本外年化 {oos_annualized[0]:.2f} %")
+    table.to_csv(args.output, index=False, float_format='%.6g')
+    logger.info(f"結果寫入 {args.output}")
+
+    total_time = (datetime.now() - start_time).total_seconds()
+    logger.info(f"程式共花費: {total_time} 秒")
@@ -0,0 +1,429 @@
+#!/usr/bin/python3
+"""
+以本地的分K來源模擬盤中交易 (paper trading)。
+
+從 --start_date 開始依時間重播資料夾中的 _min.csv (或從 --connect 的 socket 接收同樣格式的分K),
+每檔股票以 utils.streaming.LiveDay 逐根更新當天的日K與指標, 每根分K收盤時以 buy_rule_dict /
+sell_rule_dict 判斷買賣並記錄模擬成交。每根分K與每一分鐘整個股票池的判斷時間都會記錄下來,
+最後列出百分位數, 用來確認訊號計算跟得上即時行情。
+
+--serve 則是把同樣的重播資料透過 socket 送出, 當作另一個進程的本地行情來源。
+"""
+
+import argparse
+import heapq
+import itertools
+import json
+import os
+import re
+import socket
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__ + "/..")))  # noqa
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))  # noqa
+import backtest_all  # noqa
+import process_kbars  # noqa
+from user_logger import user_logger  # noqa
+from utils import config  # noqa
+from utils import data_quality  # noqa
+from utils import day_cache  # noqa
+from utils import streaming  # noqa
+from utils.backtest_struct import StockPosition, buy_rule_dict, sell_rule_dict, MIN_TURNOVER, MIN_VOLUME, STOP_LOSS  # noqa
+
+# LiveDay 需要的歷史日K欄位
+HISTORY_COLUMNS = ('High', 'Low', 'Close', '區間高點', '區間低點', '過前高', '破底')
+
+# 模擬成交紀錄的欄位
+FILL_COLUMNS = ['ts', 'code', 'side', 'num', 'price', 'fee', 'cash', 'profit']
+
+# 每根分K的間隔, 整個股票池的判斷時間要在這之內才跟得上行情
+BAR_INTERVAL = 60.0
+
+args = None
+logger = None
+
+
+def arg_parse():
+    """
+    解析參數設定並回傳解析結果。
+
+    Returns:
+        argparse.Namespace: 解析後的參數設定。
+    """
+    parser = argparse.ArgumentParser(description='paper trading with a local minute-bar feed')
+    parser.add_argument('-l', '--log', dest='log', type=str,
+                        metavar='*.log', default=f"{config.DEFAULT_LOG_DIR}/paper_trade.log", help='log file name')
+    parser.add_argument('--data_dir', dest='data_dir', type=str,
+                        metavar='*', default=config.DATA_DIR, help='本地資料緩存目錄')
+    parser.add_argument('--start_date', dest='start_date', type=str, metavar='YYYY-MM-DD', required=True,
+                        help='從這一天開始重播分K, 之前的日K當作歷史資料')
+    parser.add_argument('--end_date', dest='end_date', type=str, metavar='YYYY-MM-DD',
+                        default=None, help='重播到這一天 (含)')
+    parser.add_argument('--group', dest='group', type=str,
+                        metavar='<UNSIGNED INT>|ALL', default="ALL", help='股票類別')
+    parser.add_argument('--code', dest='code', type=str,
+                        metavar='*', default=".*", help='Only test that code')
+    parser.add_argument('--buy_rule', dest='buy_rule', type=str,
+                        metavar='*', default="過高買", help='buy rule in backtest_struct')
+    parser.add_argument('--sell_rule', dest='sell_rule', type=str,
+                        metavar='*', default="破底賣", help='sell rule in backtest_struct')
+    parser.add_argument('--amount', dest='amount', type=int,
+                        metavar='<UNSIGNED INT>', default=2000000, help='initial amount, 0 代表不限金額')
+    parser.add_argument('--investment_per_trade', dest='investment_per_trade', type=int,
+                        metavar='<UNSIGNED INT>', default=500000, help='investment per trade')
+    parser.add_argument('--chunksize', dest='chunksize', type=int, metavar='<UNSIGNED INT>',
+                        default=data_quality.DEFAULT_CHUNKSIZE, help='每次讀取的分K列數')
+    parser.add_argument('--connect', dest='connect', type=str, metavar='HOST:PORT',
+                        default=None, help='從 socket 接收分K, 不讀 _min.csv')
+    parser.add_argument('--serve', dest='serve', type=str, metavar='HOST:PORT',
+                        default=None, help='只把重播的分K從 socket 送出, 不做交易')
+    parser.add_argument('--speed', dest='speed', type=float, metavar='<FLOAT>',
+                        default=0, help='--serve 時每秒送出幾分鐘的分K, 0 代表不等待')
+    parser.add_argument('-o', '--output', dest='output', type=str,
+                        metavar='*.csv', default=None, help='模擬成交紀錄檔名')
+    parser.add_argument('--latency_output', dest='latency_output', type=str,
+                        metavar='*.json', default=None, help='判斷時間統計的輸出檔名')
+    return parser.parse_args()
+
+
+def parse_address(address):
+    """
+    將 HOST:PORT 轉成 (host, port)。
+    """
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def min_file_path(data_dir, day_file):
+    """
+    回傳 _day.csv 對應的 _min.csv 路徑。
+    """
+    return os.path.join(data_dir, re.sub(r'_day\.csv$', '_min.csv', day_file))
+
+
+def read_replay_bars(path, code, start_date, end_date=None, chunksize=data_quality.DEFAULT_CHUNKSIZE):
+    """
+    讀取單一 _min.csv 中要重播的分K。
+
+    Returns:
+        list: 依時間排序的 (ts, code, Open, High, Low, Close, Volume)。
+    """
+    bars = []
+    for chunk in data_quality.read_min_chunks(path, chunksize):
+        chunk = process_kbars.drop_invalid(chunk)
+        keep = chunk.index >= start_date
+        if end_date is not None:
+            keep &= chunk.index < end_date + pd.Timedelta(days=1)
+        chunk = chunk[keep]
+        bars.extend(zip(chunk.index, itertools.repeat(code), chunk['Open'].tolist(), chunk['High'].tolist(),
+                        chunk['Low'].tolist(), chunk['Close'].tolist(), chunk['Volume'].tolist()))
+    return bars
+
+
+def replay_min_files(data_dir, stocks, start_date, end_date=None, chunksize=data_quality.DEFAULT_CHUNKSIZE):
+    """
+    將多檔股票的分K依時間合併成一條行情。
+
+    Args:
+        data_dir (str): 資料夾。
+        stocks (pd.DataFrame): 股票清單, 至少包含 code 與 path (_day.csv 檔名)。
+        start_date (pd.Timestamp): 第一天。
+        end_date (pd.Timestamp): 最後一天, 為 None 時到檔案結尾。
+        chunksize (int): 每次讀取的分K列數。
+
+    Returns:
+        iterator: 依 (時間, 代號) 排序的 (ts, code, Open, High, Low, Close, Volume)。
+    """
+    streams = []
+    for code, day_file in zip(stocks['code'], stocks['path']):
+        path = min_file_path(data_dir, day_file)
+        if not os.path.isfile(path):
+            logger.warning(f"找不到 {path}")
+            continue
+        streams.append(read_replay_bars(path, code, start_date, end_date, chunksize))
+    return heapq.merge(*streams)
+
+
+def format_bar(bar):
+    """
+    將一根分K轉成 socket 上傳送的一行文字。
+    """
+    ts, code, open_, high, low, close, volume = bar
+    return f"{ts.isoformat()},{code},{open_!r},{high!r},{low!r},{close!r},{volume}\n"
+
+
+def parse_bar(line):
+    """
+    format_bar 的反向轉換。
+    """
+    ts, code, open_, high, low, close, volume = line.rstrip('\n').split(',')
+    return pd.Timestamp(ts), code, float(open_), float(high), float(low), float(close), int(volume)
+
+
+def serve_bars(bars, address, speed=0):
+    """
+    等一個連線, 依時間把分K送出去, 送完就關閉連線。
+
+    Args:
+        bars (iterable): replay_min_files 的分K。
+        address (tuple): (host, port)。
+        speed (float): 每秒送出幾分鐘的分K, 0 代表不等待。
+    """
+    with socket.create_server(address) as server:
+        logger.info(f"等待連線 {address[0]}:{address[1]}")
+        conn, peer = server.accept()
+        logger.info(f"開始傳送分K給 {peer[0]}:{peer[1]}")
+        with conn:
+            sent = 0
+            for _, minute in itertools.groupby(bars, key=lambda bar: bar[0]):
+                lines = [format_bar(bar) for bar in minute]
+                conn.sendall(''.join(lines).encode('utf-8'))
+                sent += len(lines)
+                if speed > 0:
+                    time.sleep(1 / speed)
+        logger.info(f"共傳送 {sent} 根分K")
+
+
+def socket_bars(address):
+    """
+    連到 serve_bars 並逐根回傳分K, 連線關閉時結束。
+    """
+    with socket.create_connection(address) as conn:
+        with conn.makefile('r', encoding='utf-8') as f:
+            for line in f:
+                yield parse_bar(line)
+
+
+def call_rule(rule, df, date):
+    """
+    與 scalar_signal 相同, 查不到參照的日期時視為 False。
+    """
+    try:
+        return bool(rule(df, date))
+    except KeyError:
+        return False
+
+
+class RuleFrame:
+    """
+    給 buy_rule_dict / sell_rule_dict 使用的輕量資料表, 只支援規則用到的 df.loc[date, col]。
+
+    每根分K都建一個 DataFrame 太慢, 規則只會查當天與前幾天的欄位, 用 dict 就夠了;
+    查不到的日期或欄位與 DataFrame 一樣丟出 KeyError。
+    """
+
+    def __init__(self, rows):
+        """
+        Args:
+            rows (dict): 日期對應 {欄位: 值}。
+        """
+        self.rows = rows
+        self.loc = self
+
+    def __getitem__(self, key):
+        date, col = key
+        return self.rows[date][col]
+
+
+def percentiles(seconds):
+    """
+    回傳判斷時間的統計 (毫秒)。
+    """
+    if len(seconds) == 0:
+        return {'count': 0}
+    ms = np.asarray(seconds) * 1000
+    p50, p90, p99 = np.percentile(ms, [50, 90, 99])
+    return {'count': len(ms), 'mean': float(ms.mean()), 'p50': float(p50), 'p90': float(p90),
+            'p99': float(p99), 'max': float(ms.max())}
+
+
+class PaperTrader:
+    """
+    逐根分K判斷買賣並記錄模擬成交。
+
+    一檔股票一天最多成交一次; 賣出條件與回測相同 (賣出規則成立或市值跌破成本的 95%),
+    手續費與每次購買張數的算法也與 backtest_all 相同。
+    """
+
+    def __init__(self, lives, buy_rule, sell_rule, ini_amount, investment_per_trade):
+        """
+        Args:
+            lives (dict): 股票代號對應的 streaming.LiveDay。
+            buy_rule (str): buy_rule_dict 中的規則名稱。
+            sell_rule (str): sell_rule_dict 中的規則名稱。
+            ini_amount (int): 初始金額, 0 代表不限金額每次都買。
+            investment_per_trade (int): 每次購買金額。
+        """
+        self.lives = lives
+        self.buy_rule = buy_rule_dict[buy_rule]
+        self.sell_rule = sell_rule_dict[sell_rule]
+        self.ini_amount = ini_amount
+        self.investment_per_trade = investment_per_trade
+        self.amount = ini_amount
+        self.hold = {}
+        self.traded = {}  # 股票代號對應最後成交的日期
+        self.fills = []
+        self.bar_seconds = []
+
+    def on_bar(self, ts, code, open_, high, low, close, volume):
+        """
+        處理一根分K, 不在股票池中的代號直接略過。
+        """
+        live = self.lives.get(code)
+        if live is None:
+            return
+        start = time.perf_counter()
+        _, row = live.on_bar(ts, open_, high, low, close, volume)
+        self.decide(ts, live, row)
+        self.bar_seconds.append(time.perf_counter() - start)
+
+    def rule_frame(self, live, row):
+        """
+        將當天目前的欄位與規則會查詢的前幾天組成 RuleFrame。
+        """
+        rows = {date: {'過前高': over_high, '破底': below_low}
+                for date, (over_high, below_low) in live.reference_rows().items()}
+        rows[live.day] = row
+        return RuleFrame(rows)
+
+    def decide(self, ts, live, row):
+        code = live.code
+        if self.traded.get(code) == live.day:
+            return
+        price_unit = int(row['Close'] * 1000)
+        df = None
+
+        # 賣
+        position = self.hold.get(code)
+        if position is not None:
+            position.update_price(price_unit, row['Close'])
+            df = self.rule_frame(live, row)
+            if call_rule(self.sell_rule, df, live.day) or position.value < position.cost * STOP_LOSS:
+                fee = int(position.value * 0.004425)
+                profit = position.value - position.cost - position.fee - fee
+                self.amount += position.value - fee
+                self.fills.append((ts, code, 'sell', position.num, row['Close'], fee, self.amount, profit))
+                del self.hold[code]
+                self.traded[code] = live.day
+                return
+
+        # 買, 流動性篩選與 liquidity_mask 相同
+        if self.ini_amount > 0 and self.amount < self.investment_per_trade:
+            return
+        if (price_unit > self.investment_per_trade or price_unit * row['Volume'] < MIN_TURNOVER or
+                row['Volume'] < MIN_VOLUME):
+            return
+        if df is None:
+            df = self.rule_frame(live, row)
+        if not call_rule(self.buy_rule, df, live.day):
+            return
+        num = int(self.investment_per_trade / price_unit)
+        fee = int(price_unit * num * 0.001425)
+        if position is None:
+            self.hold[code] = StockPosition(price_unit, num, fee)
+        else:
+            position.add_position(price_unit, num, fee)
+        self.amount -= price_unit * num + fee
+        self.fills.append((ts, code, 'buy', num, row['Close'], fee, self.amount, np.nan))
+        self.traded[code] = live.day
+
+
+def run(trader, bars):
+    """
+    依序處理行情, 回傳每一分鐘整個股票池的判斷時間 (秒)。
+    """
+    minute_seconds = []
+    for _, minute in itertools.groupby(bars, key=lambda bar: bar[0]):
+        start = time.perf_counter()
+        for bar in minute:
+            trader.on_bar(*bar)
+        minute_seconds.append(time.perf_counter() - start)
+    return minute_seconds
+
+
+def load_lives(data_dir, stocks, start_date):
+    """
+    讀取每檔股票 start_date 之前的日K, 建立 LiveDay。
+    """
+    lives = {}
+    for code, day_file in zip(stocks['code'], stocks['path']):
+        day_data = day_cache.read_day_data(os.path.join(data_dir, day_file), columns=HISTORY_COLUMNS)
+        lives[code] = streaming.LiveDay(code, day_data[day_data.index < start_date])
+    return lives
+
+
+if __name__ == '__main__':
+    args = arg_parse()  # 命令參數解析
+    start_time = datetime.now()
+    logger = user_logger.get_logger(args.log)  # 取得logger
+
+    if args.buy_rule not in buy_rule_dict:
+        logger.critical(f"{args.buy_rule}不是正確購買規則")
+        exit()
+    if args.sell_rule not in sell_rule_dict:
+        logger.critical(f"{args.sell_rule}不是正確賣規則")
+        exit()
+
+    data_dir = args.data_dir
+    if not os.path.exists(data_dir):
+        logger.critical(f"找不到{data_dir}")
+        exit()
+
+    # 股票池的篩選與 backtest_all 相同
+    backtest_all.args = args
+    backtest_all.logger = logger
+    backtest_all.decode_group()
+    stocks = backtest_all.select_stocks(data_dir)
+    start_date = pd.Timestamp(args.start_date)
+    end_date = pd.Timestamp(args.end_date) if args.end_date else None
+
+    if args.serve:
+        bars = replay_min_files(data_dir, stocks, start_date, end_date, args.chunksize)
+        serve_bars(bars, parse_address(args.serve), args.speed)
+        exit()
+
+    lives = load_lives(data_dir, stocks, start_date)
+    logger.info(f"股票池 {len(lives)} 檔")
+    if args.connect:
+        bars = socket_bars(parse_address(args.connect))
+    else:
+        bars = replay_min_files(data_dir, stocks, start_date, end_date, args.chunksize)
+
+    trader = PaperTrader(lives, args.buy_rule, args.sell_rule, args.amount, args.investment_per_trade)
+    minute_seconds = run(trader, bars)
+
+    fills = pd.DataFrame(trader.fills, columns=FILL_COLUMNS)
+    for fill in fills.itertuples(index=False):
+        logger.info(f"{fill.ts} {fill.side} {fill.code} {fill.num}張 價:{fill.price:.2f} 手續費:{fill.fee} "
+                    f"現金:{fill.cash}")
+    if args.output:
+        fills.to_csv(args.output, index=False)
+
+    # 判斷時間
+    latency = {
+        'bar': percentiles(trader.bar_seconds),
+        'minute': percentiles(minute_seconds),
+        'stocks': len(lives),
+        'minutes': len(minute_seconds),
+    }
+    for name, label in (('bar', '每根分K'), ('minute', '每分鐘整個股票池')):
+        stats = latency[name]
+        if stats['count']:
+            logger.info(f"{label}判斷時間 (ms): p50 {stats['p50']:.3f} p90 {stats['p90']:.3f} "
+                        f"p99 {stats['p99']:.3f} max {stats['max']:.3f} ({stats['count']} 次)")
+    if minute_seconds:
+        worst = max(minute_seconds)
+        status = "跟得上" if worst < BAR_INTERVAL else "跟不上"
+        logger.info(f"最慢的一分鐘花了 {worst:.3f} 秒, {status}即時行情")
+    if args.latency_output:
+        with open(args.latency_output, 'w', encoding='utf-8') as f:
+            json.dump(latency, f, ensure_ascii=False, indent=2)
+
+    logger.info(f"模擬成交 {len(fills)} 筆, 持有 {len(trader.hold)} 檔, 現金 {trader.amount}")
+    total_time = (datetime.now() - start_time).total_seconds()
+    logger.info(f"程式共花費: {total_time} 秒")
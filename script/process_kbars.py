@@ -31,97 +31,513 @@ Shioaji 台灣股市資料下載與 K 線分析專案
 
 """
 
+
 import re
+import io
+import json
+import argparse
 import pandas as pd
 import os
 import datetime
 import sys
+import time
+import cProfile
 from concurrent.futures import ProcessPoolExecutor
 sys.path.append(os.path.dirname(os.path.abspath(__file__+"/..")))  # noqa
 from utils import indicators  # noqa
 from utils import config  # noqa
+from utils import day_cache  # noqa
+from utils import trading_calendar  # noqa
+from utils import manifest  # noqa
+from utils import data_quality  # noqa
+from utils import resample  # noqa
+from utils import profiler  # noqa
+from utils import indicator_cache  # noqa
+
+# 日K指標計算流程, 不保存任何單一檔案的狀態, 可以在同一個 worker 中重複使用
+DAY_PIPELINE = indicators.IndicatorPipeline()
+
+# 需要整段歷史的區間高低點轉折欄位, 增量更新時在整份日K上重算 (只有陣列運算)
+PIVOT_TARGETS = ('Previous Index', '高點連線', '過前高', '破底')
+PIVOT_PIPELINE = indicators.IndicatorPipeline(
+    targets=PIVOT_TARGETS, given=indicators.BASE_COLUMNS + ('區間高點', '區間低點'))
+
+# 只跟附近K棒有關的欄位, 增量更新時只在尾端視窗重算
+WINDOW_PIPELINE = indicators.IndicatorPipeline(
+    targets=[col for col in DAY_PIPELINE.columns if col not in PIVOT_PIPELINE.columns])
+
+# 增量更新時要重算的尾端長度: 最長的均線 120 根加上置中的 21 根區間高低點視窗
+TAIL_WINDOW = max(indicators.SMA_PERIODS + indicators.EMA_PERIODS) + indicators.RANGE_WINDOW
+
+# 區間高低點會因為新資料而改變的最後幾根
+RANGE_HALF_WINDOW = indicators.RANGE_WINDOW // 2
+
+# 日K以外的週期在檔名中的名稱, 沒有列出的直接用週期字串, 例如 _5min.csv
+TIMEFRAME_NAMES = {'1D': 'day', '1W': 'week'}
 
+# 日K是增量更新與交易日曆的基準, 一定會產生
+DAY_TIMEFRAME = '1D'
 
-def process_min_file(min_file, data_dir):
+# 檢查點格式版本, 格式或指標改變時要跟著改, 舊的檢查點會被視為無效
+CHECKPOINT_VERSION = 1
+
+args = None
+
+# 子進程中的指標快取, 由 init_indicator_cache 設定
+_indicator_cache = None
+
+
+def arg_parse():
     """
-    生成單一 _min.csv 檔案對應的日K資料。
+    解析參數設定並回傳解析結果。
+
+    Returns:
+        argparse.Namespace: 解析後的參數設定。
+    """
+    parser = argparse.ArgumentParser(description='將分K資料轉成日K資料')
+    parser.add_argument('--data_dir', dest='data_dir', type=str,
+                        metavar='*', default=config.DATA_DIR, help='本地資料緩存目錄')
+    parser.add_argument('-i', '--incremental', dest='incremental', action='store_true',
+                        default=False, help='只處理上次執行後新增的分K資料')
+    parser.add_argument('--validate', dest='validate', action='store_true',
+                        default=False, help='讀取分K資料時一併檢查資料品質')
+    parser.add_argument('--chunksize', dest='chunksize', type=int, metavar='<UNSIGNED INT>',
+                        default=data_quality.DEFAULT_CHUNKSIZE, help='每次讀取的分K列數, 決定每個進程的記憶體用量')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, metavar='<UNSIGNED INT>',
+                        default=None, help='同時處理的檔案數, 預設為 CPU 核心數')
+    parser.add_argument('--timeframes', dest='timeframes', type=parse_timeframes, metavar='1D,5min,...',
+                        default=(), help='日K以外一併產生的K棒週期, 例如 5min,15min,60min,1W')
+    parser.add_argument('--profile', dest='profile', action='store_true',
+                        default=False, help='統計各階段與各檔案的執行時間')
+    parser.add_argument('--profile_output', dest='profile_output', type=str,
+                        metavar='*.json', default=None, help='各階段執行時間的輸出檔名')
+    parser.add_argument('--profile_top', dest='profile_top', type=int, metavar='<UNSIGNED INT>',
+                        default=10, help='列出最慢的幾個檔案')
+    parser.add_argument('--cprofile', dest='cprofile', type=str, metavar='*.prof',
+                        default=None, help='一併以 cProfile 記錄, 每個進程寫成 <檔名>.<pid>')
+    parser.add_argument('--indicator_cache', dest='indicator_cache', type=str, metavar='*',
+                        default=None, help='指標快取的資料夾, 輸入與程式碼都沒變的指標不重算')
+    parser.add_argument('--indicator_cache_mb', dest='indicator_cache_mb', type=int, metavar='<UNSIGNED INT>',
+                        default=indicator_cache.DEFAULT_MEMORY_BYTES // 2**20, help='每個進程的指標快取大小 (MB)')
+    parser.add_argument('--indicator_cache_disk_mb', dest='indicator_cache_disk_mb', type=int,
+                        metavar='<UNSIGNED INT>', default=None, help='結束時將指標快取資料夾刪到這個大小 (MB) 以內')
+    return parser.parse_args()
+
+
+def parse_timeframes(timeframes_str):
+    """
+    將以逗號分隔的週期字串轉成日K以外的週期 list。
+    """
+    timeframes = []
+    for timeframe in timeframes_str.split(','):
+        timeframe = timeframe.strip()
+        if not timeframe or timeframe == DAY_TIMEFRAME or timeframe in timeframes:
+            continue
+        try:
+            pd.tseries.frequencies.to_offset(timeframe)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"{timeframe} 不是正確的週期")
+        timeframes.append(timeframe)
+    return tuple(timeframes)
+
+
+def init_indicator_cache(path, memory_bytes=indicator_cache.DEFAULT_MEMORY_BYTES):
+    """
+    子進程的初始化, 建立這個進程的指標快取, path 為 None 時不使用快取。
+    """
+    global _indicator_cache
+    _indicator_cache = indicator_cache.IndicatorCache(path, memory_bytes) if path else None
+
+
+def stock_code(min_file):
+    """
+    回傳檔名中的股票代號, 當作指標快取的鍵的一部分。
+    """
+    return re.sub(r'_min\.csv$', '', min_file)
+
+
+def bar_path(data_dir, min_file, timeframe):
+    """
+    回傳 _min.csv 對應的 timeframe 週期K棒檔案路徑, 日K為 _day.csv。
+    """
+    name = TIMEFRAME_NAMES.get(timeframe, timeframe)
+    return os.path.join(data_dir, re.sub(r'_min\.csv$', f'_{name}.csv', min_file))
+
+
+def read_min_data(source, scanner=None):
+    """
+    讀取分K資料並捨棄不合理的資料。
 
     Args:
-        min_file (str): 輸入的 _min.csv 檔案名稱。
-        data_dir (str): 包含分K資料檔案的資料夾。
+        source (str or file-like): _min.csv 檔案路徑或檔案內容。
+        scanner (data_quality.MinDataScanner): 有給時在捨棄資料前先檢查資料品質。
 
     Returns:
-        None
+        pd.DataFrame: 以 ts 為索引的分K資料。
     """
-    day_file = re.sub(r'_min\.csv$', r'_day.csv', min_file)
-    print(f"將{min_file}轉成{day_file}")
+    with profiler.stage('read_csv'):
+        min_data = pd.read_csv(source)
+        min_data.ts = pd.to_datetime(min_data.ts)
+        min_data.set_index('ts', inplace=True)
+    if scanner is not None:
+        with profiler.stage('validate'):
+            scanner.scan(min_data)
+    with profiler.stage('filter'):
+        return drop_invalid(min_data)
+
+
+def drop_invalid(min_data):
+    """
+    捨棄有 0 的不合理分K資料。
+    """
+    return min_data[(min_data != 0).all(axis=1)]
 
-    # 讀取分K資料
-    min_data = pd.read_csv(os.path.join(data_dir, min_file))
-    min_data.ts = pd.to_datetime(min_data.ts)
-    min_data.set_index('ts', inplace=True)
 
-    # 捨棄不合理資料
-    min_data = min_data[(min_data != 0).all(axis=1)]
+def resample_day(min_data):
+    """
+    將分K資料合成日K的 OHLCV。
 
-    # 生成日K資料
-    day_data = min_data.resample('1D').agg({
-        'Open': 'first',
-        'High': 'max',
-        'Low': 'min',
-        'Close': 'last',
-        'Volume': 'sum'
-    })
+    Args:
+        min_data (pd.DataFrame): 以 ts 為索引的分K資料。
+
+    Returns:
+        pd.DataFrame: 日K資料。
+    """
+    return resample.resample_ohlcv(min_data, '1D')
+
+
+def stream_bars(min_path, chunksize, timeframes=(DAY_TIMEFRAME,), scanner=None):
+    """
+    以區塊方式讀取整個 _min.csv, 一次合成所有週期的K棒, 同時只有一個區塊的分K資料在記憶體中。
+
+    Args:
+        min_path (str): _min.csv 檔案路徑。
+        chunksize (int): 每次讀取的分K列數。
+        timeframes (iterable): 要合成的週期。
+        scanner (data_quality.MinDataScanner): 有給時在捨棄資料前先檢查資料品質。
+
+    Returns:
+        tuple: (週期對應的 OHLCV K棒, 最後一筆有效分K的時間)。
+    """
+    resamplers = {timeframe: resample.StreamingResampler(timeframe) for timeframe in timeframes}
+    last_ts = pd.Timestamp.min
+    chunks = data_quality.read_min_chunks(min_path, chunksize)
+    while True:
+        with profiler.stage('read_csv'):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        if scanner is not None:
+            with profiler.stage('validate'):
+                scanner.scan(chunk)
+        with profiler.stage('filter'):
+            chunk = drop_invalid(chunk)
+        if len(chunk):
+            last_ts = max(last_ts, chunk.index.max())
+        with profiler.stage('resample'):
+            for resampler in resamplers.values():
+                resampler.push(chunk)
+    return {timeframe: resampler.result() for timeframe, resampler in resamplers.items()}, last_ts
+
+
+def checkpoint_path(data_dir, min_file):
+    """
+    回傳 _min.csv 對應的增量更新檢查點檔案路徑。
+    """
+    return os.path.join(data_dir, re.sub(r'_min\.csv$', r'_day.ckpt.json', min_file))
+
+
+def load_checkpoint(path):
+    """
+    讀取檢查點, 不存在或版本不符時回傳 None。
+    """
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if checkpoint.get('version') != CHECKPOINT_VERSION:
+        return None
+    return checkpoint
+
+
+def save_checkpoint(path, day_data, offset, last_ts, ma_row, ma_states):
+    """
+    寫入檢查點。
+
+    Args:
+        path (str): 檢查點檔案路徑。
+        day_data (pd.DataFrame): 剛寫出的日K資料。
+        offset (int): 已處理到的 _min.csv 位元組位置。
+        last_ts (pd.Timestamp): 已處理的最後一筆分K時間。
+        ma_row (int): ma_states 對應的日K列位置, -1 表示沒有狀態。
+        ma_states (dict): 均線欄位對應 indicators.ma_states_at() 的狀態。
+    """
+    checkpoint = {
+        'version': CHECKPOINT_VERSION,
+        'offset': offset,
+        'last_ts': last_ts.isoformat(),
+        'rows': len(day_data),
+        'ma_row': ma_row,
+        'ma_states': ma_states,
+    }
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def warmup_ma_states(close, start=0, seed=None):
+    """
+    算出下一次增量更新需要的均線累加狀態。
+
+    下一次更新會從倒數第 TAIL_WINDOW + 1 根開始重算, 所以保存的是再前一根的狀態。
+
+    Args:
+        close (np.ndarray): 整份日K的收盤價。
+        start (int): seed 之後的第一根位置, seed 為 None 時必須是 0。
+        seed (dict): 第 start 根之前的均線狀態。
 
-    day_data = day_data.dropna(subset=['Open', 'High', 'Low', 'Close', 'Volume'])
+    Returns:
+        tuple: (狀態對應的列位置, 均線欄位對應的狀態), 資料不夠長時為 (-1, {})。
+    """
+    ma_row = len(close) - 2 - TAIL_WINDOW
+    if ma_row < 0:
+        return -1, {}
+    return ma_row, indicators.ma_states_at(close, ma_row, start, seed)
 
-    # 添加前一个索引值的新列
-    pre_idx = day_data.index[0].strftime('%Y-%m-%d')
-    day_data['Previous Index'] = pd.NA
-    for i in day_data.index[1:]:
-        day_data.loc[i, 'Previous Index'] = pre_idx
-        pre_idx = i.strftime('%Y-%m-%d')
 
-    # 計算均線
-    indicators.set_ma(day_data)
+def write_day_data(day_data, data_dir, min_file, offset, last_ts, ma_row, ma_states):
+    """
+    將日K資料存到 _day.csv 與欄位式快取, 並更新檢查點。
+    """
+    day_path = os.path.join(data_dir, re.sub(r'_min\.csv$', r'_day.csv', min_file))
+    with profiler.stage('write_csv'):
+        day_data.to_csv(day_path, index=True)
+    with profiler.stage('write_cache'):
+        day_cache.write_day_cache(day_data, day_path)
+    save_checkpoint(checkpoint_path(data_dir, min_file), day_data, offset, last_ts, ma_row, ma_states)
 
-    # 聚集
-    indicators.set_concentrated(day_data)
 
-    # 聚集 突破
-    indicators.set_breakthrough(day_data)
+def write_bar_data(bars, data_dir, min_file, timeframe):
+    """
+    將日K以外週期的K棒存到 _<週期>.csv 與欄位式快取。
+    """
+    path = bar_path(data_dir, min_file, timeframe)
+    with profiler.stage('write_csv'):
+        bars.to_csv(path, index=True)
+    with profiler.stage('write_cache'):
+        day_cache.write_day_cache(bars, path)
 
-    # 張嘴排列
-    indicators.set_expansion(day_data)
 
-    # 閉合排列
-    indicators.set_clogging(day_data)
+def process_min_file(min_file, data_dir, validate=False, chunksize=data_quality.DEFAULT_CHUNKSIZE, timeframes=()):
+    """
+    生成單一 _min.csv 檔案對應的日K資料。
+
+    Args:
+        min_file (str): 輸入的 _min.csv 檔案名稱。
+        data_dir (str): 包含分K資料檔案的資料夾。
+        validate (bool): 讀取時一併檢查資料品質。
+        chunksize (int): 每次讀取的分K列數。
+        timeframes (iterable): 日K以外一併產生的週期, 與日K共用同一次讀取。
 
-    # 區間高點
-    indicators.set_range_high(day_data)
+    Returns:
+        tuple: (日K的日期, 資料品質檢查結果), 沒有檢查時結果為 None。
+    """
+    day_file = re.sub(r'_min\.csv$', r'_day.csv', min_file)
+    print(f"將{min_file}轉成{day_file}")
 
-    # 高點連線
-    indicators.set_high_point_connection(day_data)
+    # 讀取分K資料, 先記下檔案大小, 讀取中才寫入的資料留給下一次增量更新
+    min_path = os.path.join(data_dir, min_file)
+    offset = os.path.getsize(min_path)
+    scanner = data_quality.MinDataScanner(min_file) if validate else None
 
-    # 區間低點
-    indicators.set_range_low(day_data)
+    # 生成日K與其他週期的K棒
+    bars, last_ts = stream_bars(min_path, chunksize, (DAY_TIMEFRAME, *timeframes), scanner)
+    day_data = bars.pop(DAY_TIMEFRAME)
 
-    # 過前高
-    indicators.set_over_high(day_data)
+    # 計算所有日K指標
+    code = stock_code(min_file)
+    DAY_PIPELINE.run(day_data, cache=_indicator_cache, code=code)
 
-    # 破前低
-    indicators.set_below_low(day_data)
+    # 其他週期使用相同的指標
+    for timeframe, timeframe_data in bars.items():
+        DAY_PIPELINE.run(timeframe_data, cache=_indicator_cache, code=code)
+        write_bar_data(timeframe_data, data_dir, min_file, timeframe)
 
     # 將生成的日K資料存儲到 _day.csv 檔案
-    day_data.to_csv(os.path.join(data_dir, day_file), index=True)
+    ma_row, ma_states = warmup_ma_states(day_data['Close'].to_numpy())
+    write_day_data(day_data, data_dir, min_file, offset, last_ts, ma_row, ma_states)
+    return day_data.index, scanner.result() if scanner is not None else None
+
+
+def read_appended_min_data(min_path, offset, scanner=None):
+    """
+    從 offset 開始讀取 _min.csv 新增的完整資料列。
+
+    Args:
+        min_path (str): _min.csv 檔案路徑。
+        offset (int): 上次處理到的位元組位置。
+        scanner (data_quality.MinDataScanner): 有給時一併檢查新增資料的品質。
+
+    Returns:
+        tuple: (新增的分K資料, 新的位元組位置), 沒有新資料時分K資料為 None。
+    """
+    with open(min_path, 'rb') as f:
+        header = f.readline()
+        f.seek(max(offset - 1, 0))
+        # 上次停在一列的中間時, 跳過那一列剩下的部分
+        if offset > 0 and f.read(1) != b'\n':
+            f.readline()
+        start = f.tell()
+        appended = f.read()
+
+    # 只處理已經寫完的資料列
+    end = appended.rfind(b'\n') + 1
+    if end == 0:
+        return None, offset
+    return read_min_data(io.BytesIO(header + appended[:end]), scanner), start + end
+
+
+def update_min_file(min_file, data_dir, validate=False, chunksize=data_quality.DEFAULT_CHUNKSIZE, timeframes=()):
+    """
+    只用上次執行後新增的分K資料更新對應的日K資料。
+
+    沒有可用的檢查點或檔案被改寫過時, 改為重新處理整個 _min.csv。
 
+    Args:
+        min_file (str): 輸入的 _min.csv 檔案名稱。
+        data_dir (str): 包含分K資料檔案的資料夾。
+        validate (bool): 讀取時一併檢查新增資料的品質。
+        chunksize (int): 需要重新處理整個檔案時, 每次讀取的分K列數。
+        timeframes (iterable): 日K以外一併更新的週期。
 
-def generate_day_data(data_dir):
+    Returns:
+        tuple: (日K的日期, 資料品質檢查結果), 沒有新資料時日期為 None, 沒有檢查時結果為 None。
+    """
+    day_file = re.sub(r'_min\.csv$', r'_day.csv', min_file)
+    min_path = os.path.join(data_dir, min_file)
+    day_path = os.path.join(data_dir, day_file)
+    checkpoint = load_checkpoint(checkpoint_path(data_dir, min_file))
+
+    if (checkpoint is None or checkpoint['rows'] == 0 or not os.path.isfile(day_path) or
+            os.path.getsize(min_path) < checkpoint['offset'] or
+            not all(os.path.isfile(bar_path(data_dir, min_file, timeframe)) for timeframe in timeframes)):
+        return process_min_file(min_file, data_dir, validate, chunksize, timeframes)
+
+    scanner = data_quality.MinDataScanner(min_file) if validate else None
+    new_min, offset = read_appended_min_data(min_path, checkpoint['offset'], scanner)
+    result = scanner.result() if scanner is not None else None
+    last_ts = pd.Timestamp(checkpoint['last_ts'])
+    if new_min is not None:
+        new_min = new_min[new_min.index > last_ts]
+    if new_min is None or len(new_min) == 0:
+        return None, result
+
+    print(f"更新{day_file}")
+    with profiler.stage('read_csv'):
+        old_day = pd.read_csv(day_path, index_col='ts', parse_dates=True)
+    if len(old_day) != checkpoint['rows']:
+        return process_min_file(min_file, data_dir, validate, chunksize, timeframes)
+
+    # 最後一天可能還沒收完, 與新增資料合併成完整的日K
+    with profiler.stage('resample'):
+        day_data = resample.concat_bars(old_day, resample_day(new_min))
+    close = day_data['Close'].to_numpy()
+
+    # 從第一根可能改變的日K往前保留 TAIL_WINDOW 根暖機資料, 只重算這一段
+    changed = max(len(old_day) - 1, 0)
+    start = max(changed - TAIL_WINDOW, 0)
+    seed = checkpoint['ma_states']
+    if start > 0 and checkpoint['ma_row'] != start - 1:
+        # 檢查點與日K對不上, 直接在全部日K上重算
+        start, seed = 0, {}
+
+    code = stock_code(min_file)
+    window = day_data.iloc[start:].copy()
+    WINDOW_PIPELINE.run(window, seed if start > 0 else None, cache=_indicator_cache, code=code)
+
+    # 尾端視窗前段的暖機資料不完整, 只採用可能改變的部分
+    keep = max(changed - RANGE_HALF_WINDOW, start)
+    for col in WINDOW_PIPELINE.columns:
+        day_data[col] = pd.concat([old_day[col].iloc[:keep], window[col].iloc[keep - start:]])
+
+    PIVOT_PIPELINE.run(day_data, cache=_indicator_cache, code=code)
+    day_data = day_data[list(indicators.BASE_COLUMNS) + DAY_PIPELINE.columns]
+
+    ma_row, ma_states = warmup_ma_states(close, start, seed if start > 0 else None)
+    # 其他週期只需要重新合成最後一根並重算指標, 不用再讀整個分K檔
+    for timeframe in timeframes:
+        with profiler.stage('read_csv'):
+            old_bars = pd.read_csv(bar_path(data_dir, min_file, timeframe), index_col='ts', parse_dates=True)
+        with profiler.stage('resample'):
+            timeframe_data = resample.concat_bars(old_bars, resample.resample_ohlcv(new_min, timeframe))
+        DAY_PIPELINE.run(timeframe_data, cache=_indicator_cache, code=code)
+        write_bar_data(timeframe_data, data_dir, min_file, timeframe)
+
+    write_day_data(day_data, data_dir, min_file, offset, max(last_ts, new_min.index.max()), ma_row, ma_states)
+    return day_data.index, result
+
+
+# 子進程中累積的 cProfile 紀錄
+_cprofile = None
+
+
+def profile_min_file(process, cprofile_path, min_file, *process_args):
+    """
+    在子進程中計時處理單一 _min.csv 檔案。
+
+    Args:
+        process (callable): process_min_file 或 update_min_file。
+        cprofile_path (str): 有給時一併以 cProfile 記錄, 寫到 <cprofile_path>.<pid>。
+        min_file (str): 輸入的 _min.csv 檔案名稱。
+        *process_args: 傳給 process 的其他參數。
+
+    Returns:
+        tuple: (process 的結果, 這個檔案的 StageTimer.to_dict())。
+    """
+    global _cprofile
+    if cprofile_path and _cprofile is None:
+        _cprofile = cProfile.Profile()
+
+    timer = profiler.enable()
+    start = time.perf_counter()
+    if _cprofile is not None:
+        _cprofile.enable()
+    try:
+        result = process(min_file, *process_args)
+    finally:
+        if _cprofile is not None:
+            _cprofile.disable()
+        profiler.disable()
+        timer.add_key(min_file, time.perf_counter() - start)
+
+    # 每個檔案處理完就覆寫一次, 不用等進程結束
+    if _cprofile is not None:
+        _cprofile.dump_stats(f"{cprofile_path}.{os.getpid()}")
+    return result, timer.to_dict()
+
+
+def generate_day_data(data_dir, incremental=False, validate=False, chunksize=data_quality.DEFAULT_CHUNKSIZE,
+                      jobs=None, timeframes=(), timer=None, cprofile=None, cache_dir=None,
+                      cache_memory_bytes=indicator_cache.DEFAULT_MEMORY_BYTES, cache_disk_bytes=None):
     """
     根據分K資料生成日K資料。
 
     Args:
         data_dir (str): 包含分K資料檔案的資料夾。
+        incremental (bool): 只處理上次執行後新增的分K資料。
+        validate (bool): 讀取分K資料時一併檢查資料品質, 最後列出有問題的檔案。
+        chunksize (int): 每次讀取的分K列數。
+        jobs (int): 同時處理的檔案數, 為 None 時使用 CPU 核心數。
+        timeframes (iterable): 日K以外一併產生的週期。
+        timer (profiler.StageTimer): 有給時合併每個子進程各階段與各檔案的執行時間。
+        cprofile (str): 有給時子進程一併以 cProfile 記錄, 每個進程寫成 <cprofile>.<pid>。
+        cache_dir (str): 指標快取的資料夾, 為 None 時不使用快取。
+        cache_memory_bytes (int): 每個子進程的指標快取大小。
+        cache_disk_bytes (int): 有給時結束後將指標快取資料夾刪到這個大小以內。
 
     Returns:
         None
@@ -133,15 +549,59 @@ def generate_day_data(data_dir):
 
     # 取得資料夾中的所有 _min.csv 檔案
     min_files = [f for f in os.listdir(data_dir) if f.endswith("_min.csv")]
+    process = update_min_file if incremental else process_min_file
 
     # 使用 ProcessPoolExecutor 建立進程池
-    with ProcessPoolExecutor() as executor:
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_indicator_cache,
+                             initargs=(cache_dir, cache_memory_bytes)) as executor:
         # 將任務提交到進程池中執行
-        executor.map(process_min_file, min_files, [data_dir]*len(min_files))
+        n = len(min_files)
+        process_args = [data_dir]*n, [validate]*n, [chunksize]*n, [tuple(timeframes)]*n
+        if timer is None and cprofile is None:
+            results = list(executor.map(process, min_files, *process_args))
+        else:
+            results = []
+            for result, stages in executor.map(profile_min_file, [process]*n, [cprofile]*n, min_files,
+                                               *process_args):
+                results.append(result)
+                if timer is not None:
+                    timer.merge(stages)
+
+        # 所有日K日期的聯集就是交易日曆, 增量更新時併入原本的日曆
+        calendar = trading_calendar.read_calendar(data_dir) if incremental else None
+        day_indexes = [index for index, _ in results if index is not None]
+        if calendar is not None:
+            day_indexes.append(calendar)
+        trading_calendar.write_calendar(data_dir, trading_calendar.union_calendar(day_indexes))
+
+        # 更新日K清單, 增量更新時沒有新資料的檔案沿用原本的資料
+        old_manifest = manifest.read_manifest(data_dir) if incremental else None
+        kept = {}
+        if old_manifest is not None:
+            kept = {row.path: row._asdict() for row in old_manifest.itertuples(index=False)}
+        day_files = [bar_path('', f, DAY_TIMEFRAME) for f in min_files]
+        changed = [day_file for day_file, (index, _) in zip(day_files, results)
+                   if index is not None or day_file not in kept]
+        entries = [kept[day_file] for day_file in day_files if day_file not in changed]
+        entries += executor.map(manifest.day_entry, [data_dir]*len(changed), changed)
+        manifest.write_manifest(data_dir, manifest.build_manifest(entries))
+
+    if cache_dir and cache_disk_bytes is not None:
+        removed = indicator_cache.IndicatorCache(cache_dir, 0).prune(cache_disk_bytes)
+        print(f"指標快取刪除 {removed} 個最久沒用到的項目")
+
+    if validate:
+        summary, issues = data_quality.build_report(result for _, result in results)
+        bad = data_quality.has_issues(summary)
+        print(f"資料品質: 共檢查 {len(summary)} 個檔案, {len(bad)} 個有問題")
+        if len(bad):
+            print(bad.drop(columns=['first_ts', 'last_ts']).to_string(index=False))
+            print(issues.to_string(index=False))
 
 
 if __name__ == '__main__':
-    data_dir = config.DATA_DIR
+    args = arg_parse()  # 命令參數解析
+    data_dir = args.data_dir
 
     if not os.path.exists(data_dir):
         print(f"找不到資料夾: {data_dir}")
@@ -152,7 +612,17 @@ if __name__ == '__main__':
     print(f"開始: {start_time.strftime('%Y-%m-%d %H:%M:%S')}")
 
     # 生成日K資料
-    generate_day_data(data_dir)
+    timer = profiler.StageTimer() if args.profile or args.profile_output else None
+    cache_disk_bytes = args.indicator_cache_disk_mb * 2**20 if args.indicator_cache_disk_mb is not None else None
+    generate_day_data(data_dir, args.incremental, args.validate, args.chunksize, args.jobs, args.timeframes,
+                      timer, args.cprofile, args.indicator_cache, args.indicator_cache_mb * 2**20, cache_disk_bytes)
+
+    # 各階段執行時間, 秒數是所有子進程的合計
+    if timer is not None:
+        for line in timer.report_lines(args.profile_top):
+            print(line)
+        if args.profile_output:
+            timer.write_json(args.profile_output, args.profile_top)
 
     # 結束執行時間
     end_time = datetime.datetime.now()
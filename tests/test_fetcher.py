@@ -0,0 +1,226 @@
+#!/usr/bin/python3
+"""
+utils.fetcher 連到 utils.mock_server 的測試。
+
+執行: python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__ + "/..")))  # noqa
+from utils import fetcher  # noqa
+from utils.mock_server import MockServer  # noqa
+
+START = '2024-01-01'
+END = '2024-02-29'
+
+
+class MockServerTestCase(unittest.IsolatedAsyncioTestCase):
+    """
+    每個測試啟動一個模擬伺服器, 分K寫在暫存資料夾中。
+    """
+
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.data_dir = self.tmp.name
+
+    async def asyncTearDown(self):
+        self.tmp.cleanup()
+
+    async def fetch(self, codes, end=END, server_kwargs=None, **kwargs):
+        """
+        以新的模擬伺服器下載 START 到 end 的分K, 回傳 (FetchResult 的 list, 伺服器)。
+
+        Args:
+            server_kwargs (dict): 傳給 MockServer 的設定。
+            **kwargs: 傳給 MinuteFetcher 的設定。
+        """
+        server = MockServer(start=START, end=END, **(server_kwargs or {}))
+        client = fetcher.HttpClient(*await server.start())
+        minute_fetcher = fetcher.MinuteFetcher(client, self.data_dir, rate=0, base_delay=0.001, max_delay=0.01,
+                                               window_days=10, seed=0, **kwargs)
+        try:
+            results = await minute_fetcher.fetch_all(codes, START, end)
+        finally:
+            await client.close()
+            await server.close()
+        return results, server
+
+    def read(self, code):
+        return pd.read_csv(fetcher.min_path(self.data_dir, code), parse_dates=['ts'])
+
+
+class TestMockServer(MockServerTestCase):
+
+    def test_day_bars_are_deterministic(self):
+        server = MockServer(start=START, end=END)
+        day = pd.Timestamp('2024-01-15')
+        pd.testing.assert_frame_equal(server.day_bars('2330', day), server.day_bars('2330', day))
+        whole = server.bars('2330', pd.Timestamp(START), pd.Timestamp(END))
+        part = server.bars('2330', day, day)
+        pd.testing.assert_frame_equal(whole[whole['ts'].dt.normalize() == day].reset_index(drop=True), part)
+
+    def test_bars_outside_range_are_empty(self):
+        server = MockServer(start=START, end=END)
+        self.assertEqual(len(server.bars('2330', pd.Timestamp('2024-03-01'), pd.Timestamp('2024-03-31'))), 0)
+
+
+class TestMinuteFetcher(MockServerTestCase):
+
+    async def test_fetch_all(self):
+        results, server = await self.fetch(['2330', '2317'])
+        expected = MockServer(start=START, end=END).bars('2330', pd.Timestamp(START), pd.Timestamp(END))
+        self.assertEqual([result.code for result in results], ['2330', '2317'])
+        for result in results:
+            self.assertIsNone(result.error)
+            self.assertEqual(result.rows, len(expected))
+        pd.testing.assert_frame_equal(self.read('2330')[fetcher.MIN_COLUMNS], expected[fetcher.MIN_COLUMNS],
+                                      check_dtype=False)
+
+    async def test_retry_with_backoff(self):
+        # 前 4 個請求輪流回傳 503 與 429, 重試之後仍然下載完整
+        with mock.patch.object(fetcher, 'backoff_delay', wraps=fetcher.backoff_delay) as delay:
+            results, server = await self.fetch(['2330'], server_kwargs={'fail_first': 4})
+        result = results[0]
+        self.assertIsNone(result.error)
+        self.assertEqual(server.failures, 4)
+        self.assertEqual(result.retries, 4)
+        self.assertEqual(server.requests, result.requests + result.retries)
+        # 同一個請求連續失敗, 退避時間以 attempt 0, 1, 2, 3 計算
+        self.assertEqual([call.args[0] for call in delay.call_args_list], [0, 1, 2, 3])
+        self.assertEqual(len(self.read('2330')), result.rows)
+
+    async def test_retries_exhausted(self):
+        results, server = await self.fetch(['2330'], server_kwargs={'fail_first': 10}, retries=2)
+        self.assertRegex(results[0].error, r'^HTTP (429|503)')
+        self.assertEqual(server.requests, 3)
+        self.assertFalse(os.path.exists(fetcher.min_path(self.data_dir, '2330')))
+
+    async def test_non_retryable_error(self):
+        results, server = await self.fetch(['2330', '9999'], server_kwargs={'statuses': {'9999': 404}})
+        by_code = {result.code: result for result in results}
+        self.assertIsNone(by_code['2330'].error)
+        self.assertIn('HTTP 404', by_code['9999'].error)
+        self.assertEqual(by_code['9999'].retries, 0)
+        self.assertEqual(by_code['9999'].requests, 0)
+
+    async def test_truncated_response_is_retried(self):
+        results, server = await self.fetch(['2330'], server_kwargs={'truncate_first': 3})
+        result = results[0]
+        self.assertIsNone(result.error)
+        self.assertEqual(result.retries, 3)
+        expected = MockServer(start=START, end=END).bars('2330', pd.Timestamp(START), pd.Timestamp(END))
+        self.assertEqual(len(self.read('2330')), len(expected))
+
+    async def test_malformed_body_is_not_retried(self):
+        # 200 但內容不是分K: 只有這檔失敗, 其他股票照常下載
+        results, server = await self.fetch(['2330', '9999'], server_kwargs={'statuses': {'9999': 200}})
+        by_code = {result.code: result for result in results}
+        self.assertIsNone(by_code['2330'].error)
+        self.assertIn('回應格式錯誤', by_code['9999'].error)
+        self.assertEqual(by_code['9999'].retries, 0)
+
+    async def test_shioaji_errors(self):
+        # 不連 Shioaji, 以假的 api 確認哪些錯誤會重試
+        def kbars(contract, start, end):
+            raise ConnectionError('timeout')
+        api = SimpleNamespace(Contracts=SimpleNamespace(Stocks={'2330': object()}), kbars=kbars)
+        client = fetcher.ShioajiClient(api)
+        day = pd.Timestamp(START)
+        with self.assertRaises(fetcher.FetchError) as cm:
+            await client.fetch('9999', day, day)
+        self.assertFalse(cm.exception.retryable)
+        with self.assertRaises(fetcher.FetchError) as cm:
+            await client.fetch('2330', day, day)
+        self.assertTrue(cm.exception.retryable)
+
+    async def test_resume_without_duplicates(self):
+        await self.fetch(['2330'], end='2024-01-20')
+        first = self.read('2330')
+        results, _ = await self.fetch(['2330'])
+        resumed = self.read('2330')
+        self.assertTrue(resumed['ts'].is_unique)
+        self.assertTrue(resumed['ts'].is_monotonic_increasing)
+        self.assertEqual(results[0].rows, len(resumed) - len(first))
+
+        # 與一次下載完的結果相同
+        os.remove(fetcher.min_path(self.data_dir, '2330'))
+        await self.fetch(['2330'])
+        pd.testing.assert_frame_equal(resumed, self.read('2330'))
+
+        # 沒有新資料時不接上任何一列
+        results, _ = await self.fetch(['2330'])
+        self.assertEqual(results[0].rows, 0)
+        pd.testing.assert_frame_equal(resumed, self.read('2330'))
+
+    async def test_resume_after_torn_tail(self):
+        await self.fetch(['2330'], end='2024-01-20')
+        path = fetcher.min_path(self.data_dir, '2330')
+        complete = self.read('2330')
+        # 模擬寫到一半中斷: 最後一列沒有換行
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write('2024-01-22 09:01:00,1')
+        self.assertEqual(fetcher.last_min_ts(path), complete['ts'].iloc[-1])
+
+        await self.fetch(['2330'])
+        resumed = self.read('2330')
+        os.remove(path)
+        await self.fetch(['2330'])
+        pd.testing.assert_frame_equal(resumed, self.read('2330'))
+
+
+class TestMinFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, '2330_min.csv')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, text):
+        with open(self.path, 'w', encoding='utf-8', newline='') as f:
+            f.write(text)
+
+    def read_text(self):
+        with open(self.path, 'r', encoding='utf-8', newline='') as f:
+            return f.read()
+
+    def test_drop_partial_line(self):
+        complete = 'ts,Open\n2024-01-02 09:01:00,1\n'
+        self.write(complete + '2024-01-02 09:02:00,')
+        fetcher._drop_partial_line(self.path)
+        self.assertEqual(self.read_text(), complete)
+
+    def test_drop_partial_line_keeps_complete_file(self):
+        complete = 'ts,Open\n2024-01-02 09:01:00,1\n'
+        self.write(complete)
+        fetcher._drop_partial_line(self.path)
+        self.assertEqual(self.read_text(), complete)
+
+    def test_last_min_ts_ignores_partial_line(self):
+        self.write('ts,Open\n2024-01-02 09:01:00,1\n2024-01-02 09:02')
+        self.assertEqual(fetcher.last_min_ts(self.path), pd.Timestamp('2024-01-02 09:01:00'))
+
+    def test_parse_response(self):
+        self.assertEqual(fetcher._parse_response(b'HTTP/1.0 200 OK\r\nContent-Length: 3\r\n\r\nabc'), (200, b'abc'))
+        for response in (b'', b'HTTP/1.0 200 OK\r\nContent-', b'HTTP/1.0\r\n\r\n',
+                         b'HTTP/1.0 200 OK\r\nContent-Length: 10\r\n\r\nabc'):
+            with self.assertRaises(fetcher.FetchError) as cm:
+                fetcher._parse_response(response)
+            self.assertTrue(cm.exception.retryable)
+
+    def test_client_fetch_is_abstract(self):
+        with self.assertRaises(TypeError):
+            fetcher.MinuteBarClient()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+#!/usr/bin/python3
+"""
+utils.profiler 的測試。
+
+執行: python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__ + "/..")))  # noqa
+from utils import profiler  # noqa
+
+
+class TestStageTimer(unittest.TestCase):
+
+    def run_nested(self, timer):
+        # 每次呼叫 perf_counter 前進 1 秒: outer 共 5 秒, 其中 inner 兩次各 1 秒
+        clock = iter(range(100))
+        with mock.patch.object(profiler.time, 'perf_counter', lambda: next(clock)):
+            with timer.stage('outer', 'A'):
+                with timer.stage('inner'):
+                    pass
+                with timer.stage('inner'):
+                    pass
+
+    def test_nested_stages(self):
+        timer = profiler.StageTimer()
+        self.run_nested(timer)
+        self.assertEqual(timer.stages['outer'], [5.0, 1, 3.0])
+        self.assertEqual(timer.stages['inner'], [2.0, 2, 2.0])
+        self.assertEqual(timer.keys, {'A': 5.0})
+
+        rows = {row['stage']: row for row in timer.report()['stages']}
+        self.assertEqual(rows['outer']['seconds'], 5.0)
+        self.assertAlmostEqual(rows['outer']['percent'], 60.0)
+        self.assertAlmostEqual(sum(row['percent'] for row in rows.values()), 100.0)
+
+    def test_merge(self):
+        timer = profiler.StageTimer()
+        self.run_nested(timer)
+        merged = profiler.StageTimer()
+        merged.merge(timer.to_dict())
+        merged.merge(timer.to_dict())
+        self.assertEqual(merged.stages['outer'], [10.0, 2, 6.0])
+        self.assertEqual(merged.keys, {'A': 10.0})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+"""
+逐日規則 (buy_rule_dict / sell_rule_dict)、向量化規則與 rules.json5 運算式規則的對照測試。
+
+執行: python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import unittest
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__ + "/..")))  # noqa
+from utils import day_schema  # noqa
+from utils import rule_expr  # noqa
+from utils.backtest_struct import buy_rule_dict, buy_rule_vec_dict, scalar_signal  # noqa
+
+BOOL_COLUMNS = ['均線聚集', '均線聚集後突破', '短均線聚集後突破', '過前高', '破底']
+
+
+def rule_frame(days=400, seed=0, missing=0.3):
+    """
+    產生精簡格式的日K, 布林欄位隨機, 參照欄位有 missing 比例沒有值。
+
+    Returns:
+        pd.DataFrame: 以 DatetimeIndex 為索引的日K資料。
+    """
+    rng = np.random.default_rng(seed)
+    index = pd.bdate_range('2020-01-02', periods=days, name='ts')
+    close = np.round(50 * np.exp(np.cumsum(rng.normal(0, 0.02, days))), 2)
+    df = pd.DataFrame({'Close': close, '高點連線': np.round(close * rng.uniform(0.9, 1.1, days), 2)}, index=index)
+    for col in BOOL_COLUMNS:
+        df[col] = rng.random(days) < 0.5
+    for col in day_schema.REF_COLUMNS:
+        offsets = rng.integers(1, 30, days)
+        offsets[rng.random(days) < missing] = day_schema.NO_REF
+        offsets[offsets > np.arange(days)] = day_schema.NO_REF
+        df[col] = offsets.astype(np.int32)
+    return df
+
+
+class TestBuyRules(unittest.TestCase):
+
+    def setUp(self):
+        self.df = rule_frame()
+        self.rules = rule_expr.load_rules(rule_expr.DEFAULT_RULES)
+
+    def assert_same(self, name, df):
+        expected = scalar_signal(buy_rule_dict[name], df)
+        np.testing.assert_array_equal(buy_rule_vec_dict[name](df), expected, err_msg=name)
+        if name in self.rules['buy']:
+            np.testing.assert_array_equal(self.rules['buy'][name](df), expected, err_msg=name)
+
+    def test_vectorized_rules_match_scalar(self):
+        for name in buy_rule_dict:
+            self.assert_same(name, self.df)
+
+    def test_missing_references(self):
+        # 前高、前低都沒有值的列: 逐日版本查不到參照, 只有 均線聚集後突破 可以買
+        df = self.df.copy()
+        df['前高 Index'] = day_schema.NO_REF
+        df['前低 Index'] = day_schema.NO_REF
+        for name in buy_rule_dict:
+            self.assert_same(name, df)
+        np.testing.assert_array_equal(buy_rule_vec_dict['聚集買'](df), df['均線聚集後突破'].to_numpy())
+
+    def test_missing_low_reference(self):
+        df = self.df.copy()
+        df['前低 Index'] = day_schema.NO_REF
+        for name in buy_rule_dict:
+            self.assert_same(name, df)
+
+
+if __name__ == '__main__':
+    unittest.main()
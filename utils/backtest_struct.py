@@ -1,7 +1,32 @@
 import pandas as pd
+import numpy as np
+
+from utils import indicators
+from utils import day_schema
+
+# 流動性篩選: 成交金額與成交量 (張) 的下限
+MIN_TURNOVER = 50000000
+MIN_VOLUME = 1000
+
+# 停損: 市值跌破成本的這個倍數就賣
+STOP_LOSS = 0.95
+
+# ESMA20死亡交叉保留的誤差: 收盤價低於 SMA20 或 EMA20 超過這個比例才賣
+DEATH_CROSS_DEVIATION = 0.01
+
+# 策略中可以調整的門檻與預設值
+DEFAULT_THRESHOLDS = {
+    'concentrated_band': indicators.CONCENTRATED_BAND,
+    'death_cross_deviation': DEATH_CROSS_DEVIATION,
+    'stop_loss': STOP_LOSS,
+    'expansion_factor': indicators.EXPANSION_FACTOR,
+    'clogging_factor': indicators.CLOGGING_FACTOR,
+}
 
 
 class StockPosition:
+    __slots__ = ('purchase_price_unit', 'price_unit', 'num', 'cost', 'value', 'purchase_price', 'price', 'fee')
+
     def __init__(self, purchase_price_unit, num, fee):
         self.purchase_price_unit = purchase_price_unit  # 每張平均購買價
         self.price_unit = purchase_price_unit  # 每張價錢
@@ -27,6 +52,8 @@ class StockPosition:
 
 
 class TradeHistory:
+    __slots__ = ('cost', 'profit', 'num')
+
     def __init__(self, stockPosition):
         self.cost = stockPosition.cost  # 總成本
         self.profit = stockPosition.value - stockPosition.cost - stockPosition.fee  # 獲利
@@ -38,13 +65,177 @@ class TradeHistory:
         self.num += 1
 
 
+class PositionView:
+    """
+    Portfolio 中單一持股的唯讀 view, 屬性與 StockPosition 相同。
+    """
+    __slots__ = ('_portfolio', '_j')
+
+    def __init__(self, portfolio, j):
+        self._portfolio = portfolio
+        self._j = j
+
+    @property
+    def num(self):
+        return int(self._portfolio.num[self._j])
+
+    @property
+    def cost(self):
+        return int(self._portfolio.cost[self._j])
+
+    @property
+    def fee(self):
+        return int(self._portfolio.fee[self._j])
+
+    @property
+    def price_unit(self):
+        return int(self._portfolio.price_unit[self._j])
+
+    @property
+    def price(self):
+        return float(self._portfolio.price[self._j])
+
+    @property
+    def value(self):
+        return self.price_unit * self.num
+
+    @property
+    def purchase_price_unit(self):
+        return float(self._portfolio.purchase_price_unit[self._j])
+
+    @property
+    def purchase_price(self):
+        return self.purchase_price_unit/1000
+
+
+class Portfolio:
+    """
+    以平行的 NumPy 陣列保存所有股票的持股, 陣列位置與 Panel 的股票欄位相同。
+
+    每天的市值更新是對當天收盤價那一列的一次陣列運算; portfolio[code] 回傳與 StockPosition
+    相同屬性的 PositionView, 舊的逐檔寫法可以照用。
+
+    Attributes:
+        num (np.ndarray): 張數。
+        cost (np.ndarray): 總成本。
+        fee (np.ndarray): 累計手續費。
+        price_unit (np.ndarray): 每張價錢。
+        price (np.ndarray): 最後收盤價。
+        purchase_price_unit (np.ndarray): 每張平均購買價。
+        opened (np.ndarray): 建立持股的順序, 沒有持股時為 -1。
+        market_value (int): 所有持股的市值。
+    """
+
+    def __init__(self, codes):
+        self.codes = list(codes)
+        self.code_pos = {code: j for j, code in enumerate(self.codes)}
+        size = len(self.codes)
+        self.num = np.zeros(size, dtype=np.int64)
+        self.cost = np.zeros(size, dtype=np.int64)
+        self.fee = np.zeros(size, dtype=np.int64)
+        self.price_unit = np.zeros(size, dtype=np.int64)
+        self.price = np.zeros(size, dtype=np.float64)
+        self.purchase_price_unit = np.zeros(size, dtype=np.float64)
+        self.opened = np.full(size, -1, dtype=np.int64)
+        self.market_value = 0
+        self._next_open = 0
+
+    @property
+    def held(self):
+        return self.opened >= 0
+
+    @property
+    def value(self):
+        return self.price_unit * self.num
+
+    @property
+    def profit(self):
+        return self.value - self.cost - self.fee
+
+    def mark_to_market(self, close_row, valid_row):
+        """
+        以當天收盤價更新所有有資料的持股。
+
+        Args:
+            close_row (np.ndarray): 當天各股票的收盤價。
+            valid_row (np.ndarray): 當天各股票是否有資料。
+        """
+        mask = self.held & valid_row
+        self.price_unit[mask] = (close_row[mask] * 1000).astype(np.int64)
+        self.price[mask] = close_row[mask]
+        self.market_value = int(self.value.sum())
+
+    def sell_candidates(self, sell_row, valid_row, stop_loss=STOP_LOSS):
+        """
+        找出當天要賣的持股: 有賣出訊號或市值跌破成本的 stop_loss 倍。
+
+        Returns:
+            np.ndarray: 要賣的股票位置, 依建立持股的順序排列。
+        """
+        held = self.held
+        ratio = np.divide(self.value, self.cost, out=np.ones(len(self.codes)), where=held)
+        pos = np.flatnonzero(held & valid_row & (sell_row | (ratio < stop_loss)))
+        return pos[np.argsort(self.opened[pos], kind='stable')]
+
+    def buy(self, j, price_unit, num, fee):
+        """
+        買入, 與 StockPosition / add_position 的計算相同。
+        """
+        old_value = int(self.price_unit[j] * self.num[j])
+        if self.opened[j] >= 0:
+            self.cost[j] += price_unit * num
+            self.num[j] += num
+            self.purchase_price_unit[j] = self.cost[j]/self.num[j]
+            self.fee[j] += fee
+        else:
+            self.price_unit[j] = price_unit
+            self.price[j] = price_unit/1000
+            self.purchase_price_unit[j] = price_unit
+            self.num[j] = num
+            self.cost[j] = price_unit * num
+            self.fee[j] = fee
+            self.opened[j] = self._next_open
+            self._next_open += 1
+        self.market_value += int(self.price_unit[j] * self.num[j]) - old_value
+
+    def add_fee(self, j, fee):
+        self.fee[j] += fee
+
+    def close(self, j):
+        """
+        清掉持股。
+        """
+        self.market_value -= int(self.price_unit[j] * self.num[j])
+        for values in (self.num, self.cost, self.fee, self.price_unit, self.price, self.purchase_price_unit):
+            values[j] = 0
+        self.opened[j] = -1
+
+    def keys(self):
+        """
+        目前持有的股票代號, 依建立持股的順序排列。
+        """
+        pos = np.flatnonzero(self.held)
+        return [self.codes[j] for j in pos[np.argsort(self.opened[pos], kind='stable')]]
+
+    def __contains__(self, code):
+        return self.opened[self.code_pos[code]] >= 0
+
+    def __getitem__(self, code):
+        j = self.code_pos[code]
+        if self.opened[j] < 0:
+            raise KeyError(code)
+        return PositionView(self, j)
+
+
 sell_rule_dict = {"破底賣":  # 破底就賣
                   lambda df, date: df.loc[date, '破底'],
                   "ESMA20死亡交叉":  # 死亡交叉賣，不過保留一點誤差值
                   lambda df, date:
                   ((df.loc[date, 'Close'] < df.loc[date, 'SMA20'] and df.loc[date, 'Close'] < df.loc[date, 'EMA20']) and
-                   ((float(df.loc[date, 'SMA20'] - df.loc[date, 'Close'])/df.loc[date, 'Close'] > 0.01) or
-                    (float(df.loc[date, 'EMA20'] - df.loc[date, 'Close'])/df.loc[date, 'Close'] > 0.01)
+                   ((float(df.loc[date, 'SMA20'] - df.loc[date, 'Close'])/df.loc[date, 'Close'] >
+                     DEATH_CROSS_DEVIATION) or
+                    (float(df.loc[date, 'EMA20'] - df.loc[date, 'Close'])/df.loc[date, 'Close'] >
+                     DEATH_CROSS_DEVIATION)
                     )),
                   }
 # sell_rule_dict = {"破底賣":  # 破底就賣
@@ -78,3 +269,129 @@ buy_rule_dict = {"過高買":  # 第一次過高就買
                  #  "聚集買":  # 在均線聚集處買
                  #  lambda df, date: (df.loc[date, '短均線聚集']),
                  }
+
+
+def _at(df, ref_col, col):
+    """
+    取出 ref_col 所指向那一天的 col 值, 用來向量化 df.loc[df.loc[date, ref_col], col]。
+
+    ref_col 沒有值 (例如還沒有前高) 時視為 False。
+
+    Args:
+        df (pd.DataFrame): 以 DatetimeIndex 為索引的日K資料。
+        ref_col (str): 存放日期或 day_schema 列距離的欄位, 例如 '前高 Index'。
+        col (str): 要取值的布林欄位。
+
+    Returns:
+        np.ndarray: 與 df 等長的布林陣列。
+    """
+    pos = day_schema.ref_positions(df, ref_col)
+    values = df[col].to_numpy(dtype=bool)
+    return np.where(pos >= 0, np.take_along_axis(values, np.maximum(pos, 0), axis=-1), False)
+
+
+def _esma20_death_cross(df, deviation=DEATH_CROSS_DEVIATION):
+    """
+    deviation 可以是 shape (K, 1) 的陣列, 一次算出 K 種誤差的訊號 (K, len(df))。
+    """
+    close = day_schema.values(df, 'Close')
+    sma20 = day_schema.values(df, 'SMA20')
+    ema20 = day_schema.values(df, 'EMA20')
+    return (((close < sma20) & (close < ema20)) &
+            (((sma20 - close) / close > deviation) | ((ema20 - close) / close > deviation)))
+
+
+# sell_rule_dict 的向量化版本, 一次算出整段歷史的訊號
+sell_rule_vec_dict = {"破底賣":
+                      lambda df: df['破底'].to_numpy(dtype=bool),
+                      "ESMA20死亡交叉":
+                      _esma20_death_cross,
+                      }
+
+
+# buy_rule_dict 的向量化版本, 一次算出整段歷史的訊號
+# 逐日版本查不到參照 (KeyError) 時視為 False, 所以 not at(...) 之前要先確認參照有值, 而且依照原本的查詢順序
+buy_rule_vec_dict = {"過高買":
+                     lambda df: (day_schema.has_ref(df, 'Previous Index') &
+                                 ~_at(df, 'Previous Index', '過前高') & df['過前高'].to_numpy(dtype=bool)),
+                     "過高後均線聚集買":
+                     lambda df: _at(df, '前高 Index', '過前高') & df['均線聚集後突破'].to_numpy(dtype=bool),
+                     "突破下降壓力均線聚集買":
+                     lambda df: ((day_schema.values(df, 'Close') > day_schema.values(df, '高點連線')) &
+                                 df['均線聚集後突破'].to_numpy(dtype=bool)),
+                     "突破下降壓力或過高後均線聚集買":
+                     lambda df: (((day_schema.values(df, 'Close') > day_schema.values(df, '高點連線')) |
+                                  _at(df, '前高 Index', '過前高')) &
+                                 df['均線聚集'].to_numpy(dtype=bool)),
+                     "聚集買":
+                     lambda df: (df['均線聚集後突破'].to_numpy(dtype=bool) |
+                                 (df['短均線聚集後突破'].to_numpy(dtype=bool) &
+                                  day_schema.has_ref(df, '前高 Index') &
+                                  (_at(df, '前高 Index', '過前高') |
+                                   (day_schema.has_ref(df, '前低 Index') & ~_at(df, '前低 Index', '破底'))))),
+                     }
+
+
+# 有門檻參數的向量化賣出規則: 規則名稱對應門檻名稱, 以 rule(df, 門檻) 呼叫
+sell_rule_thresholds = {"ESMA20死亡交叉": 'death_cross_deviation'}
+
+
+def sell_signal(sell_rule, df, thresholds=None):
+    """
+    以向量化規則計算賣出訊號, thresholds 中有規則使用的門檻時代入。
+
+    Args:
+        sell_rule (str): sell_rule_vec_dict 中的規則名稱。
+        df (pd.DataFrame): 日K資料。
+        thresholds (dict): DEFAULT_THRESHOLDS 中的門檻名稱對應的值, 可以是 (K, 1) 的陣列。
+
+    Returns:
+        np.ndarray: 與 df 等長的布林陣列, 門檻是陣列時為 (K, len(df))。
+    """
+    name = sell_rule_thresholds.get(sell_rule)
+    if thresholds and name in thresholds:
+        return sell_rule_vec_dict[sell_rule](df, thresholds[name])
+    return sell_rule_vec_dict[sell_rule](df)
+
+
+def liquidity_mask(df, investment_per_trade):
+    """
+    流動性篩選: 一張的價格不超過每次購買金額、成交金額與成交量夠大。
+
+    Args:
+        df (pd.DataFrame): 日K資料。
+        investment_per_trade (int): 每次購買金額。
+
+    Returns:
+        tuple: (符合條件的布林陣列, 每張價格的 int64 陣列)
+    """
+    price_unit = (day_schema.values(df, 'Close') * 1000).astype(np.int64)
+    volume = df['Volume'].to_numpy()
+    mask = ((price_unit <= investment_per_trade) &
+            ((price_unit * volume) >= MIN_TURNOVER) &
+            (volume >= MIN_VOLUME))
+    return mask, price_unit
+
+
+def scalar_signal(rule, df):
+    """
+    逐日呼叫 buy_rule_dict / sell_rule_dict 中的規則, 作為向量化版本的對照。
+
+    參照的日期不存在而查不到資料時視為 False, 與向量化版本相同。
+    規則以日期查詢參照, 精簡格式的日K資料會先還原成原本的型別。
+
+    Args:
+        rule (callable): rule(df, date)。
+        df (pd.DataFrame): 日K資料。
+
+    Returns:
+        np.ndarray: 與 df 等長的布林陣列。
+    """
+    df = day_schema.expand(df)
+    signal = np.zeros(len(df), dtype=bool)
+    for i, date in enumerate(df.index):
+        try:
+            signal[i] = bool(rule(df, date))
+        except KeyError:
+            signal[i] = False
+    return signal
@@ -0,0 +1,189 @@
+#!/usr/bin/python3
+"""
+分K資料的品質檢查。
+
+以區塊方式讀取 _min.csv, 每個區塊用陣列運算一次做完所有檢查, 區塊之間只保留最後一筆的時間與收盤價,
+所以記憶體用量與檔案大小無關。每個檔案回傳一份結構化的結果, 再由 build_report 彙整成一張表。
+"""
+
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+# 檢查項目
+CHECKS = (
+    'zero_price',    # 有成交量但開高低收有 0
+    'high_low',      # 最高價低於最低價
+    'duplicate_ts',  # 時間重複
+    'out_of_order',  # 時間倒退
+    'intraday_gap',  # 同一天內兩筆資料間隔過長
+    'price_jump',    # 與前一筆收盤價相差過大
+)
+
+# 讀檔時的區塊大小 (列數)
+DEFAULT_CHUNKSIZE = 500000
+
+# 同一天內兩筆分K的最大間隔
+MAX_GAP = pd.Timedelta(minutes=30)
+
+# 與前一筆收盤價的最大漲跌幅, 台股漲跌停為 10%, 多留一點誤差
+JUMP_THRESHOLD = 0.11
+
+# 每個檢查項目保留的範例筆數
+MAX_EXAMPLES = 5
+
+PRICE_COLUMNS = ['Open', 'High', 'Low', 'Close']
+
+# 單筆問題: 檔案、檢查項目、資料列 (不含標題, 從 0 開始) 與時間
+Issue = namedtuple('Issue', ['file', 'check', 'row', 'ts'])
+
+
+class MinDataScanner:
+    """
+    逐區塊檢查同一個檔案的分K資料。
+
+    區塊必須依檔案順序傳入 scan, 時間重複、倒退、間隔與價格跳動會跨區塊比較。
+    """
+
+    def __init__(self, name, max_gap=MAX_GAP, jump_threshold=JUMP_THRESHOLD, max_examples=MAX_EXAMPLES):
+        self.name = name
+        self.max_gap = np.timedelta64(pd.Timedelta(max_gap).value, 'ns')
+        self.jump_threshold = jump_threshold
+        self.max_examples = max_examples
+        self.rows = 0
+        self.counts = dict.fromkeys(CHECKS, 0)
+        self.examples = []
+        self.first_ts = None
+        self.last_ts = None
+        self._prev_ts = np.datetime64('NaT', 'ns')
+        self._prev_close = np.nan
+
+    def scan(self, chunk):
+        """
+        檢查一個區塊。
+
+        Args:
+            chunk (pd.DataFrame): 以 ts 為索引、尚未過濾的分K資料。
+        """
+        n = len(chunk)
+        if n == 0:
+            return
+        ts = pd.DatetimeIndex(chunk.index).to_numpy(dtype='datetime64[ns]')
+        prices = chunk[PRICE_COLUMNS].to_numpy(dtype=np.float64)
+        volume = chunk['Volume'].to_numpy()
+        high = prices[:, 1]
+        low = prices[:, 2]
+        close = prices[:, 3]
+
+        # 與前一筆 (包含上一個區塊的最後一筆) 的時間差
+        prev_ts = np.concatenate(([self._prev_ts], ts[:-1]))
+        delta = ts - prev_ts
+        has_prev = ~np.isnat(prev_ts)
+        same_day = has_prev & (ts.astype('datetime64[D]') == prev_ts.astype('datetime64[D]'))
+
+        # 前一筆有效的收盤價
+        valid_close = close > 0
+        closes = np.concatenate(([self._prev_close], np.where(valid_close, close, np.nan)))
+        pos = np.where(~np.isnan(closes), np.arange(n + 1), 0)
+        np.maximum.accumulate(pos, out=pos)
+        prev_close = closes[pos][:-1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            jump = valid_close & (np.abs(close / prev_close - 1) > self.jump_threshold)
+
+        flags = {
+            'zero_price': (volume != 0) & (prices == 0).any(axis=1),
+            'high_low': high < low,
+            'duplicate_ts': has_prev & (delta == np.timedelta64(0, 'ns')),
+            'out_of_order': has_prev & (delta < np.timedelta64(0, 'ns')),
+            'intraday_gap': same_day & (delta > self.max_gap),
+            'price_jump': jump,
+        }
+        for check, flag in flags.items():
+            hits = np.flatnonzero(flag)
+            self.counts[check] += len(hits)
+            recorded = sum(1 for issue in self.examples if issue.check == check)
+            for i in hits[:max(self.max_examples - recorded, 0)]:
+                self.examples.append(Issue(self.name, check, self.rows + int(i), pd.Timestamp(ts[i])))
+
+        if self.first_ts is None:
+            self.first_ts = pd.Timestamp(ts[0])
+        self.last_ts = pd.Timestamp(ts[-1])
+        self._prev_ts = ts[-1]
+        self._prev_close = closes[pos[-1]]
+        self.rows += n
+
+    def result(self, error=None):
+        """
+        回傳檢查結果。
+
+        Args:
+            error (str): 讀檔或檢查時發生的錯誤。
+
+        Returns:
+            dict: 檔案名稱、列數、時間範圍、各檢查項目的筆數、範例與錯誤。
+        """
+        return dict(file=self.name, rows=self.rows, first_ts=self.first_ts, last_ts=self.last_ts,
+                    **self.counts, examples=list(self.examples), error=error)
+
+
+def read_min_chunks(source, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    以區塊方式讀取 _min.csv。
+
+    Args:
+        source (str or file-like): _min.csv 檔案路徑或檔案內容。
+        chunksize (int): 每個區塊的列數。
+
+    Yields:
+        pd.DataFrame: 以 ts 為索引、尚未過濾的分K資料。
+    """
+    with pd.read_csv(source, chunksize=chunksize) as reader:
+        for chunk in reader:
+            chunk['ts'] = pd.to_datetime(chunk['ts'])
+            yield chunk.set_index('ts')
+
+
+def scan_min_file(path, chunksize=DEFAULT_CHUNKSIZE, **kwargs):
+    """
+    檢查單一檔案, 發生錯誤時也會回傳結果而不是丟出例外。
+
+    Args:
+        path (str): _min.csv 檔案路徑。
+        chunksize (int): 每個區塊的列數。
+        **kwargs: 傳給 MinDataScanner 的設定。
+
+    Returns:
+        dict: MinDataScanner.result() 的結果。
+    """
+    scanner = MinDataScanner(path, **kwargs)
+    try:
+        for chunk in read_min_chunks(path, chunksize):
+            scanner.scan(chunk)
+    except Exception as e:
+        return scanner.result(error=f"{type(e).__name__}: {e}")
+    return scanner.result()
+
+
+def build_report(results):
+    """
+    彙整多個檔案的檢查結果。
+
+    Args:
+        results (iterable): scan_min_file 或 MinDataScanner.result() 的結果。
+
+    Returns:
+        tuple: (每個檔案一列的摘要 DataFrame, 所有範例的 DataFrame)。
+    """
+    results = [result for result in results if result is not None]
+    summary = pd.DataFrame([{k: v for k, v in result.items() if k != 'examples'} for result in results],
+                           columns=['file', 'rows', 'first_ts', 'last_ts', *CHECKS, 'error'])
+    issues = pd.DataFrame([issue for result in results for issue in result['examples']], columns=Issue._fields)
+    return summary, issues
+
+
+def has_issues(summary):
+    """
+    回傳 build_report 摘要中有問題或錯誤的檔案。
+    """
+    return summary[(summary[list(CHECKS)] > 0).any(axis=1) | summary['error'].notna()]
@@ -0,0 +1,286 @@
+#!/usr/bin/python3
+"""
+日K資料的欄位式快取。
+
+process_kbars 寫出 _day.csv 時, 在旁邊的 <檔名>.cache 資料夾中把同型別的欄位存成一個
+(欄位數, 列數) 的 .npy 檔, 每個欄位在檔案中都是連續的一段, 並在 meta.json 記錄欄位位置
+與來源 CSV 的 mtime、大小與雜湊值。讀取時以 memory map 只載入需要的欄位;
+快取不存在或與 CSV 對不上時改讀 CSV。
+
+快取中的欄位是 day_schema 的精簡格式, 布林欄位再以 np.packbits 壓成每列一個位元。
+讀取時 compact=True 直接回傳精簡格式, 否則還原成與 CSV 相同的型別。
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from utils import day_schema
+
+# 快取格式版本, 格式改變時要跟著改, 舊的快取會被視為無效
+CACHE_VERSION = 2
+
+# 存放日期字串的欄位, 讀進來時轉成 datetime64
+DATE_COLUMNS = day_schema.REF_COLUMNS
+
+# 壓成位元的布林欄位所在的檔案
+BITS_FILE = 'bits.npy'
+
+# 索引欄位名稱
+INDEX_NAME = 'ts'
+
+
+def cache_dir(csv_path):
+    """
+    回傳 _day.csv 對應的快取資料夾路徑。
+    """
+    return os.path.splitext(csv_path)[0] + '.cache'
+
+
+def file_hash(path):
+    """
+    計算檔案的 sha1 雜湊值。
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _source_stat(csv_path):
+    stat = os.stat(csv_path)
+    return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+
+def write_day_cache(day_data, csv_path):
+    """
+    將日K資料寫成欄位式快取, 需要在 csv_path 寫完之後呼叫。
+
+    Args:
+        day_data (pd.DataFrame): 以日期為索引的日K資料。
+        csv_path (str): 剛寫出的 _day.csv 路徑。
+    """
+    path = cache_dir(csv_path)
+    os.makedirs(path, exist_ok=True)
+
+    # 同型別的欄位放在同一個區塊, 布林欄位壓成位元
+    day_data = day_schema.compact(day_data)
+    blocks = {}
+    bits = []
+    columns = []
+    for col in day_data.columns:
+        values = day_data[col].to_numpy()
+        if values.dtype == bool:
+            columns.append({'name': col, 'file': BITS_FILE, 'row': len(bits)})
+            bits.append(np.packbits(values))
+            continue
+        if values.dtype == object:
+            values = day_data[col].fillna('').astype(str).to_numpy()
+        block = blocks.setdefault(values.dtype.str, [])
+        columns.append({'name': col, 'file': f'block{list(blocks).index(values.dtype.str)}.npy',
+                        'row': len(block)})
+        block.append(values)
+    for i, block in enumerate(blocks.values()):
+        np.save(os.path.join(path, f'block{i}.npy'), np.stack(block), allow_pickle=False)
+    if bits:
+        np.save(os.path.join(path, BITS_FILE), np.stack(bits), allow_pickle=False)
+    np.save(os.path.join(path, 'index.npy'), day_data.index.to_numpy(dtype='datetime64[ns]'), allow_pickle=False)
+
+    meta = {
+        'version': CACHE_VERSION,
+        'source': dict(_source_stat(csv_path), sha1=file_hash(csv_path)),
+        'rows': len(day_data),
+        'columns': columns,
+    }
+    tmp_path = os.path.join(path, 'meta.json.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp_path, os.path.join(path, 'meta.json'))
+
+
+class DayCache:
+    """
+    單一股票的日K快取, 欄位在第一次用到時才以 memory map 載入。
+    """
+
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = meta
+        self._columns = {col['name']: (col['file'], col['row']) for col in meta['columns']}
+        self._blocks = {}
+        self._index = None
+
+    @classmethod
+    def open(cls, csv_path):
+        """
+        開啟 csv_path 的快取。
+
+        mtime 與大小都相同時直接視為有效; 只有 mtime 不同時 (例如檔案被複製或 touch),
+        再用雜湊值確認內容沒變。
+
+        Args:
+            csv_path (str): _day.csv 路徑。
+
+        Returns:
+            DayCache: 有效的快取, 快取不存在或已經過期時回傳 None。
+        """
+        path = cache_dir(csv_path)
+        try:
+            with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            stat = _source_stat(csv_path)
+        except (OSError, ValueError):
+            return None
+
+        source = meta.get('source', {})
+        if meta.get('version') != CACHE_VERSION or source.get('size') != stat['size']:
+            return None
+        if source.get('mtime_ns') != stat['mtime_ns'] and source.get('sha1') != file_hash(csv_path):
+            return None
+        return cls(path, meta)
+
+    @property
+    def columns(self):
+        return list(self._columns)
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = pd.DatetimeIndex(np.load(os.path.join(self.path, 'index.npy')), name=INDEX_NAME)
+        return self._index
+
+    def column(self, name):
+        """
+        以 memory map 載入單一欄位。
+
+        Args:
+            name (str): 欄位名稱。
+
+        Returns:
+            np.ndarray: 精簡格式的欄位資料, 除了布林欄位以外都是唯讀的。
+        """
+        file_name, row = self._columns[name]
+        if file_name not in self._blocks:
+            self._blocks[file_name] = np.load(os.path.join(self.path, file_name), mmap_mode='r')
+        values = self._blocks[file_name][row]
+        if file_name == BITS_FILE:
+            return np.unpackbits(values, count=self.meta['rows']).astype(bool)
+        return values
+
+    def to_frame(self, columns=None, compact=False, rows=None):
+        """
+        組成 DataFrame。
+
+        Args:
+            columns (iterable): 要載入的欄位, 為 None 時載入全部欄位。
+            compact (bool): 回傳 day_schema 的精簡格式, 否則還原成與 CSV 相同的型別。
+            rows (slice): 只載入這幾列, 為 None 時載入全部。
+
+        Returns:
+            pd.DataFrame: 以 DatetimeIndex 為索引的日K資料。
+        """
+        columns = self.columns if columns is None else list(columns)
+        rows = slice(None) if rows is None else rows
+        df = pd.DataFrame(self.arrays(columns, rows), index=self.index[rows], columns=columns)
+        return df if compact else day_schema.expand(df)
+
+    def arrays(self, columns=None, rows=None):
+        """
+        以精簡格式取出欄位, 不組成 DataFrame; 字串欄位的空字串還原成 NaN。
+
+        Args:
+            columns (iterable): 要載入的欄位, 為 None 時載入全部欄位。
+            rows (slice): 只載入這幾列, 為 None 時載入全部。
+
+        Returns:
+            dict: 欄位名稱對應 np.ndarray。
+        """
+        columns = self.columns if columns is None else list(columns)
+        rows = slice(None) if rows is None else rows
+        data = {}
+        for name in columns:
+            values = self.column(name)[rows]
+            if values.dtype.kind == 'U':
+                values = np.where(values == '', np.nan, values.astype(object))
+            data[name] = values
+        return data
+
+    def tail_rows(self, bars, end_date=None):
+        """
+        到 end_date (含) 為止最後 bars 列的範圍。
+
+        Returns:
+            slice: 列的範圍。
+        """
+        index = self.index
+        end = len(index) if end_date is None else int(index.searchsorted(end_date, side='right'))
+        return slice(max(end - bars, 0), end)
+
+
+def read_day_csv(csv_path, columns=None, compact=False):
+    """
+    直接讀取 _day.csv, 欄位型別與快取相同。
+
+    Args:
+        csv_path (str): _day.csv 路徑。
+        columns (iterable): 要讀取的欄位, 為 None 時讀取全部欄位。
+        compact (bool): 轉成 day_schema 的精簡格式。
+
+    Returns:
+        pd.DataFrame: 以 DatetimeIndex 為索引的日K資料。
+    """
+    usecols = None if columns is None else [INDEX_NAME] + list(columns)
+    df = pd.read_csv(csv_path, usecols=usecols)
+    df[INDEX_NAME] = pd.to_datetime(df[INDEX_NAME])
+    df.set_index(INDEX_NAME, inplace=True)
+    for col in DATE_COLUMNS:
+        if col in df.columns:
+            df[col] = pd.to_datetime(df[col])
+    if columns is not None:
+        df = df[list(columns)]
+    return day_schema.compact(df) if compact else df
+
+
+def read_day_data(csv_path, columns=None, compact=False):
+    """
+    讀取日K資料, 有有效的快取時讀快取, 否則讀 CSV。
+
+    Args:
+        csv_path (str): _day.csv 路徑。
+        columns (iterable): 要讀取的欄位, 為 None 時讀取全部欄位。
+        compact (bool): 回傳 day_schema 的精簡格式。
+
+    Returns:
+        pd.DataFrame: 以 DatetimeIndex 為索引的日K資料。
+    """
+    cache = DayCache.open(csv_path)
+    if cache is not None:
+        return cache.to_frame(columns, compact)
+    return read_day_csv(csv_path, columns, compact)
+
+
+def read_day_tail(csv_path, bars, end_date=None, columns=None, compact=False):
+    """
+    讀取到 end_date (含) 為止的最後 bars 根日K, 有快取時只從 memory map 取出這幾列。
+
+    精簡格式的參照欄位是列距離, 指到這幾列之前的參照在 day_schema.ref_positions 中視為沒有資料。
+
+    Args:
+        csv_path (str): _day.csv 路徑。
+        bars (int): 要讀取的K棒數。
+        end_date (pd.Timestamp): 最後一天, 為 None 時讀到最後一根。
+        columns (iterable): 要讀取的欄位, 為 None 時讀取全部欄位。
+        compact (bool): 回傳 day_schema 的精簡格式。
+
+    Returns:
+        pd.DataFrame: 以 DatetimeIndex 為索引的日K資料。
+    """
+    cache = DayCache.open(csv_path)
+    if cache is not None:
+        return cache.to_frame(columns, compact, cache.tail_rows(bars, end_date))
+    df = read_day_csv(csv_path, columns, compact)
+    if end_date is not None:
+        df = df[df.index <= end_date]
+    return df.iloc[max(len(df) - bars, 0):]
@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+"""
+日K資料的精簡格式。
+
+process_kbars 產生的日K資料以 float64 存價格, 以日期字串 (或 datetime64) 存前一根、前高與前低的位置,
+布林欄位有時混著 NaN 變成 object 欄位。回測只需要讀取, 改成精簡格式後每列的記憶體少很多:
+- 參照欄位 (REF_COLUMNS) 存成 int32 的列距離: 往前數第幾列, -1 代表沒有參照;
+  用列距離而不是絕對列號, 切片之後仍然正確。
+- 布林欄位存成 bool, NaN 視為 False。
+- 小數兩位以內的價格欄位存成 float32, values() 取值時還原成與 CSV 解析結果完全相同的 float64;
+  無法無損存成 float32 的欄位維持 float64。
+- 整數欄位放得進 int32 時存成 int32。
+- 索引是 DatetimeIndex。
+
+精簡格式中的 float32 欄位一定是價格, 需要做運算的程式以 values() 取值, 結果與原本的格式完全相同。
+"""
+
+import numpy as np
+import pandas as pd
+
+# 存放參照日期的欄位
+REF_COLUMNS = ('Previous Index', '前高 Index', '前低 Index')
+
+# 價格的最小單位為 1 / PRICE_SCALE
+PRICE_SCALE = 100
+
+# 沒有參照的列距離
+NO_REF = -1
+
+_INT32 = np.iinfo(np.int32)
+
+
+def ref_offsets(ref, index):
+    """
+    將參照日期轉成列距離。
+
+    Args:
+        ref (array-like): 參照的日期, NaN 代表沒有參照。
+        index (pd.DatetimeIndex): 日K資料的索引。
+
+    Returns:
+        np.ndarray: int32 的列距離, 沒有參照或參照的日期不在索引中時為 NO_REF。
+    """
+    pos = index.get_indexer(pd.to_datetime(ref))
+    return np.where(pos >= 0, np.arange(len(index)) - pos, NO_REF).astype(np.int32)
+
+
+def price_array(values):
+    """
+    可以無損存成 float32 的價格欄位回傳 float32 陣列, 否則回傳 None。
+
+    Args:
+        values (np.ndarray): float64 的欄位。
+
+    Returns:
+        np.ndarray: float32 陣列或 None。
+    """
+    finite = np.isfinite(values)
+    cents = np.round(values[finite] * PRICE_SCALE)
+    if len(cents) and np.abs(cents).max() > _INT32.max:
+        return None
+    if not np.array_equal(cents / PRICE_SCALE, values[finite]):
+        return None
+    compact = values.astype(np.float32)
+    if not np.array_equal(_decode_price(compact[finite]), values[finite]):
+        return None
+    return compact
+
+
+def _decode_price(values):
+    return np.round(values.astype(np.float64) * PRICE_SCALE) / PRICE_SCALE
+
+
+def compact_column(name, series, index):
+    """
+    將一個欄位轉成精簡格式。
+
+    Args:
+        name (str): 欄位名稱。
+        series (pd.Series): 欄位資料。
+        index (pd.DatetimeIndex): 日K資料的索引。
+
+    Returns:
+        np.ndarray: 精簡格式的欄位。
+    """
+    if name in REF_COLUMNS:
+        if series.dtype.kind in 'iu':
+            return series.to_numpy(dtype=np.int32)
+        return ref_offsets(series, index)
+    values = series.to_numpy()
+    if values.dtype == object:
+        non_null = series.dropna()
+        if non_null.map(lambda v: isinstance(v, (bool, np.bool_))).all():
+            return series.fillna(False).to_numpy(dtype=bool)
+        return values
+    if values.dtype == np.float64:
+        compact = price_array(values)
+        return values if compact is None else compact
+    if values.dtype.kind in 'iu' and values.dtype.itemsize > 4:
+        if len(values) == 0 or (values.min() >= _INT32.min and values.max() <= _INT32.max):
+            return values.astype(np.int32)
+    return values
+
+
+def compact(df):
+    """
+    將日K資料轉成精簡格式。
+
+    Args:
+        df (pd.DataFrame): 以日期為索引的日K資料。
+
+    Returns:
+        pd.DataFrame: 精簡格式的日K資料。
+    """
+    index = pd.DatetimeIndex(pd.to_datetime(df.index), name=df.index.name)
+    data = {col: compact_column(col, df[col], index) for col in df.columns}
+    return pd.DataFrame(data, index=index, columns=df.columns)
+
+
+def expand(df):
+    """
+    將精簡格式還原成原本的型別: 參照欄位為 datetime64, 價格為 float64, 整數為 int64。
+
+    Args:
+        df (pd.DataFrame): 精簡格式的日K資料。
+
+    Returns:
+        pd.DataFrame: 與 day_cache.read_day_csv 相同型別的日K資料。
+    """
+    data = {}
+    for col in df.columns:
+        if col in REF_COLUMNS and df[col].dtype.kind in 'iu':
+            data[col] = ref_dates(df, col)
+        elif df[col].dtype.kind in 'iu':
+            data[col] = df[col].to_numpy(dtype=np.int64)
+        else:
+            data[col] = values(df, col)
+    return pd.DataFrame(data, index=df.index, columns=df.columns)
+
+
+def values(df, col):
+    """
+    取出欄位的值, 精簡格式的價格還原成 float64。
+
+    Args:
+        df (pd.DataFrame): 日K資料, 精簡格式或原本的格式都可以。
+        col (str): 欄位名稱。
+
+    Returns:
+        np.ndarray: 欄位的值。
+    """
+    return array_values(df[col].to_numpy())
+
+
+def array_values(array):
+    """
+    陣列版的 values(): 精簡格式的 float32 價格還原成 float64, 其他型別原樣回傳。
+    """
+    if array.dtype == np.float32:
+        return _decode_price(array)
+    return array
+
+
+def frame_values(df, cols):
+    """
+    取出多個欄位組成的 DataFrame, 精簡格式的價格還原成 float64。
+    """
+    cols = list(cols)
+    if all(df[col].dtype != np.float32 for col in cols):
+        return df[cols]
+    return pd.DataFrame({col: values(df, col) for col in cols}, index=df.index, columns=cols)
+
+
+def ref_positions(df, col):
+    """
+    參照欄位所指向的列位置。
+
+    Args:
+        df (pd.DataFrame): 日K資料, 參照欄位可以是列距離或日期。
+        col (str): 參照欄位, 例如 '前高 Index'。
+
+    Returns:
+        np.ndarray: 與 df 等長的列位置 (沿著最後一個軸), 沒有參照或參照的列不在 df 中時為 -1。
+    """
+    ref = df[col]
+    if ref.dtype.kind in 'iu':
+        # 列距離沿著最後一個軸計算, (股票數, K棒數) 的陣列也適用
+        offsets = ref.to_numpy()
+        pos = np.arange(offsets.shape[-1]) - offsets
+        return np.where((offsets >= 0) & (pos >= 0), pos, -1)
+    return df.index.get_indexer(ref)
+
+
+def has_ref(df, col):
+    """
+    參照欄位有沒有值 (不論參照的列是否在 df 中), 相當於 df[col].notna()。
+
+    Returns:
+        np.ndarray: 與 df 等長的布林陣列。
+    """
+    ref = df[col]
+    if ref.dtype.kind in 'iu':
+        return ref.to_numpy() >= 0
+    return ref.notna().to_numpy()
+
+
+def ref_dates(df, col):
+    """
+    將列距離還原成參照的日期。
+
+    Returns:
+        np.ndarray: datetime64 陣列, 沒有參照時為 NaT。
+    """
+    pos = ref_positions(df, col)
+    dates = df.index.to_numpy(dtype='datetime64[ns]')
+    return np.where(pos >= 0, dates[np.maximum(pos, 0)], np.datetime64('NaT'))
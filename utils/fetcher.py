@@ -0,0 +1,401 @@
+#!/usr/bin/python3
+"""
+以 asyncio 同時下載多檔股票的分K。
+
+每檔股票依時間分成幾個區間下載, 下載好一段就直接接在 _min.csv 後面, 之後 process_kbars -i
+只會處理新接上的資料。同時進行的股票數由 concurrency 限制, 所有請求共用一個 TokenBucket 控制
+每秒請求數, 失敗時以指數退避重試。
+
+下載的來源只要實作 MinuteBarClient.fetch(), 例如呼叫 Shioaji 的 ShioajiClient, 或是連到
+utils.mock_server 的 HttpClient。
+"""
+
+import abc
+import asyncio
+import io
+import os
+import random
+import time
+from collections import namedtuple
+
+import pandas as pd
+
+# _min.csv 的欄位
+MIN_COLUMNS = ['ts', 'Open', 'High', 'Low', 'Close', 'Volume', 'Amount']
+
+# _min.csv 的時間格式
+TS_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# 每次請求的日期區間長度 (日曆日)
+DEFAULT_WINDOW_DAYS = 30
+
+# 單一檔股票的下載結果
+FetchResult = namedtuple('FetchResult', ['code', 'requests', 'retries', 'rows', 'last_ts', 'error'])
+
+
+class FetchError(Exception):
+    """
+    下載失敗。retryable 為 True 時 (例如超過流量限制或伺服器錯誤) 會重試。
+    """
+
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class MinuteBarClient(abc.ABC):
+    """
+    分K來源的介面。
+    """
+
+    @abc.abstractmethod
+    async def fetch(self, code, start, end):
+        """
+        下載一段日期的分K。
+
+        Args:
+            code (str): 股票代號。
+            start (pd.Timestamp): 第一天。
+            end (pd.Timestamp): 最後一天 (含)。
+
+        Returns:
+            pd.DataFrame: 欄位與 MIN_COLUMNS 相同、依時間排序的分K, ts 為 datetime64。
+        """
+
+    async def close(self):
+        pass
+
+
+class ShioajiClient(MinuteBarClient):
+    """
+    以 Shioaji 的 api.kbars 下載分K。Shioaji 是同步的 API, 在執行緒中呼叫。
+    """
+
+    def __init__(self, api):
+        """
+        Args:
+            api: 已經登入的 shioaji.Shioaji()。
+        """
+        self.api = api
+
+    @classmethod
+    def login(cls, key_file):
+        """
+        以 key 檔登入 Shioaji, key 檔是包含 api_key 與 secret_key 的 JSON5。
+        """
+        import json5
+        import shioaji as sj
+        with open(key_file, 'r', encoding='utf-8') as f:
+            key = json5.load(f)
+        api = sj.Shioaji()
+        api.login(api_key=key['api_key'], secret_key=key['secret_key'])
+        return cls(api)
+
+    def _fetch(self, code, start, end):
+        try:
+            contract = self.api.Contracts.Stocks[code]
+        except (KeyError, IndexError) as e:
+            raise FetchError(f"找不到股票 {code}: {e}", retryable=False) from e
+        if contract is None:
+            raise FetchError(f"找不到股票 {code}", retryable=False)
+        kbars = self.api.kbars(contract=contract, start=start.strftime('%Y-%m-%d'), end=end.strftime('%Y-%m-%d'))
+        bars = pd.DataFrame({**kbars})
+        bars['ts'] = pd.to_datetime(bars['ts'])
+        return bars[MIN_COLUMNS]
+
+    async def fetch(self, code, start, end):
+        try:
+            return await asyncio.to_thread(self._fetch, code, start, end)
+        except FetchError:
+            raise
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            # 參數或回傳內容有問題, 重試也不會成功
+            raise FetchError(f"{type(e).__name__}: {e}", retryable=False) from e
+        except Exception as e:
+            raise FetchError(f"{type(e).__name__}: {e}") from e
+
+    async def close(self):
+        await asyncio.to_thread(self.api.logout)
+
+
+class HttpClient(MinuteBarClient):
+    """
+    從 HTTP 伺服器 (例如 utils.mock_server) 下載 CSV 格式的分K, 不需要額外的套件。
+
+    請求為 GET /kbars?code=<代號>&start=<YYYY-MM-DD>&end=<YYYY-MM-DD>, 回應內容是 _min.csv 格式。
+    """
+
+    def __init__(self, host, port, timeout=30):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    async def _get(self, path):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write(f"GET {path} HTTP/1.0\r\nHost: {self.host}\r\n\r\n".encode('ascii'))
+            await writer.drain()
+            response = await reader.read()
+        finally:
+            writer.close()
+        return _parse_response(response)
+
+    async def fetch(self, code, start, end):
+        path = f"/kbars?code={code}&start={start.strftime('%Y-%m-%d')}&end={end.strftime('%Y-%m-%d')}"
+        try:
+            status, body = await asyncio.wait_for(self._get(path), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise FetchError(f"{type(e).__name__}: {e}") from e
+        if status != 200:
+            # 429 與 5xx 是暫時的錯誤
+            raise FetchError(f"HTTP {status}: {body[:200].decode('utf-8', 'replace')}",
+                             retryable=status == 429 or status >= 500)
+        try:
+            bars = pd.read_csv(io.BytesIO(body))
+            bars['ts'] = pd.to_datetime(bars['ts'])
+            return bars[MIN_COLUMNS]
+        except (KeyError, ValueError) as e:
+            # pandas 的 ParserError 與 EmptyDataError 都是 ValueError
+            raise FetchError(f"回應格式錯誤: {type(e).__name__}: {e}", retryable=False) from e
+
+
+def _parse_response(response):
+    """
+    拆開 HTTP 回應, 回傳 (狀態碼, 內容)。
+
+    連線中斷造成的不完整回應 (沒有標頭、狀態列無法解析或內容比 Content-Length 短) 以可以重試的 FetchError 回報。
+
+    Args:
+        response (bytes): 完整的 HTTP 回應。
+
+    Returns:
+        tuple: (int, bytes)
+    """
+    header, sep, body = response.partition(b'\r\n\r\n')
+    lines = header.split(b'\r\n')
+    try:
+        if not sep:
+            raise ValueError("沒有完整的標頭")
+        status = int(lines[0].split(b' ', 2)[1])
+        length = [int(line.split(b':', 1)[1]) for line in lines[1:] if line.lower().startswith(b'content-length:')]
+    except (IndexError, ValueError) as e:
+        raise FetchError(f"回應不完整: {e}: {response[:100]!r}") from e
+    if length and len(body) < length[0]:
+        raise FetchError(f"回應不完整: 內容 {len(body)} bytes, Content-Length {length[0]}")
+    return status, body
+
+
+class TokenBucket:
+    """
+    令牌桶: 平均每秒最多 rate 次, 最多累積 capacity 次的突發請求。
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        Args:
+            rate (float): 每秒補充的令牌數, 0 代表不限制。
+            capacity (float): 桶子的容量, 預設為 max(rate, 1)。
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """
+        取得一個令牌, 不夠時等到補充為止。
+        """
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def backoff_delay(attempt, base_delay, max_delay, rng=random):
+    """
+    第 attempt 次重試前等待的秒數: 指數退避再乘上 0.5 ~ 1 的隨機比例, 避免同時重試。
+    """
+    return min(max_delay, base_delay * 2 ** attempt) * (0.5 + rng.random() / 2)
+
+
+def min_path(data_dir, code):
+    """
+    回傳股票的 _min.csv 路徑。
+    """
+    return os.path.join(data_dir, f'{code}_min.csv')
+
+
+def last_min_ts(path):
+    """
+    讀取 _min.csv 最後一筆完整資料的時間, 檔案不存在或沒有資料時回傳 None。
+
+    只讀檔案結尾, 不用讀整個檔案。
+    """
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+        block = 4096
+        while True:
+            start = max(size - block, 0)
+            f.seek(start)
+            tail = f.read(size - start)
+            # 最後一列可能還沒寫完, 只看已經寫完的資料列
+            lines = tail[:tail.rfind(b'\n') + 1].splitlines()
+            if len(lines) >= 2 or start == 0:
+                break
+            block *= 2
+    for line in reversed(lines):
+        ts = line.split(b',', 1)[0].decode('ascii', 'replace')
+        if ts and ts != 'ts':
+            return pd.Timestamp(ts)
+    return None
+
+
+def _drop_partial_line(path):
+    """
+    上次寫到一半中斷時, 去掉檔案結尾沒寫完的資料列。
+    """
+    with open(path, 'rb+') as f:
+        size = f.seek(0, os.SEEK_END)
+        f.seek(size - 1)
+        if f.read(1) == b'\n':
+            return
+        start = max(size - 4096, 0)
+        f.seek(start)
+        tail = f.read()
+        f.truncate(start + tail.rfind(b'\n') + 1)
+
+
+def append_min_bars(path, bars, last_ts=None):
+    """
+    將比 last_ts 新的分K接在 _min.csv 後面, 檔案不存在時一併寫入標題。
+
+    Args:
+        path (str): _min.csv 路徑。
+        bars (pd.DataFrame): 欄位與 MIN_COLUMNS 相同的分K。
+        last_ts (pd.Timestamp): 檔案中最後一筆的時間。
+
+    Returns:
+        tuple: (接上的列數, 新的最後一筆時間)。
+    """
+    bars = bars.sort_values('ts', kind='stable')
+    if last_ts is not None:
+        bars = bars[bars['ts'] > last_ts]
+    if len(bars) == 0:
+        return 0, last_ts
+
+    header = not os.path.isfile(path) or os.path.getsize(path) == 0
+    if not header:
+        _drop_partial_line(path)
+    buffer = io.StringIO()
+    bars[MIN_COLUMNS].to_csv(buffer, header=header, index=False, date_format=TS_FORMAT)
+    # 一次寫入, 避免 process_kbars 讀到寫了一半的資料列
+    with open(path, 'a', encoding='utf-8', newline='') as f:
+        f.write(buffer.getvalue())
+    return len(bars), bars['ts'].iloc[-1]
+
+
+def date_windows(start, end, window_days=DEFAULT_WINDOW_DAYS):
+    """
+    將 [start, end] 切成每段最多 window_days 天的區間。
+    """
+    windows = []
+    while start <= end:
+        stop = min(start + pd.Timedelta(days=window_days - 1), end)
+        windows.append((start, stop))
+        start = stop + pd.Timedelta(days=1)
+    return windows
+
+
+class MinuteFetcher:
+    """
+    同時下載多檔股票的分K並接在各自的 _min.csv 後面。
+    """
+
+    def __init__(self, client, data_dir, concurrency=8, rate=10, burst=None, retries=5,
+                 base_delay=0.5, max_delay=30, window_days=DEFAULT_WINDOW_DAYS, seed=None):
+        """
+        Args:
+            client (MinuteBarClient): 分K來源。
+            data_dir (str): _min.csv 所在的資料夾。
+            concurrency (int): 同時下載的股票數。
+            rate (float): 每秒最多的請求數, 0 代表不限制。
+            burst (float): 最多累積的突發請求數。
+            retries (int): 每個請求最多重試幾次。
+            base_delay (float): 第一次重試前等待的秒數。
+            max_delay (float): 重試前最多等待的秒數。
+            window_days (int): 每個請求的日期區間長度。
+            seed (int): 退避時間的亂數種子。
+        """
+        self.client = client
+        self.data_dir = data_dir
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate, burst)
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.window_days = window_days
+        self.rng = random.Random(seed)
+
+    async def _request(self, code, start, end):
+        """
+        下載一個區間, 回傳 (分K, 重試次數)。
+        """
+        attempt = 0
+        while True:
+            await self.bucket.acquire()
+            try:
+                return await self.client.fetch(code, start, end), attempt
+            except FetchError as e:
+                if not e.retryable or attempt >= self.retries:
+                    raise
+            await asyncio.sleep(backoff_delay(attempt, self.base_delay, self.max_delay, self.rng))
+            attempt += 1
+
+    async def fetch_code(self, code, start_date, end_date):
+        """
+        下載單一股票從上次的最後一筆 (或 start_date) 到 end_date 的分K。
+
+        最後一天可能還沒收完, 所以從最後一筆那一天重新下載, 只接上比最後一筆新的資料。
+
+        Returns:
+            FetchResult: 下載結果, 發生錯誤時 error 為錯誤訊息, 已經接上的資料會保留。
+        """
+        path = min_path(self.data_dir, code)
+        last_ts = await asyncio.to_thread(last_min_ts, path)
+        start = last_ts.normalize() if last_ts is not None else pd.Timestamp(start_date)
+        requests = retries = rows = 0
+        try:
+            for window_start, window_end in date_windows(start, pd.Timestamp(end_date), self.window_days):
+                bars, attempts = await self._request(code, window_start, window_end)
+                requests += 1
+                retries += attempts
+                added, last_ts = await asyncio.to_thread(append_min_bars, path, bars, last_ts)
+                rows += added
+        except FetchError as e:
+            return FetchResult(code, requests, retries, rows, last_ts, str(e))
+        return FetchResult(code, requests, retries, rows, last_ts, None)
+
+    async def fetch_all(self, codes, start_date, end_date):
+        """
+        下載多檔股票, 同時最多 concurrency 檔。
+
+        Returns:
+            list: 每檔股票的 FetchResult, 順序與 codes 相同。
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run(code):
+            async with semaphore:
+                return await self.fetch_code(code, start_date, end_date)
+
+        return await asyncio.gather(*(run(code) for code in codes))
@@ -0,0 +1,342 @@
+#!/usr/bin/python3
+"""
+以內容定址的指標快取。
+
+IndicatorPipeline.run(df, cache=...) 的每個指標以下列內容的雜湊值當作鍵:
+股票代號、日期、指標名稱、指標程式碼的版本、均線累加狀態, 以及每個輸入欄位的鍵。
+原始欄位 (Open、High ...) 的鍵是欄位內容與日期的雜湊值, 其他指標算出來的欄位則沿用該指標的鍵,
+所以輸入的K棒或任何上游指標的程式碼改變時, 只有受影響的指標需要重算。
+
+指標程式碼的版本是指標函式以及它呼叫的同套件函式 (包含以 day_schema.values 這種方式呼叫的其他模組)
+與常數的原始碼雜湊值, 改了 set_concentrated 只會讓聚集與後面用到聚集的指標失效。
+
+算好的欄位存在兩層:
+- 進程內的 LRU, 超過 memory_bytes 時丟掉最久沒用到的結果;
+- 硬碟上的欄位式儲存, 每個鍵一個資料夾, 每個欄位一個 .npy 檔, 寫完整個資料夾才改名,
+  多個進程同時寫同一個鍵也不會讀到寫了一半的結果。prune() 依最後使用時間刪到 disk_bytes 以內。
+"""
+
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import types
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# 儲存格式版本, 格式改變時要跟著改
+CACHE_VERSION = 2
+
+# 字串欄位中的空值, 存檔時記錄每一格是哪一種 (0 代表不是空值), 讀回時還原成同一種
+NULL_VALUES = (np.nan, None, pd.NA, pd.NaT)
+
+# 預設的進程內快取大小
+DEFAULT_MEMORY_BYTES = 256 * 2**20
+
+
+def _code_names(code):
+    """
+    回傳程式碼物件 (包含內部的 lambda 與函式) 用到的所有全域名稱。
+    """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _code_names(const)
+    return names
+
+
+def _package(module_name):
+    return module_name.split('.', 1)[0]
+
+
+def _hash_constant(sha1, name, value):
+    if isinstance(value, (int, float, str, tuple, frozenset)):
+        sha1.update(f'{name}={value!r}'.encode('utf-8'))
+
+
+def code_version(func):
+    """
+    計算指標函式的程式碼版本。
+
+    包含函式本身的原始碼與預設參數, 以及它直接或間接呼叫的同套件函式的原始碼與用到的常數;
+    以模組屬性呼叫的函式與常數 (例如 day_schema.values、day_schema.PRICE_SCALE) 也包含在內。
+
+    Args:
+        func (callable): Indicator.func。
+
+    Returns:
+        str: sha1 雜湊值。
+    """
+    package = _package(func.__module__)
+    sha1 = hashlib.sha1()
+    seen = set()
+    stack = [func]
+    while stack:
+        f = stack.pop()
+        if id(f) in seen:
+            continue
+        seen.add(id(f))
+        try:
+            sha1.update(inspect.getsource(f).encode('utf-8'))
+        except (OSError, TypeError):
+            sha1.update(f.__qualname__.encode('utf-8'))
+        # 預設參數 (例如 band=CONCENTRATED_BAND) 在定義時就決定了, 原始碼中看不到數值
+        sha1.update(repr((f.__defaults__, f.__kwdefaults__)).encode('utf-8'))
+        module_globals = getattr(f, '__globals__', {})
+        names = sorted(_code_names(f.__code__))
+        for name in names:
+            value = module_globals.get(name)
+            if isinstance(value, types.FunctionType) and _package(value.__module__) == package:
+                stack.append(value)
+            elif isinstance(value, types.ModuleType) and _package(value.__name__) == package:
+                # 屬性名稱也在 co_names 中, 取出該模組中同名的函式與常數
+                for attr in names:
+                    member = getattr(value, attr, None)
+                    if isinstance(member, types.FunctionType) and member.__module__ == value.__name__:
+                        stack.append(member)
+                    else:
+                        _hash_constant(sha1, f'{value.__name__}.{attr}', member)
+            else:
+                _hash_constant(sha1, name, value)
+    return sha1.hexdigest()
+
+
+def _null_codes(values):
+    """
+    字串欄位每一格的空值種類, 對應 NULL_VALUES 的位置加 1, 不是空值為 0。
+    """
+    null = pd.isna(values)
+    codes = np.zeros(len(values), dtype=np.int8)
+    for i in np.flatnonzero(null):
+        value = values[i]
+        if value is None:
+            codes[i] = 2
+        elif value is pd.NA:
+            codes[i] = 3
+        elif value is pd.NaT:
+            codes[i] = 4
+        else:
+            codes[i] = 1
+    return codes
+
+
+def _nbytes(values):
+    """
+    估計欄位使用的記憶體, 字串欄位以每個元素的長度估計。
+    """
+    if values.dtype == object:
+        return sum(len(v) if isinstance(v, str) else 8 for v in values) + values.nbytes
+    return values.nbytes
+
+
+def _directory_bytes(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+class IndicatorCache:
+    """
+    指標結果的快取, 記憶體一層, 硬碟一層。
+
+    Attributes:
+        hits (int): 從快取取得的指標數。
+        misses (int): 重新計算的指標數。
+    """
+
+    def __init__(self, path=None, memory_bytes=DEFAULT_MEMORY_BYTES, disk_bytes=None):
+        """
+        Args:
+            path (str): 硬碟快取的資料夾, 為 None 時只用進程內的快取。
+            memory_bytes (int): 進程內快取的大小上限, 0 代表不在記憶體保留。
+            disk_bytes (int): prune() 時硬碟快取的大小上限, 為 None 時不刪除。
+        """
+        self.path = path
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lru = OrderedDict()
+        self._lru_bytes = 0
+        self._versions = {}
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    # 鍵
+
+    @staticmethod
+    def index_key(df):
+        """
+        日期的雜湊值, 只用到日期的指標 (例如 Previous Index) 也需要。
+        """
+        return hashlib.sha1(pd.util.hash_pandas_object(df.index).to_numpy().tobytes()).hexdigest()
+
+    @staticmethod
+    def column_key(df, col):
+        """
+        原始欄位的鍵: 欄位型別、內容與日期的雜湊值。
+        """
+        sha1 = hashlib.sha1(str(df[col].dtype).encode('utf-8'))
+        sha1.update(pd.util.hash_pandas_object(df[col], index=True).to_numpy().tobytes())
+        return sha1.hexdigest()
+
+    def step_key(self, code, index_key, indicator, input_keys, ma_states=None):
+        """
+        指標的鍵。
+
+        Args:
+            code (str): 股票代號。
+            index_key (str): index_key() 的日期雜湊值。
+            indicator (Indicator): 指標宣告。
+            input_keys (list): 每個輸入欄位的鍵, 順序與 indicator.inputs 相同。
+            ma_states (dict): 均線的累加狀態。
+
+        Returns:
+            str: sha1 雜湊值。
+        """
+        version = self._versions.get(indicator.name)
+        if version is None:
+            version = self._versions[indicator.name] = code_version(indicator.func)
+        sha1 = hashlib.sha1()
+        for part in (CACHE_VERSION, code, index_key, indicator.name, version, indicator.outputs, input_keys):
+            sha1.update(repr(part).encode('utf-8'))
+            sha1.update(b'\0')
+        if ma_states:
+            sha1.update(json.dumps(ma_states, sort_keys=True).encode('utf-8'))
+        return sha1.hexdigest()
+
+    # 讀寫
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def _remember(self, key, columns):
+        if self.memory_bytes <= 0:
+            return
+        size = sum(_nbytes(values) for values in columns.values())
+        if key in self._lru:
+            self._lru_bytes -= self._lru.pop(key)[1]
+        self._lru[key] = (columns, size)
+        self._lru_bytes += size
+        while self._lru_bytes > self.memory_bytes and self._lru:
+            _, (_, old_size) = self._lru.popitem(last=False)
+            self._lru_bytes -= old_size
+
+    def _load(self, key):
+        path = self._entry_path(key)
+        try:
+            with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            columns = {}
+            for i, col in enumerate(meta['columns']):
+                values = np.load(os.path.join(path, f'{i}.npy'), allow_pickle=False)
+                if col['null'] is not None:
+                    codes = np.load(os.path.join(path, f'{i}.null.npy'), allow_pickle=False)
+                    values = values.astype(object)
+                    for code, null_value in enumerate(NULL_VALUES, 1):
+                        values[codes == code] = null_value
+                columns[col['name']] = values
+            # 更新最後使用時間, prune() 依這個時間刪除
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            return None
+        return columns
+
+    def _store(self, key, columns):
+        path = self._entry_path(key)
+        if os.path.isdir(path):
+            return
+        for values in columns.values():
+            # 只有字串與空值的 object 欄位可以不用 pickle 存檔, 其他的只留在記憶體
+            if values.dtype == object and not all(isinstance(v, str) for v in values[~pd.isna(values)]):
+                return
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        os.makedirs(tmp_path)
+        meta = {'version': CACHE_VERSION, 'columns': []}
+        for i, (name, values) in enumerate(columns.items()):
+            null = None
+            if values.dtype == object:
+                # 字串欄位存成固定長度的字串陣列與空值種類, 不需要 pickle
+                codes = _null_codes(values)
+                np.save(os.path.join(tmp_path, f'{i}.null.npy'), codes, allow_pickle=False)
+                null = codes > 0
+                values = np.where(null, '', values).astype(str)
+            np.save(os.path.join(tmp_path, f'{i}.npy'), values, allow_pickle=False)
+            meta['columns'].append({'name': name, 'null': None if null is None else f'{i}.null.npy'})
+        with open(os.path.join(tmp_path, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # 其他進程已經寫好同一個鍵
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def get(self, key):
+        """
+        取得指標算好的欄位。
+
+        Returns:
+            dict: 欄位名稱對應的 np.ndarray, 沒有快取時回傳 None。
+        """
+        if key in self._lru:
+            self._lru.move_to_end(key)
+            self.hits += 1
+            return self._lru[key][0]
+        columns = self._load(key) if self.path is not None else None
+        if columns is None:
+            self.misses += 1
+            return None
+        self._remember(key, columns)
+        self.hits += 1
+        return columns
+
+    def put(self, key, df, outputs):
+        """
+        保存指標算好的欄位。
+
+        Args:
+            key (str): step_key() 的鍵。
+            df (pd.DataFrame): 已經算好指標的資料。
+            outputs (iterable): 要保存的欄位。
+        """
+        columns = {col: df[col].to_numpy(copy=True) for col in outputs}
+        self._remember(key, columns)
+        if self.path is not None:
+            self._store(key, columns)
+
+    def clear_memory(self):
+        self._lru.clear()
+        self._lru_bytes = 0
+
+    def prune(self, disk_bytes=None):
+        """
+        刪除最久沒用到的硬碟快取, 直到總大小不超過 disk_bytes。
+
+        Args:
+            disk_bytes (int): 大小上限, 為 None 時使用建立時的設定。
+
+        Returns:
+            int: 刪除的項目數。
+        """
+        disk_bytes = self.disk_bytes if disk_bytes is None else disk_bytes
+        if self.path is None or disk_bytes is None:
+            return 0
+        entries = []
+        for prefix in os.scandir(self.path):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                if entry.is_dir() and not entry.name.endswith('.tmp'):
+                    entries.append((entry.stat().st_mtime_ns, _directory_bytes(entry.path), entry.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in entries:
+            if total <= disk_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed += 1
+        return removed
@@ -2,159 +2,387 @@
 
 import pandas as pd
 import numpy as np
+import math
+from collections import deque, namedtuple
+from utils import profiler
+from utils import day_schema
 
-#
-ma_cols_large = None
-ma_cols_little = None
-set_ma_done = False
-max_ma_large = None
-min_ma_large = None
-diff_ma_large = None
+# 日K的原始欄位
+BASE_COLUMNS = ('Open', 'High', 'Low', 'Close', 'Volume')
 
+# 均線週期
+SMA_PERIODS = (5, 10, 20, 60, 120)
+EMA_PERIODS = (20, 60, 120)
 
-def set_sma(df, n):
+# 區間高低點使用的置中視窗長度
+RANGE_WINDOW = 21
+
+# 用來算均線聚集的均線組合
+MA_COLS_LARGE = ('Close', 'SMA5', 'SMA10', 'SMA20', 'SMA60', 'SMA120', 'EMA20', 'EMA60', 'EMA120')
+MA_COLS_MID = ('Close', 'SMA5', 'SMA10', 'SMA20', 'SMA60', 'EMA20', 'EMA60')
+MA_COLS_LITTLE = ('Close', 'SMA5', 'SMA10', 'SMA20', 'EMA20')
+
+# 均線聚集的門檻: 均線最大值與最小值的差距不超過最大值的這個比例
+CONCENTRATED_BAND = 0.02
+
+# 張嘴排列與閉合排列的倍數
+EXPANSION_FACTOR = 1.1
+CLOGGING_FACTOR = 0.9
+
+# 只放在計算暫存 (env) 中, 不會寫進 DataFrame 的中間結果
+ENV_KEYS = ('ma_envelope',)
+
+
+def sma_state(values, n, state=None):
+    """
+    依照 pandas rolling(window=n).mean() 的 Kahan 累加方式逐筆推進 SMA。
+
+    pandas 的滾動平均會從序列開頭一路累加, 從中間重新開始算會有極小的誤差,
+    四捨五入到小數第二位時可能差一檔, 所以接續計算時要帶著先前的累加狀態。
+
+    Args:
+        values (array-like): 收盤價。
+        n (int): 期間長度。
+        state (tuple): 先前的狀態, 為 None 時從第一筆開始算。
+
+    Returns:
+        tuple: (SMA 陣列, 最後的狀態), 沒有資料時狀態不變。
+    """
+    values = np.asarray(values, dtype=np.float64)
+    sma = np.empty(len(values))
+
+    if state is None:
+        if len(values) == 0:
+            return sma, None
+        nobs = neg_ct = num_same = 0
+        sum_x = compensation_add = compensation_remove = 0.
+        prev_value = float(values[0])
+        window = deque()
+    else:
+        nobs, neg_ct, num_same, sum_x, compensation_add, compensation_remove, prev_value, window = state
+        window = deque(window)
+
+    for i in range(len(values)):
+        val = float(values[i])
+        if len(window) == n:
+            old = window.popleft()
+            if old == old:
+                nobs -= 1
+                y = - old - compensation_remove
+                t = sum_x + y
+                compensation_remove = t - sum_x - y
+                sum_x = t
+                if math.copysign(1., old) < 0:
+                    neg_ct -= 1
+        window.append(val)
+        if val == val:
+            nobs += 1
+            y = val - compensation_add
+            t = sum_x + y
+            compensation_add = t - sum_x - y
+            sum_x = t
+            if math.copysign(1., val) < 0:
+                neg_ct += 1
+            num_same = num_same + 1 if val == prev_value else 1
+            prev_value = val
+
+        if nobs >= n:
+            result = sum_x / nobs
+            if num_same >= nobs:
+                result = prev_value
+            elif neg_ct == 0 and result < 0:
+                result = 0.
+            elif neg_ct == nobs and result > 0:
+                result = 0.
+        else:
+            result = np.nan
+        sma[i] = result
+    return sma, (nobs, neg_ct, num_same, sum_x, compensation_add, compensation_remove, prev_value, list(window))
+# End of sma_state
+
+
+def set_sma(df, n, state=None):
     """
     用來算SMA
 
+    state 是 sma_state() 回傳的狀態, 有給時 df 視為接在該狀態之後的資料。
+
     """
-    df[f'SMA{n}'] = df['Close'].rolling(window=n).mean().round(2)
+    if state is None:
+        df[f'SMA{n}'] = df['Close'].rolling(window=n).mean().round(2)
+    else:
+        df[f'SMA{n}'] = np.round(sma_state(df['Close'].to_numpy(), n, state)[0], 2)
 # End of set_sma
 
 
-def set_ema(df, n):
+def ema_state(values, n, state=None):
+    """
+    依照 pandas ewm(span=n, adjust=True).mean() 的遞迴式逐筆推進 EMA。
+
+    運算順序與 pandas 相同, 所以接續先前的狀態算出來的值與一次算完整段資料完全一致。
+
+    Args:
+        values (array-like): 收盤價。
+        n (int): 期間長度。
+        state (tuple): 先前的狀態 (weighted, old_wt), 為 None 時從第一筆開始算。
+
+    Returns:
+        tuple: (EMA 陣列, 最後的狀態), 沒有資料時狀態不變。
+    """
+    alpha = 1. / (1. + (n - 1) / 2.0)
+    old_wt_factor = 1. - alpha
+    values = np.asarray(values, dtype=np.float64)
+    ema = np.empty(len(values))
+
+    start = 0
+    if state is None:
+        if len(values) == 0:
+            return ema, None
+        weighted = float(values[0])
+        old_wt = 1.
+        ema[0] = weighted
+        start = 1
+    else:
+        weighted, old_wt = state
+
+    for i in range(start, len(values)):
+        cur = values[i]
+        old_wt *= old_wt_factor
+        if weighted != cur:
+            weighted = old_wt * weighted + cur
+            weighted /= (old_wt + 1.)
+        old_wt += 1.
+        ema[i] = weighted
+    return ema, (float(weighted), float(old_wt))
+# End of ema_state
+
+
+def set_ema(df, n, state=None):
     """
     計算指數移動平均 (EMA)
 
     參數：
     df: 包含價格資料的 DataFrame, 至少包含 'Close' 欄位
     n: 期間長度
+    state: ema_state() 回傳的狀態, 有給時 df 視為接在該狀態之後的資料
 
     回傳：
     None( 會在原始 DataFrame 中添加一個名為 'EMA{n}' 的新欄位 )
     """
-    df[f'EMA{n}'] = df['Close'].ewm(span=n).mean().round(2)
+    if state is None:
+        df[f'EMA{n}'] = df['Close'].ewm(span=n).mean().round(2)
+    else:
+        df[f'EMA{n}'] = np.round(ema_state(df['Close'].to_numpy(), n, state)[0], 2)
 
 # End of set_ema
 
 
-def set_ma(df):
+def index_strings(index):
+    """
+    將K棒的時間轉成字串, 日K以上只留日期, 分鐘K棒保留時間。
+
+    """
+    index = pd.DatetimeIndex(index)
+    if len(index) and (index != index.normalize()).any():
+        return index.strftime('%Y-%m-%d %H:%M:%S')
+    return index.strftime('%Y-%m-%d')
+# End of index_strings
+
+
+def set_previous_index(df):
+    """
+    用來算前一根K棒的日期
+
+    """
+    previous_index = np.full(len(df), pd.NA, dtype=object)
+    previous_index[1:] = index_strings(df.index)[:-1]
+    df['Previous Index'] = previous_index
+# End of set_previous_index
+
+
+def set_ma(df, ma_states=None):
     """
     用來算MA
 
+    Args:
+        df (pd.DataFrame): 日K資料。
+        ma_states (dict): 均線欄位對應 sma_state() / ema_state() 的狀態, 用來接續先前算到一半的均線。
     """
-    global ma_cols_large
-    global ma_cols_little
-    global set_ma_done
-    global max_ma_large
-    global min_ma_large
-    global diff_ma_large
-    global max_ma_mid
-    global min_ma_mid
-    global diff_ma_mid
-    global max_ma_little
-    global min_ma_little
-    global diff_ma_little
-    set_sma(df, 5)
-    set_sma(df, 10)
-    set_sma(df, 20)
-    set_sma(df, 60)
-    set_sma(df, 120)
-    set_ema(df, 20)
-    set_ema(df, 60)
-    set_ema(df, 120)
-
-    ma_cols_large = ['Close', 'SMA5', 'SMA10', 'SMA20', 'SMA60', 'SMA120', 'EMA20', 'EMA60', 'EMA120']
-    ma_cols_mid = ['Close', 'SMA5', 'SMA10', 'SMA20', 'SMA60', 'EMA20', 'EMA60']
-    ma_cols_little = ['Close', 'SMA5', 'SMA10', 'SMA20', 'EMA20']
-    max_ma_large = df[ma_cols_large].max(axis=1)
-    min_ma_large = df[ma_cols_large].min(axis=1)
-    max_ma_mid = df[ma_cols_mid].max(axis=1)
-    min_ma_mid = df[ma_cols_mid].min(axis=1)
-    max_ma_little = df[ma_cols_little].max(axis=1)
-    min_ma_little = df[ma_cols_little].min(axis=1)
-    diff_ma_large = max_ma_large - min_ma_large
-    diff_ma_mid = max_ma_mid - min_ma_mid
-    diff_ma_little = max_ma_little - min_ma_little
-
-    # ma_cols_large = ['SMA5', 'SMA10', 'SMA20', 'SMA60', 'SMA120', 'EMA20', 'EMA60', 'EMA120']
-    # ma_cols_mid = ['SMA5', 'SMA10', 'SMA20', 'SMA60', 'EMA20', 'EMA60']
-    # ma_cols_little = ['SMA5', 'SMA10', 'SMA20', 'EMA20']
-    # max_ma_large = df[ma_cols_large].max(axis=1)
-    # max_ma_mid = df[ma_cols_mid].max(axis=1)
-    # max_ma_little = df[ma_cols_little].max(axis=1)
-    set_ma_done = True
-# End of set_sma
+    ma_states = ma_states or {}
+    for n in SMA_PERIODS:
+        set_sma(df, n, ma_states.get(f'SMA{n}'))
+    for n in EMA_PERIODS:
+        set_ema(df, n, ma_states.get(f'EMA{n}'))
+# End of set_ma
 
 
-def set_concentrated(df):
+def ma_states_at(close, end, start=0, ma_states=None):
     """
-    用來算聚集
+    算出第 end 根 (含) 為止所有均線的累加狀態。
+
+    Args:
+        close (np.ndarray): 收盤價。
+        end (int): 最後一根的位置。
+        start (int): ma_states 之後的第一根位置, ma_states 為 None 時必須是 0。
+        ma_states (dict): 第 start 根之前的均線狀態。
+
+    Returns:
+        dict: 均線欄位對應的狀態。
+    """
+    ma_states = ma_states or {}
+    values = close[start:end + 1]
+    states = {}
+    for n in SMA_PERIODS:
+        states[f'SMA{n}'] = sma_state(values, n, ma_states.get(f'SMA{n}'))[1]
+    for n in EMA_PERIODS:
+        states[f'EMA{n}'] = ema_state(values, n, ma_states.get(f'EMA{n}'))[1]
+    return states
+# End of ma_states_at
+
+
+def ma_envelope(df, cols):
+    """
+    計算一組均線的最大值、最小值與差距。
 
+    Args:
+        df (pd.DataFrame): 已經算好均線的日K資料。
+        cols (tuple): 均線欄位。
+
+    Returns:
+        tuple: (最大值, 最小值, 差距) 三個 pd.Series。
     """
-    if not set_ma_done:
-        set_ma(df)
+    ma = day_schema.frame_values(df, cols)
+    max_ma = ma.max(axis=1)
+    min_ma = ma.min(axis=1)
+    return max_ma, min_ma, max_ma - min_ma
+# End of ma_envelope
+
 
-    # df['均線聚集'] = (diff_ma_large <= max_ma_large *
-    #               0.02) & (~df.isnull().any(axis=1))
+def ma_envelopes(df, env=None):
+    """
+    取得長、中、短三組均線包絡線, 同一個 env 內只算一次。
 
-    df['均線聚集'] = (~df.isnull().any(axis=1) &
-                  (diff_ma_large <= max_ma_large * 0.02))
+    Args:
+        df (pd.DataFrame): 日K資料, 還沒有均線時會先算均線。
+        env (dict): 單一 DataFrame 的計算暫存, 為 None 時直接計算。
 
-    df['中均線聚集'] = (~df.isnull().any(axis=1) &
-                   ((diff_ma_mid <= max_ma_mid * 0.02) &
-                   (df['EMA120'] > df['SMA120'])))
-    # df['短均線聚集'] = (~df.isnull().any(axis=1) &
-    #                ((diff_ma_little <= max_ma_little * 0.21)))
+    Returns:
+        dict: 'large'、'mid'、'little' 對應 ma_envelope 的結果。
+    """
+    if env is None:
+        env = {}
+    if 'ma_envelope' not in env:
+        if not set(MA_COLS_LARGE).issubset(df.columns):
+            set_ma(df)
+        env['ma_envelope'] = {
+            'large': ma_envelope(df, MA_COLS_LARGE),
+            'mid': ma_envelope(df, MA_COLS_MID),
+            'little': ma_envelope(df, MA_COLS_LITTLE),
+        }
+    return env['ma_envelope']
+# End of ma_envelopes
+
+
+def concentrated_masks(df, env=None, band=CONCENTRATED_BAND):
+    """
+    計算三種均線聚集的布林陣列。
+
+    band 可以是 shape (K, 1) 的陣列, 透過 broadcasting 一次算出 K 種門檻的結果, 均線包絡線只算一次。
+
+    Args:
+        df (pd.DataFrame): 已經算好均線的日K資料。
+        env (dict): 單一 DataFrame 的計算暫存。
+        band (float | np.ndarray): 均線聚集的門檻。
+
+    Returns:
+        dict: '均線聚集'、'中均線聚集'、'短均線聚集' 對應 (len(df),) 或 (K, len(df)) 的布林陣列。
+    """
+    envelope = ma_envelopes(df, env)
+    max_ma_large, _, diff_ma_large = (s.to_numpy() for s in envelope['large'])
+    max_ma_mid, _, diff_ma_mid = (s.to_numpy() for s in envelope['mid'])
+    max_ma_little, _, diff_ma_little = (s.to_numpy() for s in envelope['little'])
+    ma = {col: day_schema.values(df, col) for col in ('SMA20', 'SMA60', 'SMA120', 'EMA20', 'EMA60', 'EMA120')}
+
+    # 所有均線都算得出來才算聚集
+    ma_ready = df[list(MA_COLS_LARGE)].notna().all(axis=1).to_numpy()
+
+    return {
+        '均線聚集': (ma_ready &
+                 (diff_ma_large <= max_ma_large * band)),
+        '中均線聚集': (ma_ready &
+                  ((diff_ma_mid <= max_ma_mid * band) &
+                   (ma['EMA120'] > ma['SMA120']))),
+        '短均線聚集': (ma_ready &
+                  ((diff_ma_little <= max_ma_little * band) &
+                   (ma['EMA20'] > ma['EMA60']) & (ma['SMA20'] > ma['SMA60']) &
+                   ((ma['EMA60'] > ma['EMA120']) | (ma['EMA120'] > ma['SMA120'])))),
+    }
+# End of concentrated_masks
+
+
+def set_concentrated(df, env=None, band=CONCENTRATED_BAND):
+    """
+    用來算聚集
 
-    df['短均線聚集'] = (~df.isnull().any(axis=1) &
-                   ((diff_ma_little <= max_ma_little * 0.02) &
-                   (df['EMA20'] > df['EMA60']) & (df['SMA20'] > df['SMA60']) &
-                   ((df['EMA60'] > df['EMA120']) | (df['EMA120'] > df['SMA120']))))
+    """
+    for col, mask in concentrated_masks(df, env, band).items():
+        df[col] = mask
 
 # End of set_concentrated
 
 
-def set_breakthrough(df):
+def breakthrough_masks(df, concentrated, env=None):
     """
-    用來算聚集 突破
+    計算三種均線聚集後突破的布林陣列: 聚集且收盤價是均線包絡線的最大值。
+
+    Args:
+        df (pd.DataFrame): 已經算好均線的日K資料。
+        concentrated (dict): concentrated_masks 的結果, 可以是 (K, len(df)) 的陣列。
+        env (dict): 單一 DataFrame 的計算暫存。
 
+    Returns:
+        dict: '均線聚集後突破'、'中均線聚集後突破'、'短均線聚集後突破' 對應的布林陣列。
     """
-    if not set_ma_done:
-        set_ma(df)
+    envelope = ma_envelopes(df, env)
+    close = day_schema.values(df, 'Close')
+    return {
+        '均線聚集後突破': concentrated['均線聚集'] & (close == envelope['large'][0].to_numpy()),
+        '中均線聚集後突破': concentrated['中均線聚集'] & (close == envelope['mid'][0].to_numpy()),
+        '短均線聚集後突破': concentrated['短均線聚集'] & (close == envelope['little'][0].to_numpy()),
+    }
+# End of breakthrough_masks
 
-    df['均線聚集後突破'] = (df['均線聚集']) & (df['Close'] == max_ma_large)
 
-    df['中均線聚集後突破'] = (df['中均線聚集']) & (df['Close'] == max_ma_mid)
+def set_breakthrough(df, env=None):
+    """
+    用來算聚集 突破
 
-    df['短均線聚集後突破'] = (df['短均線聚集']) & (df['Close'] == max_ma_little)
+    """
+    concentrated = {col: df[col].to_numpy(dtype=bool) for col in ('均線聚集', '中均線聚集', '短均線聚集')}
+    for col, mask in breakthrough_masks(df, concentrated, env).items():
+        df[col] = mask
 
 # End of set_breakthrough
 
 
-def set_expansion(df):
+def set_expansion(df, factor=EXPANSION_FACTOR):
     """
     用來算突破後的張嘴排列
 
     """
-    if not set_ma_done:
-        set_ma(df)
-
     df['Expansion'] = ((df['均線聚集後突破']) &
-                       ((df['Close'] * 2 * 1.1) > (df['Close'].shift(20)*3 - df['Close'].shift(60))))
+                       ((df['Close'] * 2 * factor) > (df['Close'].shift(20)*3 - df['Close'].shift(60))))
 
 # End of set_expansion
 
 
-def set_clogging(df):
+def set_clogging(df, factor=CLOGGING_FACTOR):
     """
     用來算閉合排列
 
     """
-    if not set_ma_done:
-        set_ma(df)
-
     df['Clogging'] = (
-        ((df['Close'] * 0.9 * 2) < (df['Close'].shift(20)*3 - df['Close'].shift(60))))
+        ((df['Close'] * factor * 2) < (df['Close'].shift(20)*3 - df['Close'].shift(60))))
 
 # End of set_clogging
 
@@ -166,7 +394,7 @@ def set_range_high(df):
     """
 
     df['區間高點'] = (df['High'] >= df['High'].rolling(
-        window=21, center=True).max())
+        window=RANGE_WINDOW, center=True).max())
 # End of set_range_high
 
 
@@ -174,26 +402,34 @@ def set_high_point_connection(df):
     """
     用來算區間高點連線
 
+    以最近兩個區間高點 (不含第一筆資料) 的連線延伸到每一筆資料,
+    全部以 NumPy 陣列一次計算, 不逐筆讀寫 DataFrame。
+
     """
-    df['高點連線'] = pd.NA
-    pre_high = 0
-    pre_high_diff = 0
-    cnt = 0
-    pre_cnt = 0
-    pre_pre_cnt = 0
-    pre_cnt_diff = 0
+    n = len(df)
+    high = df['High'].to_numpy(dtype=np.float64)
+    is_pivot = df['區間高點'].to_numpy(dtype=bool).copy()
+    if n > 0:
+        is_pivot[0] = False  # 原本的逐筆計算從第二筆開始
+
+    pos = np.arange(n)
+    pivot_pos = np.flatnonzero(is_pivot)
 
-    for i in df.index[1:]:
-        cnt += 1
-        if (df.loc[i, '區間高點']):
-            pre_high_diff = (df.loc[i, 'High'] - pre_high)
-            pre_high = df.loc[i, 'High']
-            pre_pre_cnt = pre_cnt
-            pre_cnt = cnt
-            pre_cnt_diff = pre_cnt - pre_pre_cnt
+    # 最近一個高點與再前一個高點的位置 (往後填補)
+    last_pos = np.full(n, -1)
+    last_pos[pivot_pos] = pivot_pos
+    last_pos = np.maximum.accumulate(last_pos)
+    prev_pos = np.full(n, -1)
+    prev_pos[pivot_pos[1:]] = pivot_pos[:-1]
+    prev_pos = np.maximum.accumulate(prev_pos)
 
-        if (pre_pre_cnt != 0):
-            df.loc[i, '高點連線'] = round(pre_high + (pre_high_diff)/(pre_cnt_diff)*(cnt-pre_cnt), 2)
+    line = np.full(n, np.nan)
+    valid = prev_pos >= 0
+    last_high = high[last_pos[valid]]
+    slope = (last_high - high[prev_pos[valid]]) / (last_pos[valid] - prev_pos[valid])
+    line[valid] = np.round(last_high + slope * (pos[valid] - last_pos[valid]), 2)
+
+    df['高點連線'] = line
 
 
 # End of set_high_point_connection
@@ -205,33 +441,53 @@ def set_range_low(df):
 
     """
     df['區間低點'] = (df['Low'] <= df['Low'].rolling(
-        window=21, center=True).min())
+        window=RANGE_WINDOW, center=True).min())
 # End of set_range_low
 
 
-def set_over_high(df):
+def _previous_pivot(df, pivot_col, value_col):
     """
-    用來算過前高
+    找出每一筆資料之前最近的一個區間高/低點。
+
+    將區間高/低點遮罩往後平移一根 K 棒後往後填補, 一次算出全部資料的前一個轉折點。
 
+    Args:
+        df (pd.DataFrame): 日K資料。
+        pivot_col (str): 轉折點旗標欄位, 例如 '區間高點'。
+        value_col (str): 轉折點價格欄位, 例如 'High'。
+
+    Returns:
+        tuple: (前一個轉折點價格, 前一個轉折點日期字串), 沒有轉折點時為 NaN。
     """
-    df['前高'] = pd.NA
-    df['前高 Index'] = pd.NA
-    df['過前高'] = False
+    n = len(df)
+    values = df[value_col].to_numpy(dtype=np.float64)
+    is_pivot = df[pivot_col].to_numpy(dtype=bool).copy()
+    if n > 0:
+        is_pivot[0] = False  # 原本的逐筆計算從第二筆開始
+
+    # 往後平移一根 K 棒, 當根的轉折點要到下一根才算前高/前低
+    last_pos = np.full(n, -1)
+    last_pos[1:] = np.where(is_pivot[:-1], np.arange(n - 1), -1)
+    last_pos = np.maximum.accumulate(last_pos)
+
+    has_pivot = last_pos >= 0
+    pre_value = np.full(n, np.nan)
+    pre_value[has_pivot] = values[last_pos[has_pivot]]
+    pre_idx = np.full(n, np.nan, dtype=object)
+    pre_idx[has_pivot] = index_strings(df.index).to_numpy()[last_pos[has_pivot]]
+    return pre_value, pre_idx
+# End of _previous_pivot
 
-    pre_high_idx = np.nan
-    pre_high = np.nan
-    for i in df.index[1:]:
-        df.loc[i, '前高 Index'] = pre_high_idx
-        df.loc[i, '前高'] = pre_high
 
-        if (pre_high != np.nan and df.loc[i, 'High'] > pre_high):
-            df.loc[i, '過前高'] = True
-        else:
-            df.loc[i, '過前高'] = False
+def set_over_high(df):
+    """
+    用來算過前高
 
-        if (df.loc[i, '區間高點']):
-            pre_high = df.loc[i, 'High']
-            pre_high_idx = i.strftime('%Y-%m-%d')
+    """
+    pre_high, pre_high_idx = _previous_pivot(df, '區間高點', 'High')
+    df['前高'] = pre_high
+    df['前高 Index'] = pre_high_idx
+    df['過前高'] = df['High'].to_numpy() > pre_high
 
 
 # End of set_over_high
@@ -242,25 +498,188 @@ def set_below_low(df):
     用來算破底
 
     """
+    pre_low, pre_low_idx = _previous_pivot(df, '區間低點', 'Low')
+    df['前低'] = pre_low
+    df['前低 Index'] = pre_low_idx
+    df['破底'] = df['Low'].to_numpy() < pre_low
 
-    df['前低'] = pd.NA
-    df['前低 Index'] = pd.NA
-    df['破底'] = False
 
-    pre_low_idx = np.nan
-    pre_low = np.nan
-    for i in df.index[1:]:
-        df.loc[i, '前低 Index'] = pre_low_idx
-        df.loc[i, '前低'] = pre_low
+# End of set_below_low
 
-        if (pre_low != np.nan and df.loc[i, 'Low'] < pre_low):
-            df.loc[i, '破底'] = True
-        else:
-            df.loc[i, '破底'] = False
 
-        if (df.loc[i, '區間低點']):
-            pre_low = df.loc[i, 'Low']
-            pre_low_idx = i.strftime('%Y-%m-%d')
+# Indicator 用來宣告一個指標:
+#   name:    指標名稱
+#   inputs:  需要的欄位 (或 env 中的暫存, 例如 'ma_envelope')
+#   outputs: 產生的欄位 (或 env 中的暫存)
+#   func:    func(df, env), env 是單一 DataFrame 的計算暫存
+Indicator = namedtuple('Indicator', ['name', 'inputs', 'outputs', 'func'])
+
+# 日K使用的所有指標, 依照輸出到 _day.csv 的欄位順序排列
+DAY_K_INDICATORS = (
+    # 前一根K棒
+    Indicator('previous_index', (), ('Previous Index',),
+              lambda df, env: set_previous_index(df)),
+    # 計算均線
+    Indicator('ma', ('Close',),
+              tuple(f'SMA{n}' for n in SMA_PERIODS) + tuple(f'EMA{n}' for n in EMA_PERIODS),
+              lambda df, env: set_ma(df, env.get('ma_states'))),
+    # 均線包絡線, 聚集與突破共用
+    Indicator('ma_envelope', MA_COLS_LARGE, ('ma_envelope',),
+              ma_envelopes),
+    # 聚集
+    Indicator('concentrated', MA_COLS_LARGE + ('ma_envelope',),
+              ('均線聚集', '中均線聚集', '短均線聚集'),
+              set_concentrated),
+    # 聚集 突破
+    Indicator('breakthrough', ('Close', 'ma_envelope', '均線聚集', '中均線聚集', '短均線聚集'),
+              ('均線聚集後突破', '中均線聚集後突破', '短均線聚集後突破'),
+              set_breakthrough),
+    # 張嘴排列
+    Indicator('expansion', ('Close', '均線聚集後突破'), ('Expansion',),
+              lambda df, env: set_expansion(df)),
+    # 閉合排列
+    Indicator('clogging', ('Close',), ('Clogging',),
+              lambda df, env: set_clogging(df)),
+    # 區間高點
+    Indicator('range_high', ('High',), ('區間高點',),
+              lambda df, env: set_range_high(df)),
+    # 高點連線
+    Indicator('high_point_connection', ('High', '區間高點'), ('高點連線',),
+              lambda df, env: set_high_point_connection(df)),
+    # 區間低點
+    Indicator('range_low', ('Low',), ('區間低點',),
+              lambda df, env: set_range_low(df)),
+    # 過前高
+    Indicator('over_high', ('High', '區間高點'), ('前高', '前高 Index', '過前高'),
+              lambda df, env: set_over_high(df)),
+    # 破前低
+    Indicator('below_low', ('Low', '區間低點'), ('前低', '前低 Index', '破底'),
+              lambda df, env: set_below_low(df)),
+)
+
+
+class IndicatorPipeline:
+    """
+    依照指標宣告的輸入欄位解析相依關係, 對每個 DataFrame 各算一次所需的指標。
 
+    物件本身只保存解析好的計算順序, 計算中的暫存 (例如均線包絡線) 都放在每次
+    run() 自己的 env 中, 所以同一個物件可以在長時間執行的 worker 中重複處理多個檔案。
+    """
 
-# End of set_below_low
+    def __init__(self, targets=None, indicators=DAY_K_INDICATORS, given=BASE_COLUMNS):
+        """
+        Args:
+            targets (iterable): 要算的欄位, 為 None 時計算所有指標。
+            indicators (iterable): 可用的指標宣告。
+            given (iterable): 呼叫 run() 時 DataFrame 已經有的欄位。
+        """
+        producers = {}
+        for indicator in indicators:
+            for output in indicator.outputs:
+                producers[output] = indicator
+
+        if targets is None:
+            targets = [output for indicator in indicators for output in indicator.outputs]
+
+        self.given = tuple(given)
+        self.steps = []
+        done = set()
+        visiting = set()
+
+        def visit(name):
+            if name in self.given:
+                return
+            if name not in producers:
+                raise ValueError(f"沒有指標可以產生 {name}")
+            indicator = producers[name]
+            if indicator.name in done:
+                return
+            if indicator.name in visiting:
+                raise ValueError(f"指標相依關係有循環: {indicator.name}")
+            visiting.add(indicator.name)
+            for dependency in indicator.inputs:
+                visit(dependency)
+            visiting.remove(indicator.name)
+            done.add(indicator.name)
+            self.steps.append(indicator)
+
+        for target in targets:
+            visit(target)
+
+    @property
+    def columns(self):
+        """
+        回傳 run() 之後會新增的欄位 (不含 env 中的暫存)。
+        """
+        return [output for indicator in self.steps for output in indicator.outputs
+                if output not in ENV_KEYS]
+
+    def run(self, df, ma_states=None, cache=None, code=''):
+        """
+        在 df 上依序計算所有需要的指標。
+
+        Args:
+            df (pd.DataFrame): 至少包含 given 欄位的 K 線資料, 會直接新增欄位。
+            ma_states (dict): 均線欄位對應的累加狀態, df 是接在這個狀態之後的資料時使用。
+            cache (indicator_cache.IndicatorCache): 有給時輸入與程式碼都沒變的指標直接從快取取得。
+            code (str): 股票代號, 快取的鍵的一部分。
+
+        Returns:
+            pd.DataFrame: 同一個 df。
+        """
+        missing = [col for col in self.given if col not in df.columns]
+        if missing:
+            raise KeyError(f"缺少欄位: {', '.join(missing)}")
+
+        env = {'ma_states': ma_states}
+        if cache is not None:
+            return self._run_cached(df, env, cache, code)
+        for indicator in self.steps:
+            with profiler.stage(f'indicator.{indicator.name}'):
+                indicator.func(df, env)
+        return df
+
+    def _run_cached(self, df, env, cache, code):
+        """
+        依序取得每個指標: 快取中有就直接放進 df, 沒有才計算並存進快取。
+
+        只放在 env 中的暫存 (例如均線包絡線) 不存進快取, 等到有指標需要重新計算時才算。
+        """
+        keys = {}
+        pending = {}
+        index_key = cache.index_key(df)
+
+        def input_key(name):
+            if name not in keys:
+                keys[name] = cache.column_key(df, name)
+            return keys[name]
+
+        def compute(indicator):
+            # 先算出還沒算的 env 暫存
+            for name in indicator.inputs:
+                if name in pending:
+                    compute(pending.pop(name))
+            with profiler.stage(f'indicator.{indicator.name}'):
+                indicator.func(df, env)
+
+        for indicator in self.steps:
+            key = cache.step_key(code, index_key, indicator, [input_key(name) for name in indicator.inputs],
+                                 env['ma_states'])
+            for output in indicator.outputs:
+                keys[output] = f'{key}:{output}'
+            if all(output in ENV_KEYS for output in indicator.outputs):
+                for output in indicator.outputs:
+                    pending[output] = indicator
+                continue
+
+            with profiler.stage('indicator_cache.get'):
+                columns = cache.get(key)
+            if columns is not None:
+                for col in indicator.outputs:
+                    df[col] = columns[col].copy()
+                continue
+            compute(indicator)
+            with profiler.stage('indicator_cache.put'):
+                cache.put(key, df, indicator.outputs)
+        return df
+# End of IndicatorPipeline
@@ -0,0 +1,132 @@
+#!/usr/bin/python3
+"""
+回測的成交紀錄。
+
+回測時每筆成交只在欄位式的陣列尾端加一列 (日期、股票、買賣、張數、價格、手續費、成交後現金與總資產),
+不在交易當下組字串; 需要給人看的報表時才由 report_lines 從紀錄產生。
+"""
+
+import numpy as np
+import pandas as pd
+
+# 買賣方向
+BUY = 1
+SELL = -1
+
+# 欄位與型別
+LEDGER_COLUMNS = {
+    'date': np.int32,        # 交易日在日曆中的位置
+    'code': np.int32,        # 股票在 codes 中的位置
+    'side': np.int8,         # BUY 或 SELL
+    'num': np.int64,         # 張數
+    'price': np.float64,     # 收盤價
+    'price_unit': np.int64,  # 每張價錢
+    'cost': np.int64,        # 買: 這次花費; 賣: 持股總成本
+    'fee': np.int64,         # 這次的手續費
+    'total_fee': np.int64,   # 持股累計的手續費
+    'profit': np.int64,      # 賣出獲利, 買入為 0
+    'cash': np.int64,        # 成交後的現金
+    'assets': np.int64,      # 成交後的總資產
+}
+
+
+class TradeLedger:
+    """
+    只能往後加的欄位式成交紀錄。
+
+    Attributes:
+        dates (pd.DatetimeIndex): 交易日, 'date' 欄位存的是這裡的位置。
+        codes (list): 股票代號, 'code' 欄位存的是這裡的位置。
+    """
+
+    def __init__(self, dates, codes, capacity=1024):
+        self.dates = dates
+        self.codes = list(codes)
+        self._size = 0
+        self._columns = {name: np.zeros(capacity, dtype=dtype) for name, dtype in LEDGER_COLUMNS.items()}
+
+    def __len__(self):
+        return self._size
+
+    def _grow(self):
+        for name, values in self._columns.items():
+            grown = np.zeros(len(values) * 2, dtype=values.dtype)
+            grown[:self._size] = values[:self._size]
+            self._columns[name] = grown
+
+    def append(self, **row):
+        """
+        加入一筆成交, 參數名稱就是 LEDGER_COLUMNS 的欄位名稱, 沒給的欄位為 0。
+        """
+        if self._size == len(self._columns['date']):
+            self._grow()
+        for name, value in row.items():
+            self._columns[name][self._size] = value
+        self._size += 1
+
+    def __getitem__(self, name):
+        """
+        取出單一欄位 (唯讀的 view)。
+        """
+        values = self._columns[name][:self._size]
+        values.flags.writeable = False
+        return values
+
+    def to_frame(self):
+        """
+        轉成 DataFrame, 日期與股票代號換成實際的值。
+
+        Returns:
+            pd.DataFrame: 每列一筆成交。
+        """
+        df = pd.DataFrame({name: self[name] for name in LEDGER_COLUMNS})
+        df['date'] = self.dates[df['date']]
+        df['code'] = np.asarray(self.codes, dtype=object)[df['code']]
+        return df
+
+    def report_lines(self, stock_symbol_name_mapping, with_assets=True):
+        """
+        產生逐筆成交的報表。
+
+        Args:
+            stock_symbol_name_mapping (dict): 股號股名對照表。
+            with_assets (bool): 是否列出成交後的現金與總資產。
+
+        Yields:
+            str: 報表的每一行。
+        """
+        last_date = -1
+        for i in range(self._size):
+            row = {name: values[i] for name, values in self._columns.items()}
+            code = self.codes[row['code']]
+            if row['date'] != last_date:
+                last_date = row['date']
+                yield f"日期:{self.dates[last_date].strftime('%Y-%m-%d')}"
+
+            yield "======================="
+            if row['side'] == SELL:
+                value = row['num'] * row['price_unit']
+                yield f"賣出 {stock_symbol_name_mapping[code]}({code})"
+                yield "-----------------------"
+                yield f"張數：        {row['num']} 張"
+                yield f"單價：        {row['price']:.2f} 元"
+                yield f"總價：        {value} 元"
+                yield f"平均購買單價： {row['cost']/row['num']/1000:.2f} 元"
+                yield f"成本：        {row['cost']} 元"
+                yield f"賣手續：      {row['fee']} 元"
+                yield f"總手續：      {row['total_fee']} 元"
+                yield f"獲利：        {row['profit']} 元 ({row['profit']/(row['cost']+row['total_fee'])*100:.2f}) %"
+            else:
+                yield f"買入 {stock_symbol_name_mapping[code]}({code})"
+                yield "-----------------------"
+                yield f"張數： {row['num']} 張"
+                yield f"單價： {row['price']:.2f} 元"
+                yield f"總價： {row['cost']} 元"
+                yield f"手續： {row['fee']} 元"
+
+            if with_assets:
+                yield "-----------------------"
+                yield f"總持有現金： {row['cash']} 元"
+                yield f"總資產： {row['assets']} 元"
+            yield "======================="
+            yield ""
@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+"""
+日K資料清單。
+
+process_kbars 產生日K時, 在資料夾中寫一份 manifest.csv, 每檔股票一列: 代號、檔名、產業別、
+證券類型、第一天與最後一天、列數以及 _day.csv 的雜湊值。回測時只讀這份清單就能依產業別與代號
+篩選股票並決定日期範圍, 不用列出資料夾、查詢 twstock 或打開任何日K檔。
+"""
+
+import os
+import re
+import pandas as pd
+
+from utils import day_cache
+
+# 清單檔名
+MANIFEST_FILE = 'manifest.csv'
+
+# 清單欄位
+MANIFEST_COLUMNS = ['code', 'path', 'group', 'type', 'first_date', 'last_date', 'rows', 'hash']
+
+# 日K檔名中的股票代號
+DAY_FILE_PATTERN = re.compile(r'(\d+)_day\.csv$')
+
+
+def manifest_path(data_dir):
+    """
+    回傳資料夾中的清單路徑。
+    """
+    return os.path.join(data_dir, MANIFEST_FILE)
+
+
+def stock_info(code):
+    """
+    以 twstock 查詢股票的產業別與證券類型, 查不到時為空字串。
+
+    只有產生清單時才需要 twstock, 所以在這裡才匯入。
+    """
+    import twstock
+    info = twstock.codes.get(code)
+    if info is None:
+        return '', ''
+    return info.group, info.type
+
+
+def day_entry(data_dir, day_file):
+    """
+    產生單一 _day.csv 的清單資料。
+
+    有效的欄位式快取已經記錄了雜湊值與日期, 直接使用; 否則讀 CSV 的日期欄位並計算雜湊值。
+
+    Args:
+        data_dir (str): 資料夾。
+        day_file (str): _day.csv 檔名。
+
+    Returns:
+        dict: 一列清單資料, 檔名中沒有股票代號時回傳 None。
+    """
+    match = DAY_FILE_PATTERN.search(day_file)
+    if match is None:
+        return None
+    code = match.group(1)
+    path = os.path.join(data_dir, day_file)
+
+    cache = day_cache.DayCache.open(path)
+    if cache is not None:
+        index = cache.index
+        file_hash = cache.meta['source']['sha1']
+    else:
+        index = pd.DatetimeIndex(pd.read_csv(path, usecols=[day_cache.INDEX_NAME])[day_cache.INDEX_NAME])
+        file_hash = day_cache.file_hash(path)
+
+    group, stock_type = stock_info(code)
+    return {
+        'code': code,
+        'path': day_file,
+        'group': group,
+        'type': stock_type,
+        'first_date': index[0] if len(index) else pd.NaT,
+        'last_date': index[-1] if len(index) else pd.NaT,
+        'rows': len(index),
+        'hash': file_hash,
+    }
+
+
+def build_manifest(entries):
+    """
+    將 day_entry 的結果組成清單, 依代號排序。
+    """
+    manifest = pd.DataFrame([entry for entry in entries if entry is not None], columns=MANIFEST_COLUMNS)
+    return manifest.sort_values('code', kind='stable').reset_index(drop=True)
+
+
+def read_manifest(data_dir):
+    """
+    讀取清單, 不存在時回傳 None。
+    """
+    path = manifest_path(data_dir)
+    if not os.path.isfile(path):
+        return None
+    # 代號要保留開頭的 0, 查不到的產業別是空字串而不是 NaN
+    manifest = pd.read_csv(path, dtype=str, keep_default_na=False)
+    for col in ('first_date', 'last_date'):
+        manifest[col] = pd.to_datetime(manifest[col])
+    manifest['rows'] = manifest['rows'].astype(int)
+    return manifest
+
+
+def write_manifest(data_dir, manifest):
+    """
+    寫入清單。
+    """
+    path = manifest_path(data_dir)
+    tmp_path = path + '.tmp'
+    manifest[MANIFEST_COLUMNS].to_csv(tmp_path, index=False, date_format='%Y-%m-%d')
+    os.replace(tmp_path, path)
+
+
+def select(manifest, groups, code_pattern='.*', stock_type='股票'):
+    """
+    依產業別、代號與證券類型篩選清單。
+
+    Args:
+        manifest (pd.DataFrame): read_manifest 或 build_manifest 的清單。
+        groups (iterable): 要保留的產業別名稱。
+        code_pattern (str): 代號要符合的正規表示式 (re.match)。
+        stock_type (str): 要保留的證券類型。
+
+    Returns:
+        pd.DataFrame: 篩選後的清單。
+    """
+    pattern = re.compile(code_pattern)
+    keep = (manifest['type'] == stock_type) & manifest['group'].isin(set(groups))
+    keep &= manifest['code'].map(lambda code: pattern.match(code) is not None)
+    return manifest[keep]
+
+
+def date_range(manifest):
+    """
+    回傳清單中所有股票的第一天與最後一天, 清單為空時為 (None, None)。
+    """
+    manifest = manifest[manifest['rows'] > 0]
+    if len(manifest) == 0:
+        return None, None
+    return manifest['first_date'].min(), manifest['last_date'].max()
@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+"""
+提供模擬分K的本地 HTTP 伺服器, 讓 utils.fetcher 不連 Shioaji 也能測試。
+
+GET /kbars?code=<代號>&start=<YYYY-MM-DD>&end=<YYYY-MM-DD> 回傳 _min.csv 格式的分K。每一天的
+資料以 (代號, 日期) 為亂數種子由 utils.synthetic 產生, 只產生請求的區間而且不保留, 同一檔股票同一天
+每次請求都得到同樣的資料, 上千檔股票也不會佔用大量記憶體。可以設定每個請求的延遲、隨機回傳
+429 / 503 的比例、前幾個請求固定失敗或在傳送中途斷線, 以及指定股票固定回傳的狀態碼, 用來測試同時下載、
+流量限制與重試。
+"""
+
+import asyncio
+import math
+import random
+from urllib.parse import urlsplit, parse_qs
+
+import pandas as pd
+
+from utils import synthetic
+from utils.fetcher import MIN_COLUMNS, TS_FORMAT
+
+# 錯誤回應的狀態碼與說明
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 429: 'Too Many Requests',
+               500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class MockServer:
+    """
+    模擬分K的 HTTP 伺服器。
+    """
+
+    def __init__(self, latency=0, fail_rate=0, seed=0, start=synthetic.START_DATE, end=None, fail_first=0,
+                 statuses=None, truncate_first=0):
+        """
+        Args:
+            latency (float): 每個請求延遲的秒數。
+            fail_rate (float): 隨機回傳 429 或 503 的比例。
+            seed (int): 錯誤回應的亂數種子。
+            start (str): 模擬資料的第一個交易日。
+            end (str): 模擬資料的最後一天, 預設為今天。
+            fail_first (int): 前幾個請求固定輪流回傳 429 與 503。
+            statuses (dict): 股票代號對應固定回傳的狀態碼, 例如 {'9999': 404}。
+            truncate_first (int): 接在 fail_first 之後的幾個請求只送出一半的回應就斷線。
+        """
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.rng = random.Random(seed)
+        self.first_date = pd.Timestamp(start)
+        self.last_date = pd.Timestamp(end) if end else pd.Timestamp.today().normalize()
+        self.fail_first = fail_first
+        self.statuses = dict(statuses or {})
+        self.truncate_first = truncate_first
+        self.requests = 0
+        self.failures = 0
+        self._server = None
+
+    @staticmethod
+    def _code_seed(code):
+        return int(code) if code.isdigit() else sum(code.encode())
+
+    def day_bars(self, code, day):
+        """
+        回傳股票某一天的模擬分K。
+
+        亂數種子是 (代號, 日期), 開盤價是以日期緩慢變動的固定函數, 所以每一天可以單獨產生,
+        相鄰兩天的價格仍然接得上。
+        """
+        code_seed = self._code_seed(code)
+        base = 20 + code_seed % 180
+        price = base * math.exp(0.2 * math.sin(day.toordinal() / 40 + code_seed))
+        return synthetic.minute_bars(1, seed=[code_seed, day.toordinal()], start=day, price=price)
+
+    def bars(self, code, start, end):
+        """
+        回傳股票 start 到 end (含) 之間交易日的模擬分K, 超出模擬資料範圍的日期不產生。
+        """
+        days = pd.bdate_range(max(start, self.first_date), min(end, self.last_date))
+        if len(days) == 0:
+            return pd.DataFrame(columns=MIN_COLUMNS)
+        return pd.concat([self.day_bars(code, day) for day in days], ignore_index=True)
+
+    def kbars(self, query):
+        """
+        處理 /kbars 請求, 回傳 (狀態碼, 內容)。
+        """
+        try:
+            code = query['code'][0]
+            start = pd.Timestamp(query['start'][0])
+            end = pd.Timestamp(query['end'][0])
+        except (KeyError, ValueError):
+            return 400, b'code, start and end are required'
+        if code in self.statuses:
+            return self.statuses[code], f'{code}: {STATUS_TEXT.get(self.statuses[code], "")}'.encode('utf-8')
+        bars = self.bars(code, start.normalize(), end.normalize())
+        return 200, bars[MIN_COLUMNS].to_csv(index=False, date_format=TS_FORMAT).encode('utf-8')
+
+    async def handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            # 略過標頭
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            self.requests += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+
+            parts = request.decode('ascii', 'replace').split()
+            url = urlsplit(parts[1] if len(parts) > 1 else '/')
+            if self.requests <= self.fail_first:
+                self.failures += 1
+                status, body = (429, 503)[self.requests % 2], b'try again later'
+            elif self.rng.random() < self.fail_rate:
+                self.failures += 1
+                status, body = self.rng.choice((429, 503)), b'try again later'
+            elif url.path == '/kbars':
+                status, body = self.kbars(parse_qs(url.query))
+            else:
+                status, body = 404, b'not found'
+
+            response = (f"HTTP/1.0 {status} {STATUS_TEXT.get(status, '')}\r\n"
+                        f"Content-Type: text/csv\r\nContent-Length: {len(body)}\r\n\r\n").encode('ascii') + body
+            if self.fail_first < self.requests <= self.fail_first + self.truncate_first:
+                self.failures += 1
+                response = response[:len(response) // 2]
+            writer.write(response)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=0):
+        """
+        開始接受連線, port 為 0 時由系統指定。
+
+        Returns:
+            tuple: 實際的 (host, port)。
+        """
+        self._server = await asyncio.start_server(self.handle, host, port)
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+"""
+日期 × 股票對齊的二維資料表。
+
+每個欄位是一個 (交易日數, 股票數) 的 NumPy 陣列, 另有一個 valid 遮罩標示該股票當天是否有資料,
+回測時每天只需要取一列, 不用再對每檔股票的 DataFrame 做 df.loc 查詢。
+"""
+
+import numpy as np
+import pandas as pd
+
+from utils import day_schema
+
+
+def _fill_value(dtype):
+    """
+    回傳沒有資料的格子要填的值。
+    """
+    if dtype.kind == 'f':
+        return np.nan
+    if dtype.kind == 'M':
+        return np.datetime64('NaT')
+    if dtype.kind == 'b':
+        return False
+    if dtype.kind in 'iu':
+        return 0
+    return None
+
+
+class Panel:
+    """
+    日期 × 股票的對齊資料。
+
+    Attributes:
+        dates (pd.DatetimeIndex): 交易日, 對應陣列的第一維。
+        codes (list): 股票代號, 對應陣列的第二維。
+        valid (np.ndarray): (交易日數, 股票數) 的布林遮罩, 該股票當天有資料時為 True。
+        date_pos (dict): 交易日對應的列位置。
+        code_pos (dict): 股票代號對應的行位置。
+    """
+
+    def __init__(self, dates, codes, fields, valid, rows=None):
+        self.dates = dates
+        self.codes = list(codes)
+        self.fields = fields
+        self.valid = valid
+        self.rows = rows  # 每檔股票原始資料在 Panel 中的列位置, 由 from_df_dict 提供
+        self.date_pos = {date: t for t, date in enumerate(dates)}
+        self.code_pos = {code: j for j, code in enumerate(self.codes)}
+
+    @classmethod
+    def from_df_dict(cls, df_dict, fields=('Close', 'Volume'), dates=None):
+        """
+        由每檔股票的日K資料建立 Panel。
+
+        Args:
+            df_dict (dict): 股票代號對應以 DatetimeIndex 為索引的日K資料。
+            fields (iterable): 要放進 Panel 的欄位。
+            dates (pd.DatetimeIndex): 交易日, 為 None 時使用所有股票日期的聯集。
+
+        Returns:
+            Panel: 建好的 Panel。
+        """
+        codes = list(df_dict)
+        if dates is None:
+            dates = pd.DatetimeIndex([])
+            for df in df_dict.values():
+                dates = dates.union(df.index)
+        dates = pd.DatetimeIndex(dates).sort_values()
+
+        valid = np.zeros((len(dates), len(codes)), dtype=bool)
+        rows = []
+        for j, code in enumerate(codes):
+            pos = dates.get_indexer(df_dict[code].index)
+            found = pos >= 0
+            valid[pos[found], j] = True
+            rows.append((pos[found], found))
+
+        arrays = {}
+        for field in fields:
+            dtype = None
+            for df in df_dict.values():
+                # day_schema 精簡格式的價格以 float64 放進 Panel
+                field_dtype = np.dtype(np.float64) if df[field].dtype == np.float32 else df[field].dtype
+                dtype = field_dtype if dtype is None else np.promote_types(dtype, field_dtype)
+            # 整數與布林欄位沒有 NaN, 沒有資料的格子填 0 / False, 要搭配 valid 使用
+            dtype = np.dtype(dtype if dtype is not None else np.float64)
+            array = np.full((len(dates), len(codes)), _fill_value(dtype), dtype=dtype)
+            for j, code in enumerate(codes):
+                pos, found = rows[j]
+                array[pos, j] = day_schema.values(df_dict[code], field)[found]
+            arrays[field] = array
+
+        return cls(dates, codes, arrays, valid, rows)
+
+    def __getitem__(self, field):
+        return self.fields[field]
+
+    def __contains__(self, field):
+        return field in self.fields
+
+    def copy(self):
+        """
+        淺複製, 陣列與原本的 Panel 共用, 只有欄位字典是新的,
+        在複本上 add_field / add_aligned 不會影響原本的 Panel。
+        """
+        panel = Panel.__new__(Panel)
+        panel.__dict__.update(self.__dict__)
+        panel.fields = dict(self.fields)
+        return panel
+
+    def add_field(self, field, array):
+        """
+        加入一個已經對齊的 (交易日數, 股票數) 欄位, 例如預先算好的訊號。
+        """
+        if array.shape != self.valid.shape:
+            raise ValueError(f"{field} 的形狀 {array.shape} 與 Panel {self.valid.shape} 不符")
+        self.fields[field] = array
+
+    def add_aligned(self, field, values_by_code, fill_value=False):
+        """
+        加入一個每檔股票各自一個陣列的欄位, 陣列要與 from_df_dict 時的日K資料等長。
+
+        Args:
+            field (str): 欄位名稱。
+            values_by_code (dict): 股票代號對應的一維陣列。
+            fill_value: 沒有資料的格子要填的值。
+
+        Returns:
+            np.ndarray: 加入的 (交易日數, 股票數) 陣列。
+        """
+        if self.rows is None:
+            raise ValueError("只有 from_df_dict 建立的 Panel 可以對齊個股陣列")
+        dtype = np.result_type(*values_by_code.values()) if values_by_code else np.dtype(bool)
+        array = np.full(self.valid.shape, fill_value, dtype=dtype)
+        for code, values in values_by_code.items():
+            j = self.code_pos[code]
+            pos, found = self.rows[j]
+            array[pos, j] = np.asarray(values)[found]
+        self.fields[field] = array
+        return array
+
+    @property
+    def nbytes(self):
+        """
+        所有陣列使用的記憶體大小 (位元組)。
+        """
+        return self.valid.nbytes + sum(array.nbytes for array in self.fields.values())
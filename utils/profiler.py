@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+"""
+各階段的執行時間統計。
+
+程式中用 `with profiler.stage('resample'):` 標出各個階段, 只有呼叫 enable() 之後才會計時,
+沒有啟用時只是一個空的 context manager。階段可以巢狀 (例如 indicator_cache.get 與 indicator.* 在同一檔股票中),
+每個階段另外記錄扣掉子階段之後的自身時間, 報表的比例以自身時間計算, 加總為 100%。
+子進程各自計時, 用 to_dict() 把結果傳回主進程再以 merge() 合併。
+"""
+
+import json
+import time
+from contextlib import contextmanager, nullcontext
+
+# 目前啟用的 StageTimer, 沒有啟用時為 None
+_active = None
+
+_NULL_STAGE = nullcontext()
+
+
+class StageTimer:
+    """
+    累計每個階段與每個項目 (例如每檔股票) 的執行時間。
+
+    Attributes:
+        stages (dict): 階段名稱對應 [總秒數, 次數, 自身秒數], 自身秒數不含巢狀在裡面的其他階段。
+        keys (dict): 項目名稱對應總秒數。
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.keys = {}
+        # 執行中的階段, 每一層累計子階段的秒數
+        self._children = []
+
+    @contextmanager
+    def stage(self, name, key=None):
+        self._children.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            child_seconds = self._children.pop()
+            if self._children:
+                self._children[-1] += seconds
+            self.add(name, seconds, self_seconds=seconds - child_seconds)
+            if key is not None:
+                self.add_key(key, seconds)
+
+    def add(self, name, seconds, count=1, self_seconds=None):
+        total = self.stages.setdefault(name, [0.0, 0, 0.0])
+        total[0] += seconds
+        total[1] += count
+        total[2] += seconds if self_seconds is None else self_seconds
+
+    def add_key(self, key, seconds):
+        self.keys[key] = self.keys.get(key, 0.0) + seconds
+
+    def to_dict(self):
+        """
+        轉成可以 pickle 與寫成 JSON 的 dict。
+        """
+        return {
+            'stages': {name: {'seconds': seconds, 'count': count, 'self_seconds': self_seconds}
+                       for name, (seconds, count, self_seconds) in self.stages.items()},
+            'keys': dict(self.keys),
+        }
+
+    def merge(self, data):
+        """
+        合併其他 StageTimer 的 to_dict() 結果。
+        """
+        for name, total in data['stages'].items():
+            self.add(name, total['seconds'], total['count'], total.get('self_seconds'))
+        for key, seconds in data['keys'].items():
+            self.add_key(key, seconds)
+
+    def report(self, top=10):
+        """
+        產生依時間排序的報表。
+
+        seconds 包含巢狀的子階段; percent 是自身秒數佔所有階段自身秒數總和的比例, 各階段加總為 100%。
+
+        Args:
+            top (int): 列出最慢的幾個項目。
+
+        Returns:
+            dict: 'stages' 與 'slowest' 兩個依時間排序的 list。
+        """
+        total = sum(self_seconds for _, _, self_seconds in self.stages.values()) or 1.0
+        stages = [{'stage': name, 'seconds': seconds, 'count': count, 'self_seconds': self_seconds,
+                   'percent': self_seconds / total * 100}
+                  for name, (seconds, count, self_seconds) in sorted(self.stages.items(), key=lambda item: -item[1][0])]
+        slowest = [{'key': key, 'seconds': seconds}
+                   for key, seconds in sorted(self.keys.items(), key=lambda item: -item[1])[:top]]
+        return {'stages': stages, 'slowest': slowest}
+
+    def report_lines(self, top=10):
+        """
+        產生給人看的報表。
+
+        Yields:
+            str: 報表的每一行。
+        """
+        report = self.report(top)
+        yield f"{'階段':30} {'秒數':>8} {'次數':>8} {'自身秒數':>6} {'比例':>5}"
+        for row in report['stages']:
+            yield (f"{row['stage']:32} {row['seconds']:10.3f} {row['count']:10} {row['self_seconds']:10.3f} "
+                   f"{row['percent']:6.1f}%")
+        if report['slowest']:
+            yield f"最慢的 {len(report['slowest'])} 個項目:"
+            for row in report['slowest']:
+                yield f"    {row['key']:28} {row['seconds']:10.3f}"
+
+    def write_json(self, path, top=10):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(top), f, ensure_ascii=False, indent=2)
+
+
+def enable(timer=None):
+    """
+    啟用計時, 回傳使用中的 StageTimer。
+    """
+    global _active
+    _active = timer if timer is not None else StageTimer()
+    return _active
+
+
+def disable():
+    """
+    停止計時, 回傳原本使用中的 StageTimer。
+    """
+    global _active
+    timer, _active = _active, None
+    return timer
+
+
+def active():
+    return _active
+
+
+def stage(name, key=None):
+    """
+    標出一個階段, 沒有啟用計時時不做任何事。
+
+    Args:
+        name (str): 階段名稱。
+        key (str): 有給時時間也累計到這個項目, 例如股票代號。
+    """
+    if _active is None:
+        return _NULL_STAGE
+    return _active.stage(name, key)
+
@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+"""
+將分K資料合成較長週期的 OHLCV K棒。
+
+StreamingResampler 可以一個區塊一個區塊地餵入分K資料, 只保留最後一根可能還沒收完的K棒,
+其餘已完成的K棒直接輸出, 所以記憶體用量只跟區塊大小有關。分K資料必須依時間排序。
+"""
+
+import pandas as pd
+
+# K棒欄位的合成方式
+OHLCV_AGG = {
+    'Open': 'first',
+    'High': 'max',
+    'Low': 'min',
+    'Close': 'last',
+    'Volume': 'sum',
+}
+
+OHLCV_COLUMNS = list(OHLCV_AGG)
+
+
+def resample_ohlcv(min_data, rule='1D'):
+    """
+    將分K資料合成 rule 週期的 OHLCV, 捨棄沒有資料的K棒。
+
+    Args:
+        min_data (pd.DataFrame): 以 ts 為索引的分K資料。
+        rule (str): pandas 的週期字串, 例如 '1D'、'5min'。
+
+    Returns:
+        pd.DataFrame: 合成後的K棒。
+    """
+    bars = min_data.resample(rule).agg(OHLCV_AGG)
+    return bars.dropna(subset=OHLCV_COLUMNS)
+
+
+def concat_bars(bars, new_bars):
+    """
+    將新的K棒接在原本的K棒後面。
+
+    新K棒的第一根與原本的最後一根是同一個時間時 (例如同一天分兩次收到), 合成為一根。
+
+    Args:
+        bars (pd.DataFrame): 原本的K棒, 至少包含 OHLCV 欄位。
+        new_bars (pd.DataFrame): 新的 OHLCV K棒。
+
+    Returns:
+        pd.DataFrame: 接好的 OHLCV K棒, 型別與 bars 相同。
+    """
+    bars = bars[OHLCV_COLUMNS]
+    if len(bars) == 0:
+        return new_bars
+    if len(new_bars) == 0:
+        return bars
+    if new_bars.index[0] == bars.index[-1]:
+        label = new_bars.index[0]
+        new_bars = new_bars.copy()
+        new_bars.loc[label, 'Open'] = bars['Open'].iloc[-1]
+        new_bars.loc[label, 'High'] = max(bars['High'].iloc[-1], new_bars['High'].iloc[0])
+        new_bars.loc[label, 'Low'] = min(bars['Low'].iloc[-1], new_bars['Low'].iloc[0])
+        new_bars.loc[label, 'Volume'] = bars['Volume'].iloc[-1] + new_bars['Volume'].iloc[0]
+        bars = bars.iloc[:-1]
+    return pd.concat([bars, new_bars.astype(bars.dtypes.to_dict())])
+
+
+class StreamingResampler:
+    """
+    逐區塊合成K棒。
+    """
+
+    def __init__(self, rule='1D'):
+        self.rule = rule
+        self._done = []
+        self._pending = None
+
+    def push(self, min_data):
+        """
+        加入一個區塊的分K資料。
+
+        Args:
+            min_data (pd.DataFrame): 以 ts 為索引、已經過濾的分K資料, 時間必須接在上一個區塊之後。
+
+        Returns:
+            pd.DataFrame: 這次確定已經完成的K棒。
+        """
+        bars = resample_ohlcv(min_data, self.rule)
+        if len(bars) == 0:
+            return bars
+        if self._pending is not None:
+            bars = concat_bars(self._pending, bars)
+
+        # 最後一根可能會延續到下一個區塊
+        done = bars.iloc[:-1]
+        self._pending = bars.iloc[-1:]
+        if len(done):
+            self._done.append(done)
+        return done
+
+    def result(self):
+        """
+        回傳所有合成好的K棒, 包含最後一根。
+
+        Returns:
+            pd.DataFrame: 以 ts 為索引的 OHLCV K棒。
+        """
+        parts = self._done + ([self._pending] if self._pending is not None else [])
+        if not parts:
+            return pd.DataFrame(columns=OHLCV_COLUMNS, index=pd.DatetimeIndex([], name='ts'))
+        return pd.concat(parts)
@@ -0,0 +1,494 @@
+#!/usr/bin/python3
+"""
+以運算式定義的買賣規則。
+
+規則寫在 json5 檔中 ({buy: {名稱: 運算式}, sell: {名稱: 運算式}}), 運算式的語法:
+- 欄位名稱直接寫, 可以包含空白 (前高 Index), 或以 '...'、"..."、`...` 括起來;
+- $名稱 是門檻參數, 預設值為 backtest_struct.DEFAULT_THRESHOLDS, 例如 $death_cross_deviation;
+- 數字、true、false;
+- 運算子 (優先順序由低到高): or、and、not、比較 (< <= > >= == !=)、+ -、* /、負號;
+- 函式:
+    shift(x, n)   往前 n 根K棒的值, 最前面 n 根為 False / NaN;
+    at(ref, x)    參照欄位 ref (例如 前高 Index) 所指那一天的 x, 沒有參照時為 False / NaN;
+    has(ref)      參照欄位有沒有值;
+    notna(x)、abs(x)、max(x, y, ...)、min(x, y, ...)。
+
+每個運算式編譯成一棵節點樹, 每個節點是一個整段歷史一次算完的 NumPy 運算。節點以正規化的
+運算式字串為鍵 (and、or、+、* 的運算元會排序), evaluate() 一次計算多條規則時, 相同的子運算式
+(例如 at(前高 Index, 過前高)) 在同一檔股票只會算一次。
+"""
+
+import os
+import re
+
+import json5
+import numpy as np
+
+from utils import day_schema
+from utils.backtest_struct import DEFAULT_THRESHOLDS
+
+# 規則的種類
+RULE_KINDS = ('buy', 'sell')
+
+# 預設的規則檔
+DEFAULT_RULES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rules.json5')
+
+_TOKEN_RE = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<quoted>'[^']*'|"[^"]*"|`[^`]*`)
+  | (?P<param>\$[A-Za-z_]\w*)
+  | (?P<op><=|>=|==|!=|<|>|\+|-|\*|/|\(|\)|,)
+  | (?P<name>[^\s()+\-*/<>=!,'"`$]+)
+""", re.VERBOSE)
+
+_KEYWORDS = ('and', 'or', 'not', 'true', 'false')
+
+_COMPARISONS = {
+    '<': np.less,
+    '<=': np.less_equal,
+    '>': np.greater,
+    '>=': np.greater_equal,
+    '==': np.equal,
+    '!=': np.not_equal,
+}
+
+_ARITHMETIC = {
+    '+': np.add,
+    '-': np.subtract,
+    '*': np.multiply,
+    '/': np.divide,
+}
+
+# 運算元順序不影響結果的運算, 正規化時排序
+_COMMUTATIVE = ('and', 'or', '+', '*', '==', '!=')
+
+
+class RuleSyntaxError(ValueError):
+    """
+    運算式的語法錯誤。
+    """
+
+    def __init__(self, text, pos, message):
+        super().__init__(f"{message}: {text[:pos]} >>> {text[pos:]}")
+        self.text = text
+        self.pos = pos
+
+
+def _tokenize(text):
+    """
+    將運算式切成 (種類, 值, 位置) 的 list, 相鄰的名稱 (例如 前高 Index) 合併成一個欄位名稱。
+    """
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        match = _TOKEN_RE.match(text, pos)
+        if match is None:
+            raise RuleSyntaxError(text, pos, "無法辨識的字元")
+        kind, value = match.lastgroup, match.group()
+        if kind == 'name' and value in _KEYWORDS:
+            tokens.append(('keyword', value, pos))
+        elif kind == 'name':
+            if tokens and tokens[-1][0] == 'name' and text[tokens[-1][2]:pos].strip() == tokens[-1][1]:
+                tokens[-1] = ('name', f'{tokens[-1][1]} {value}', tokens[-1][2])
+            else:
+                tokens.append(('name', value, pos))
+        elif kind == 'quoted':
+            tokens.append(('column', value[1:-1], pos))
+        elif kind != 'space':
+            tokens.append((kind, value, pos))
+        pos = match.end()
+    tokens.append(('end', '', len(text)))
+    return tokens
+
+
+class Node:
+    """
+    運算式樹的節點。
+
+    Attributes:
+        op (str): 運算, 例如 'column'、'and'、'<'、'at'。
+        args (tuple): 子節點, 或常數、欄位名稱等值。
+        key (str): 正規化的運算式字串, 相同的子運算式有相同的鍵。
+    """
+    __slots__ = ('op', 'args', 'key')
+
+    def __init__(self, op, args, key):
+        self.op = op
+        self.args = args
+        self.key = key
+
+    def children(self):
+        return [arg for arg in self.args if isinstance(arg, Node)]
+
+
+def _node(op, *args):
+    """
+    建立節點並計算正規化的鍵。
+    """
+    if op in ('column', 'param', 'const'):
+        key = f'{op}:{args[0]!r}'
+    else:
+        parts = [arg.key if isinstance(arg, Node) else repr(arg) for arg in args]
+        if op in _COMMUTATIVE:
+            parts = sorted(set(parts)) if op in ('and', 'or') else sorted(parts)
+        key = f"{op}({','.join(parts)})"
+    return Node(op, args, key)
+
+
+def _flatten(op, left, right):
+    """
+    將 a and (b and c) 攤平成一個 and 節點, 讓不同寫法的子運算式有相同的鍵。
+    """
+    args = []
+    for node in (left, right):
+        args.extend(node.args if node.op == op else (node,))
+    unique = {}
+    for node in args:
+        unique.setdefault(node.key, node)
+    return _node(op, *unique.values())
+
+
+class _Parser:
+    """
+    遞迴下降的運算式剖析器。
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = _tokenize(text)
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos]
+
+    def take(self, kind=None, value=None):
+        token = self.tokens[self.pos]
+        if (kind is not None and token[0] != kind) or (value is not None and token[1] != value):
+            expected = value if value is not None else kind
+            raise RuleSyntaxError(self.text, token[2], f"這裡應該是 {expected}")
+        self.pos += 1
+        return token
+
+    def accept(self, kind, value=None):
+        token = self.tokens[self.pos]
+        if token[0] == kind and (value is None or token[1] == value):
+            self.pos += 1
+            return True
+        return False
+
+    def parse(self):
+        node = self.parse_or()
+        self.take('end')
+        return node
+
+    def parse_or(self):
+        node = self.parse_and()
+        while self.accept('keyword', 'or'):
+            node = _flatten('or', node, self.parse_and())
+        return node
+
+    def parse_and(self):
+        node = self.parse_not()
+        while self.accept('keyword', 'and'):
+            node = _flatten('and', node, self.parse_not())
+        return node
+
+    def parse_not(self):
+        if self.accept('keyword', 'not'):
+            return _node('not', self.parse_not())
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        node = self.parse_sum()
+        token = self.peek()
+        if token[0] == 'op' and token[1] in _COMPARISONS:
+            self.pos += 1
+            node = _node(token[1], node, self.parse_sum())
+        return node
+
+    def parse_sum(self):
+        node = self.parse_product()
+        while self.peek()[0] == 'op' and self.peek()[1] in '+-':
+            op = self.take()[1]
+            node = _node(op, node, self.parse_product())
+        return node
+
+    def parse_product(self):
+        node = self.parse_unary()
+        while self.peek()[0] == 'op' and self.peek()[1] in '*/':
+            op = self.take()[1]
+            node = _node(op, node, self.parse_unary())
+        return node
+
+    def parse_unary(self):
+        if self.accept('op', '-'):
+            return _node('neg', self.parse_unary())
+        return self.parse_primary()
+
+    def parse_primary(self):
+        kind, value, pos = self.take()
+        if kind == 'number':
+            return _node('const', float(value))
+        if kind == 'keyword' and value in ('true', 'false'):
+            return _node('const', value == 'true')
+        if kind == 'param':
+            return _node('param', value[1:])
+        if kind == 'column':
+            return _node('column', value)
+        if kind == 'op' and value == '(':
+            node = self.parse_or()
+            self.take('op', ')')
+            return node
+        if kind == 'name':
+            if value in _FUNCTIONS and self.accept('op', '('):
+                return self.parse_call(value, pos)
+            return _node('column', value)
+        raise RuleSyntaxError(self.text, pos, "這裡應該是欄位、數字或函式")
+
+    def parse_call(self, name, pos):
+        args = []
+        if not self.accept('op', ')'):
+            args.append(self.parse_argument(name, 0))
+            while self.accept('op', ','):
+                args.append(self.parse_argument(name, len(args)))
+            self.take('op', ')')
+        arity = _FUNCTIONS[name][0]
+        if (arity is not None and len(args) != arity) or not args:
+            raise RuleSyntaxError(self.text, pos, f"{name} 的參數數目不對")
+        if name == 'shift':
+            if args[1].op != 'const' or args[1].args[0] != int(args[1].args[0]) or args[1].args[0] < 0:
+                raise RuleSyntaxError(self.text, pos, "shift 的 n 必須是非負整數, 不能看未來的K棒")
+            args[1] = int(args[1].args[0])
+        if name in ('at', 'has') and args[0].op != 'column':
+            raise RuleSyntaxError(self.text, pos, f"{name} 的第一個參數必須是參照欄位")
+        if name in ('at', 'has'):
+            args[0] = args[0].args[0]
+        return _node(name, *args)
+
+    def parse_argument(self, name, i):
+        # 參照欄位的參數直接當成欄位名稱
+        if name in ('at', 'has') and i == 0 and self.peek()[0] in ('name', 'column'):
+            return _node('column', self.take()[1])
+        return self.parse_or()
+
+
+def _fill_like(values):
+    """
+    沒有資料時的值: 布林為 False, 其他為 NaN。
+    """
+    return False if values.dtype == bool else np.nan
+
+
+def _as_bool(values):
+    return np.asarray(values).astype(bool, copy=False)
+
+
+def _shift(values, n):
+    values = np.asarray(values)
+    if n == 0 or values.ndim == 0:
+        return values
+    dtype = values.dtype if values.dtype == bool else np.result_type(values.dtype, np.float64)
+    shifted = np.full(values.shape, _fill_like(values), dtype=dtype)
+    shifted[..., n:] = values[..., :-n]
+    return shifted
+
+
+def _at(ctx, ref_col, values):
+    pos = day_schema.ref_positions(ctx.df, ref_col)
+    shape = np.broadcast_shapes(np.shape(values), pos.shape)
+    values = np.broadcast_to(np.asarray(values), shape)
+    taken = np.take_along_axis(values, np.broadcast_to(np.maximum(pos, 0), shape), axis=-1)
+    return np.where(pos >= 0, taken, _fill_like(values))
+
+
+def _notna(values):
+    values = np.asarray(values)
+    if values.dtype.kind == 'f':
+        return ~np.isnan(values)
+    return np.ones(values.shape, dtype=bool)
+
+
+# 函式名稱對應 (參數數目, 實作), 參數數目為 None 代表不限
+_FUNCTIONS = {
+    'shift': (2, lambda ctx, values, n: _shift(values, n)),
+    'at': (2, _at),
+    'has': (1, lambda ctx, ref_col: day_schema.has_ref(ctx.df, ref_col)),
+    'notna': (1, lambda ctx, values: _notna(values)),
+    'abs': (1, lambda ctx, values: np.abs(values)),
+    'max': (None, lambda ctx, *values: np.fmax.reduce(np.broadcast_arrays(*values))
+            if len(values) > 1 else values[0]),
+    'min': (None, lambda ctx, *values: np.fmin.reduce(np.broadcast_arrays(*values))
+            if len(values) > 1 else values[0]),
+}
+
+
+def parse(text):
+    """
+    剖析運算式。
+
+    Args:
+        text (str): 運算式。
+
+    Returns:
+        Node: 運算式樹的根節點。
+    """
+    return _Parser(text).parse()
+
+
+class _Context:
+    """
+    單一股票的一次計算, memo 保存算過的子運算式。
+    """
+
+    def __init__(self, df, params):
+        self.df = df
+        self.params = params
+        self.memo = {}
+        self.computed = 0
+
+    def column(self, name):
+        try:
+            values = day_schema.values(self.df, name)
+        except KeyError:
+            raise KeyError(f"規則用到的欄位 {name} 不在日K資料中") from None
+        return values
+
+    def eval(self, node):
+        values = self.memo.get(node.key)
+        if values is None:
+            values = self.memo[node.key] = self._compute(node)
+            self.computed += 1
+        return values
+
+    def _compute(self, node):
+        op, args = node.op, node.args
+        if op == 'column':
+            return self.column(args[0])
+        if op == 'const':
+            return args[0]
+        if op == 'param':
+            if args[0] not in self.params:
+                raise KeyError(f"沒有門檻參數 ${args[0]}")
+            return self.params[args[0]]
+        if op in ('and', 'or'):
+            result = _as_bool(self.eval(args[0]))
+            combine = np.logical_and if op == 'and' else np.logical_or
+            for arg in args[1:]:
+                result = combine(result, _as_bool(self.eval(arg)))
+            return result
+        if op == 'not':
+            return ~_as_bool(self.eval(args[0]))
+        if op == 'neg':
+            return np.negative(self.eval(args[0]))
+        if op in _COMPARISONS:
+            return _COMPARISONS[op](self.eval(args[0]), self.eval(args[1]))
+        if op in _ARITHMETIC:
+            return _ARITHMETIC[op](self.eval(args[0]), self.eval(args[1]))
+        values = [self.eval(arg) if isinstance(arg, Node) else arg for arg in args]
+        return _FUNCTIONS[op][1](self, *values)
+
+
+class Rule:
+    """
+    編譯好的規則, 以 rule(df, params) 算出整段歷史的訊號。
+
+    Attributes:
+        name (str): 規則名稱。
+        text (str): 原始的運算式。
+        root (Node): 運算式樹。
+        columns (frozenset): 用到的欄位, 包含參照欄位。
+    """
+
+    def __init__(self, name, text):
+        self.name = name
+        self.text = text
+        self.root = parse(text)
+        self.columns = frozenset(_columns(self.root))
+
+    def __call__(self, df, params=None):
+        return evaluate(df, [self], params)[0]
+
+    def __repr__(self):
+        return f'Rule({self.name!r}, {self.text!r})'
+
+
+def _columns(node):
+    if node.op == 'column':
+        yield node.args[0]
+    elif node.op in ('at', 'has'):
+        yield node.args[0]
+    for child in node.children():
+        yield from _columns(child)
+
+
+def _walk(node):
+    yield node
+    for child in node.children():
+        yield from _walk(child)
+
+
+def node_count(rules):
+    """
+    回傳 (所有規則的節點總數, 去掉重複子運算式後的節點數)。
+    """
+    nodes = [node.key for rule in rules for node in _walk(rule.root)]
+    return len(nodes), len(set(nodes))
+
+
+def evaluate(df, rules, params=None):
+    """
+    在同一檔股票上計算多條規則, 相同的子運算式只算一次。
+
+    Args:
+        df (pd.DataFrame): 日K資料, 精簡格式或原本的格式都可以。
+        rules (iterable): Rule 的 list。
+        params (dict): 門檻參數, 會蓋過 DEFAULT_THRESHOLDS, 值可以是 (K, 1) 的陣列。
+
+    Returns:
+        list: 每條規則與 df 等長的布林陣列 (門檻是陣列時為 (K, len(df)))。
+    """
+    ctx = _Context(df, {**DEFAULT_THRESHOLDS, **(params or {})})
+    signals = []
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for rule in rules:
+            values = _as_bool(ctx.eval(rule.root))
+            signals.append(np.broadcast_to(values, np.broadcast_shapes(values.shape, (len(df),))))
+    return signals
+
+
+def compile_rules(rule_texts):
+    """
+    編譯 名稱 -> 運算式 的字典。
+
+    Returns:
+        dict: 名稱對應 Rule。
+
+    Raises:
+        RuleSyntaxError: 運算式有語法錯誤, 訊息包含規則名稱。
+    """
+    rules = {}
+    for name, text in rule_texts.items():
+        try:
+            rules[name] = Rule(name, text)
+        except RuleSyntaxError as e:
+            raise RuleSyntaxError(e.text, e.pos, f"規則 {name} 的語法錯誤") from None
+    return rules
+
+
+def load_rules(path):
+    """
+    讀取規則檔。
+
+    Args:
+        path (str): json5 規則檔, 格式為 {buy: {名稱: 運算式}, sell: {名稱: 運算式}}。
+
+    Returns:
+        dict: 'buy' 與 'sell' 各自對應 名稱 -> Rule 的字典。
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        config = json5.load(f)
+    unknown = set(config) - set(RULE_KINDS)
+    if unknown:
+        raise ValueError(f"{path} 中有不認識的規則種類 {sorted(unknown)}, 只能是 {RULE_KINDS}")
+    return {kind: compile_rules(config.get(kind, {})) for kind in RULE_KINDS}
@@ -0,0 +1,499 @@
+#!/usr/bin/python3
+"""
+逐根K棒更新的即時指標。
+
+utils.indicators 每次都在整段歷史上重算; 盤中監控時每收到一根新K棒 (或同一根K棒的新報價) 只需要
+更新最後一根, 這裡把每個指標的狀態保存下來, 每次更新只做固定量的運算:
+
+- SMA 以環狀緩衝區與 Kahan 累加保存視窗, 運算順序與 indicators.sma_state 相同;
+- EMA 只保存 indicators.ema_state 的 (weighted, old_wt);
+- 區間高低點以單調佇列維護 RANGE_WINDOW 根內的最大/最小值;
+- 張嘴與閉合排列只需要最近 61 根收盤價。
+
+算出來的值與 utils.indicators 在同一段歷史上算出的值完全相同。區間高低點使用置中視窗,
+要再收到 RANGE_WINDOW // 2 根K棒才能確定, 所以最新一根一定是 False, 確定的結果放在 confirmed。
+
+LiveDay 再把分K累加成當天的日K, 並以已經確定的區間高低點算出前高、前低、過前高、破底與高點連線。
+批次計算時轉折點用到了之後的K棒, 即時計算時只能用已經確定的轉折點, 所以這幾個欄位可能與
+_day.csv 不同, 這是回測與實際交易本來就有的差異。
+"""
+
+import math
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from utils import indicators
+
+# 張嘴與閉合排列比較的前幾根收盤價
+SHIFTS = (20, 60)
+
+# 區間高低點要再等幾根K棒才能確定
+RANGE_LAG = indicators.RANGE_WINDOW // 2
+
+# update() 回傳的欄位
+MA_COLUMNS = tuple(f'SMA{n}' for n in indicators.SMA_PERIODS) + tuple(f'EMA{n}' for n in indicators.EMA_PERIODS)
+SIGNAL_COLUMNS = ('均線聚集', '中均線聚集', '短均線聚集', '均線聚集後突破', '中均線聚集後突破', '短均線聚集後突破',
+                  'Expansion', 'Clogging', '區間高點', '區間低點')
+
+
+class OnlineSMA:
+    """
+    單一期間的 SMA, 狀態與 indicators.sma_state() 的狀態可以互相轉換。
+    """
+
+    def __init__(self, n, state=None):
+        self.n = n
+        if state is None:
+            self.nobs = self.neg_ct = self.num_same = 0
+            self.sum_x = self.compensation_add = self.compensation_remove = 0.
+            self.prev_value = None
+            self.window = deque()
+        else:
+            (self.nobs, self.neg_ct, self.num_same, self.sum_x, self.compensation_add,
+             self.compensation_remove, self.prev_value, window) = state
+            self.window = deque(window)
+
+    def state(self):
+        """
+        回傳 indicators.sma_state() 格式的狀態。
+        """
+        return (self.nobs, self.neg_ct, self.num_same, self.sum_x, self.compensation_add,
+                self.compensation_remove, self.prev_value, list(self.window))
+
+    def update(self, val, commit=True):
+        """
+        加入一筆收盤價並回傳 SMA。
+
+        Args:
+            val (float): 收盤價。
+            commit (bool): 為 False 時只算出加入這筆之後的值, 不改變狀態。
+
+        Returns:
+            float: 未四捨五入的 SMA, 資料不足時為 NaN。
+        """
+        nobs, neg_ct, num_same = self.nobs, self.neg_ct, self.num_same
+        sum_x, compensation_add, compensation_remove = self.sum_x, self.compensation_add, self.compensation_remove
+        prev_value = val if self.prev_value is None else self.prev_value
+
+        full = len(self.window) == self.n
+        if full:
+            old = self.window[0]
+            if old == old:
+                nobs -= 1
+                y = - old - compensation_remove
+                t = sum_x + y
+                compensation_remove = t - sum_x - y
+                sum_x = t
+                if math.copysign(1., old) < 0:
+                    neg_ct -= 1
+        if val == val:
+            nobs += 1
+            y = val - compensation_add
+            t = sum_x + y
+            compensation_add = t - sum_x - y
+            sum_x = t
+            if math.copysign(1., val) < 0:
+                neg_ct += 1
+            num_same = num_same + 1 if val == prev_value else 1
+            prev_value = val
+
+        if nobs >= self.n:
+            result = sum_x / nobs
+            if num_same >= nobs:
+                result = prev_value
+            elif neg_ct == 0 and result < 0:
+                result = 0.
+            elif neg_ct == nobs and result > 0:
+                result = 0.
+        else:
+            result = math.nan
+
+        if commit:
+            if full:
+                self.window.popleft()
+            self.window.append(val)
+            self.nobs, self.neg_ct, self.num_same = nobs, neg_ct, num_same
+            self.sum_x, self.compensation_add, self.compensation_remove = sum_x, compensation_add, compensation_remove
+            self.prev_value = prev_value
+        return result
+
+
+class OnlineEMA:
+    """
+    單一期間的 EMA, 狀態與 indicators.ema_state() 的狀態相同。
+    """
+
+    def __init__(self, n, state=None):
+        self.n = n
+        self.alpha = 1. / (1. + (n - 1) / 2.0)
+        self.old_wt_factor = 1. - self.alpha
+        self.weighted, self.old_wt = state if state is not None else (None, None)
+
+    def state(self):
+        """
+        回傳 indicators.ema_state() 格式的狀態, 還沒有資料時為 None。
+        """
+        if self.weighted is None:
+            return None
+        return (float(self.weighted), float(self.old_wt))
+
+    def update(self, cur, commit=True):
+        """
+        加入一筆收盤價並回傳未四捨五入的 EMA, commit 為 False 時不改變狀態。
+        """
+        if self.weighted is None:
+            weighted, old_wt = cur, 1.
+        else:
+            weighted, old_wt = self.weighted, self.old_wt
+            old_wt *= self.old_wt_factor
+            if weighted != cur:
+                weighted = old_wt * weighted + cur
+                weighted /= (old_wt + 1.)
+            old_wt += 1.
+        if commit:
+            self.weighted, self.old_wt = weighted, old_wt
+        return weighted
+
+
+class RollingExtreme:
+    """
+    以單調佇列維護最近 window 根的最大值 (或最小值), 每根攤銷 O(1)。
+    """
+
+    def __init__(self, window, largest=True):
+        self.window = window
+        self.largest = largest
+        self._queue = deque()  # (位置, 值), 值單調遞減 (最大值) 或遞增 (最小值)
+
+    def push(self, pos, value):
+        """
+        加入第 pos 根的值, 回傳最近 window 根的極值, 不滿 window 根時為 NaN。
+        """
+        queue = self._queue
+        if self.largest:
+            while queue and queue[-1][1] <= value:
+                queue.pop()
+        else:
+            while queue and queue[-1][1] >= value:
+                queue.pop()
+        queue.append((pos, value))
+        if queue[0][0] <= pos - self.window:
+            queue.popleft()
+        return queue[0][1] if pos + 1 >= self.window else math.nan
+
+
+def _round(value):
+    return float(np.round(value, 2))
+
+
+def _envelope(values):
+    """
+    與 DataFrame.max(axis=1) / min(axis=1) 相同, 略過 NaN。
+    """
+    values = [value for value in values if value == value]
+    if not values:
+        return math.nan, math.nan
+    return max(values), min(values)
+
+
+class StreamingIndicators:
+    """
+    單一股票的即時指標。
+
+    Attributes:
+        bars (int): 已經確定的K棒數。
+        confirmed (tuple): 最近一次 update 確定的 (位置, 時間, 區間高點, 區間低點, High, Low), 還沒有時為 None。
+    """
+
+    def __init__(self, ma_states=None):
+        """
+        Args:
+            ma_states (dict): indicators.ma_states_at() 格式的均線狀態, 為 None 時從第一根開始。
+        """
+        ma_states = ma_states or {}
+        self.sma = {n: OnlineSMA(n, ma_states.get(f'SMA{n}')) for n in indicators.SMA_PERIODS}
+        self.ema = {n: OnlineEMA(n, ma_states.get(f'EMA{n}')) for n in indicators.EMA_PERIODS}
+        self.range_high = RollingExtreme(indicators.RANGE_WINDOW, largest=True)
+        self.range_low = RollingExtreme(indicators.RANGE_WINDOW, largest=False)
+        self.closes = deque(maxlen=max(SHIFTS) + 1)
+        self.recent = deque(maxlen=RANGE_LAG + 1)  # (時間, High, Low), 等待確定區間高低點
+        self.bars = 0
+        self.confirmed = None
+
+    @classmethod
+    def from_history(cls, day_data, ma_row=-1, ma_states=None):
+        """
+        以歷史K棒 (例如 _day.csv) 建立狀態, 之後的 update 接在最後一根之後。
+
+        Args:
+            day_data (pd.DataFrame): 至少包含 High、Low、Close 的歷史K棒。
+            ma_row (int): ma_states 對應的列位置 (process_kbars 檢查點中的 ma_row), -1 表示沒有。
+            ma_states (dict): 第 ma_row 根 (含) 為止的均線狀態; 沒有時從第一根重新累加。
+
+        Returns:
+            StreamingIndicators: 已經讀入所有歷史K棒的狀態。
+        """
+        close = day_data['Close'].to_numpy(dtype=np.float64)
+        n = len(close)
+        engine = cls()
+        if n == 0:
+            return engine
+
+        # 均線: 從檢查點 (或第一根) 接續累加到最後一根
+        if ma_states and 0 <= ma_row < n:
+            states = indicators.ma_states_at(close, n - 1, ma_row + 1, ma_states)
+        else:
+            states = indicators.ma_states_at(close, n - 1)
+        engine = cls(states)
+
+        # 其餘狀態只跟最後幾根有關
+        high = day_data['High'].to_numpy(dtype=np.float64)
+        low = day_data['Low'].to_numpy(dtype=np.float64)
+        index = day_data.index
+        start = max(n - indicators.RANGE_WINDOW, 0)
+        for pos in range(start, n):
+            engine.range_high.push(pos, high[pos])
+            engine.range_low.push(pos, low[pos])
+        engine.closes.extend(close[-engine.closes.maxlen:].tolist())
+        engine.recent.extend((index[pos], high[pos], low[pos]) for pos in range(max(n - RANGE_LAG, 0), n))
+        engine.bars = n
+        return engine
+
+    def ma_states(self):
+        """
+        回傳 indicators.ma_states_at() 格式的均線狀態, 可以存進檢查點。
+        """
+        states = {f'SMA{n}': sma.state() for n, sma in self.sma.items()}
+        states.update({f'EMA{n}': ema.state() for n, ema in self.ema.items()})
+        return states
+
+    def update(self, high, low, close, ts=None, final=True):
+        """
+        加入一根K棒並回傳這根K棒的指標。
+
+        Args:
+            high (float): 最高價。
+            low (float): 最低價。
+            close (float): 收盤價。
+            ts: K棒時間, 只用來標示 confirmed。
+            final (bool): 為 False 時表示這根K棒還沒收完 (盤中報價), 只算出目前的值而不改變狀態,
+                之後可以用新的報價再呼叫, 收完時以 final=True 呼叫一次。
+
+        Returns:
+            dict: 欄位名稱對應的值, 欄位與 utils.indicators 相同。
+        """
+        high, low, close = float(high), float(low), float(close)
+        row = {'Close': close}
+        for n, sma in self.sma.items():
+            row[f'SMA{n}'] = _round(sma.update(close, final))
+        for n, ema in self.ema.items():
+            row[f'EMA{n}'] = _round(ema.update(close, final))
+
+        # 均線包絡線與聚集
+        max_large, min_large = _envelope(row[col] for col in indicators.MA_COLS_LARGE)
+        max_mid, min_mid = _envelope(row[col] for col in indicators.MA_COLS_MID)
+        max_little, min_little = _envelope(row[col] for col in indicators.MA_COLS_LITTLE)
+        ma_ready = all(row[col] == row[col] for col in indicators.MA_COLS_LARGE)
+        concentrated = ma_ready and (max_large - min_large) <= max_large * indicators.CONCENTRATED_BAND
+        concentrated_mid = (ma_ready and (max_mid - min_mid) <= max_mid * indicators.CONCENTRATED_BAND and
+                            row['EMA120'] > row['SMA120'])
+        concentrated_little = (ma_ready and (max_little - min_little) <= max_little * indicators.CONCENTRATED_BAND and
+                               row['EMA20'] > row['EMA60'] and row['SMA20'] > row['SMA60'] and
+                               (row['EMA60'] > row['EMA120'] or row['EMA120'] > row['SMA120']))
+        row['均線聚集'] = concentrated
+        row['中均線聚集'] = concentrated_mid
+        row['短均線聚集'] = concentrated_little
+        row['均線聚集後突破'] = concentrated and close == max_large
+        row['中均線聚集後突破'] = concentrated_mid and close == max_mid
+        row['短均線聚集後突破'] = concentrated_little and close == max_little
+
+        # 張嘴與閉合排列, 前面的收盤價不夠時與 shift() 的 NaN 一樣為 False
+        closes = self.closes
+        if len(closes) >= max(SHIFTS):
+            shifted = closes[-20] * 3 - closes[-60]
+        else:
+            shifted = math.nan
+        row['Expansion'] = row['均線聚集後突破'] and (close * 2 * indicators.EXPANSION_FACTOR) > shifted
+        row['Clogging'] = (close * indicators.CLOGGING_FACTOR * 2) < shifted
+
+        # 置中視窗的右半邊還沒出現, 與只用到目前為止的資料批次計算一樣為 False
+        row['區間高點'] = False
+        row['區間低點'] = False
+
+        if final:
+            self._advance(high, low, close, ts)
+        return row
+
+    def _advance(self, high, low, close, ts):
+        """
+        K棒收完時更新收盤價緩衝與區間高低點。
+        """
+        pos = self.bars
+        range_max = self.range_high.push(pos, high)
+        range_min = self.range_low.push(pos, low)
+        self.recent.append((ts, high, low))
+        self.closes.append(close)
+        self.bars += 1
+
+        # 視窗 [pos - RANGE_WINDOW + 1, pos] 的中心那一根可以確定了
+        self.confirmed = None
+        if len(self.recent) == self.recent.maxlen:
+            center_ts, center_high, center_low = self.recent[0]
+            self.confirmed = (pos - RANGE_LAG, center_ts, bool(center_high >= range_max),
+                              bool(center_low <= range_min), center_high, center_low)
+
+
+class LiveDay:
+    """
+    單一股票盤中的日K與買賣規則需要的欄位。
+
+    每收到一根分K就累加到當天的日K並算出目前的指標 (不改變狀態), 換日時才把前一天定案。
+
+    Attributes:
+        code (str): 股票代號。
+        day (pd.Timestamp): 目前這一天, 還沒有收到分K時為 None。
+        bar (list): 當天目前的 [Open, High, Low, Close, Volume]。
+    """
+
+    def __init__(self, code, day_data):
+        """
+        Args:
+            code (str): 股票代號。
+            day_data (pd.DataFrame): 開始前的歷史日K, 欄位與 _day.csv 相同。
+        """
+        self.code = code
+        self.engine = StreamingIndicators.from_history(day_data)
+        self.pos = len(day_data)
+        self.day = None
+        self.bar = None
+
+        # 最近幾天定案後的 (日期, 過前高, 破底), 等待區間高低點確定時查詢
+        self.recent = deque(maxlen=RANGE_LAG + 1)
+        # 已經確定的區間高點 (位置, 日期, High, 過前高), 高點連線需要最近兩個
+        self.high_pivots = deque(maxlen=2)
+        # 已經確定的區間低點 (位置, 日期, Low, 破底)
+        self.low_pivot = None
+
+        n = len(day_data)
+        if n == 0:
+            return
+        over_high = day_data['過前高'].to_numpy(dtype=bool)
+        below_low = day_data['破底'].to_numpy(dtype=bool)
+        for pos in range(max(n - self.recent.maxlen, 0), n):
+            self.recent.append((day_data.index[pos], over_high[pos], below_low[pos]))
+
+        # 最後 RANGE_LAG 根的區間高低點用到了之後的K棒, 由 engine 重新確定
+        known = n - RANGE_LAG
+        high_pos = np.flatnonzero(day_data['區間高點'].to_numpy(dtype=bool)[1:known]) + 1
+        for pos in high_pos[-2:]:
+            self.high_pivots.append((pos, day_data.index[pos], float(day_data['High'].iloc[pos]), over_high[pos]))
+        low_pos = np.flatnonzero(day_data['區間低點'].to_numpy(dtype=bool)[1:known]) + 1
+        if len(low_pos):
+            pos = low_pos[-1]
+            self.low_pivot = (pos, day_data.index[pos], float(day_data['Low'].iloc[pos]), below_low[pos])
+
+    def on_bar(self, ts, open_, high, low, close, volume):
+        """
+        加入一根分K。
+
+        Returns:
+            tuple: (換日時定案的前一天, 沒有換日時為 None; 當天目前的欄位)。
+        """
+        day = pd.Timestamp(ts).normalize()
+        finished = None
+        if self.day is not None and day != self.day:
+            finished = self.finish_day()
+        if self.bar is None:
+            self.day = day
+            self.bar = [open_, high, low, close, volume]
+        else:
+            bar = self.bar
+            bar[1] = max(bar[1], high)
+            bar[2] = min(bar[2], low)
+            bar[3] = close
+            bar[4] += volume
+        return finished, self.row(final=False)
+
+    def finish_day(self):
+        """
+        將目前這一天定案, 更新均線狀態與區間高低點。
+
+        Returns:
+            dict: 定案的日K欄位, 沒有資料時為 None。
+        """
+        if self.bar is None:
+            return None
+        row = self.row(final=True)
+        self.recent.append((self.day, row['過前高'], row['破底']))
+
+        # 與批次計算相同, 第一根不算轉折點
+        confirmed = self.engine.confirmed
+        if confirmed is not None and confirmed[0] > 0:
+            pos, date, is_high, is_low, high, low = confirmed
+            _, over_high, below_low = self.recent[0]
+            if is_high:
+                self.high_pivots.append((pos, date, high, over_high))
+            if is_low:
+                self.low_pivot = (pos, date, low, below_low)
+
+        self.pos += 1
+        self.day = None
+        self.bar = None
+        return row
+
+    def row(self, final=False):
+        """
+        以目前的日K算出所有規則需要的欄位。
+
+        Args:
+            final (bool): 為 True 時這一天已經收完, 會更新狀態; 一天只能呼叫一次。
+
+        Returns:
+            dict: 欄位名稱對應的值, 日期欄位為 pd.Timestamp (沒有時為 NaT)。
+        """
+        open_, high, low, close, volume = self.bar
+        row = self.engine.update(high, low, close, self.day, final)
+        row.update({'Open': open_, 'High': high, 'Low': low, 'Volume': volume})
+        row['Previous Index'] = self.recent[-1][0] if self.recent else pd.NaT
+
+        pos = self.pos
+        if self.high_pivots:
+            pivot_pos, pivot_date, pivot_high, _ = self.high_pivots[-1]
+            row['前高'], row['前高 Index'] = pivot_high, pivot_date
+            row['過前高'] = high > pivot_high
+        else:
+            row['前高'], row['前高 Index'], row['過前高'] = math.nan, pd.NaT, False
+        if self.low_pivot is not None:
+            row['前低'], row['前低 Index'] = self.low_pivot[2], self.low_pivot[1]
+            row['破底'] = low < self.low_pivot[2]
+        else:
+            row['前低'], row['前低 Index'], row['破底'] = math.nan, pd.NaT, False
+
+        # 最近兩個區間高點的連線延伸到今天
+        if len(self.high_pivots) == 2:
+            (prev_pos, _, prev_high, _), (last_pos, _, last_high, _) = self.high_pivots
+            slope = (last_high - prev_high) / (last_pos - prev_pos)
+            row['高點連線'] = _round(last_high + slope * (pos - last_pos))
+        else:
+            row['高點連線'] = math.nan
+        return row
+
+    def reference_rows(self):
+        """
+        回傳規則會以日期查詢的前幾天 (前一天、前高與前低那一天) 的 過前高 與 破底。
+
+        Returns:
+            dict: 日期對應 (過前高, 破底)。
+        """
+        rows = {}
+        for date, over_high, below_low in self.recent:
+            rows[date] = (over_high, below_low)
+        if self.high_pivots:
+            _, date, _, over_high = self.high_pivots[-1]
+            rows.setdefault(date, (over_high, False))
+        if self.low_pivot is not None:
+            _, date, _, below_low = self.low_pivot
+            rows.setdefault(date, (False, below_low))
+        return rows
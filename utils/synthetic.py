@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+"""
+以固定亂數種子產生的模擬K線資料。
+
+格式與 Shioaji 下載的 _min.csv 以及 process_kbars 產生的日K相同, 讓效能測試與除錯不需要真實資料;
+同樣的參數與種子一定產生同樣的資料。
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+# 模擬資料的第一個交易日
+START_DATE = '2018-12-07'
+
+# 每天的分K數量 (09:01 ~ 13:30)
+BARS_PER_DAY = 270
+
+
+def trading_days(days, start=START_DATE):
+    """
+    回傳 days 個平日做為交易日。
+    """
+    return pd.bdate_range(start, periods=days, name='ts')
+
+
+def _ohlc(rng, n, price, volatility):
+    """
+    以幾何隨機漫步產生收盤價, 再加上上下影線。
+    """
+    close = np.round(np.maximum(1, price * np.exp(np.cumsum(rng.normal(0, volatility, n)))), 2)
+    high = np.round(close * (1 + rng.uniform(0, 1.5 * volatility, n)), 2)
+    low = np.round(close * (1 - rng.uniform(0, 1.5 * volatility, n)), 2)
+    opn = np.round((high + low) / 2, 2)
+    return opn, high, low, close
+
+
+def minute_bars(days, seed=0, start=START_DATE, bars_per_day=BARS_PER_DAY, price=50.0, volatility=0.002):
+    """
+    產生分K資料。
+
+    Args:
+        days (int): 交易日數。
+        seed (int): 亂數種子。
+        start (str): 第一個交易日。
+        bars_per_day (int): 每天的分K數量。
+        price (float): 起始價格。
+        volatility (float): 每根分K收盤價報酬率的標準差。
+
+    Returns:
+        pd.DataFrame: 與 _min.csv 相同欄位 (ts, Open, High, Low, Close, Volume, Amount) 的分K資料。
+    """
+    rng = np.random.default_rng(seed)
+    dates = trading_days(days, start).to_numpy()
+    ts = (dates[:, None] + np.timedelta64(9, 'h') +
+          np.arange(1, bars_per_day + 1)[None, :] * np.timedelta64(1, 'm')).ravel()
+    opn, high, low, close = _ohlc(rng, len(ts), price, volatility)
+    volume = rng.integers(1, 50, len(ts))
+    return pd.DataFrame({'ts': ts, 'Open': opn, 'High': high, 'Low': low, 'Close': close,
+                         'Volume': volume, 'Amount': np.round(close * volume * 1000, 0)})
+
+
+def day_bars(days, seed=0, start=START_DATE, price=50.0, volatility=0.02, volume=(1000, 20000)):
+    """
+    產生日K的 OHLCV。
+
+    Args:
+        days (int): 交易日數。
+        seed (int): 亂數種子。
+        start (str): 第一個交易日。
+        price (float): 起始價格。
+        volatility (float): 每天收盤價報酬率的標準差。
+        volume (tuple): 成交量 (張) 的範圍。
+
+    Returns:
+        pd.DataFrame: 以 ts 為索引的日K資料。
+    """
+    rng = np.random.default_rng(seed)
+    opn, high, low, close = _ohlc(rng, days, price, volatility)
+    return pd.DataFrame({'Open': opn, 'High': high, 'Low': low, 'Close': close,
+                         'Volume': rng.integers(volume[0], volume[1], days)},
+                        index=trading_days(days, start))
+
+
+def stock_codes(stocks):
+    """
+    回傳模擬股票的代號。
+    """
+    return [str(1000 + i) for i in range(stocks)]
+
+
+def day_universe(stocks, days, seed=0, **kwargs):
+    """
+    產生多檔股票的日K, 每檔股票使用不同但固定的種子。
+
+    Args:
+        stocks (int): 股票數量。
+        days (int): 交易日數。
+        seed (int): 亂數種子。
+        **kwargs: 傳給 day_bars 的設定。
+
+    Returns:
+        dict: 股票代號對應的日K資料。
+    """
+    return {code: day_bars(days, seed * 100003 + i, **kwargs) for i, code in enumerate(stock_codes(stocks))}
+
+
+def write_minute_files(data_dir, stocks, days, seed=0, **kwargs):
+    """
+    在 data_dir 寫出多檔股票的 _min.csv。
+
+    Returns:
+        list: 寫出的檔案名稱。
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    files = []
+    for i, code in enumerate(stock_codes(stocks)):
+        file_name = f'{code}_min.csv'
+        minute_bars(days, seed * 100003 + i, **kwargs).to_csv(os.path.join(data_dir, file_name), index=False)
+        files.append(file_name)
+    return files
@@ -0,0 +1,422 @@
+#!/usr/bin/python3
+"""
+所有股票最後幾根日K的橫截面快取。
+
+選股只需要每檔股票最後幾根K棒, 但逐檔打開 day_cache 光是開檔就要將近一毫秒, 上千檔股票就超過一秒。
+這裡把每檔股票最後 bars 根K棒 (day_schema 的精簡格式) 疊成 (股票數, bars) 的陣列, 存成資料夾中的
+一個 .npz 檔。K棒不足 bars 根的股票在前面補空值 (價格 NaN、布林 False、參照 NO_REF、整數 0),
+所以每一列的最後一根都是該股票最新的K棒。每檔股票記錄 _day.csv 的 mtime 與大小, 只有變動過的
+股票需要重新讀取。
+
+TailFrame 讓 backtest_struct 與 rule_expr 的向量化規則直接在 (股票數, K棒數) 的陣列上一次算完所有股票;
+參照欄位是列距離, 沿著最後一個軸計算。
+"""
+
+import json
+import os
+import uuid
+from collections import namedtuple
+
+import numpy as np
+
+from utils import day_cache
+from utils import day_schema
+
+# 快取檔名
+TAIL_FILE = 'tail_cache.npz'
+
+# 快取格式版本, 格式改變時要跟著改
+CACHE_VERSION = 1
+
+# 快取至少保存的K棒數
+DEFAULT_BARS = 250
+
+
+def _fill_value(name, dtype):
+    """
+    補在前面的空值。
+    """
+    if dtype == bool:
+        return False
+    if dtype.kind == 'f':
+        return np.nan
+    if dtype.kind == 'M':
+        return np.datetime64('NaT')
+    if name in day_schema.REF_COLUMNS:
+        return day_schema.NO_REF
+    return 0
+
+
+def _source_stat(csv_path):
+    stat = os.stat(csv_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+class _TailColumn:
+    """
+    TailFrame 的欄位, 提供向量化規則用到的 dtype 與 to_numpy()。
+    """
+    __slots__ = ('array',)
+
+    def __init__(self, array):
+        self.array = array
+
+    @property
+    def dtype(self):
+        return self.array.dtype
+
+    def to_numpy(self, dtype=None):
+        return self.array if dtype is None else self.array.astype(dtype, copy=False)
+
+
+class TailFrame:
+    """
+    (股票數, K棒數) 的日K資料, 每一列是一檔股票最後幾根K棒。
+
+    Attributes:
+        codes (list): 每一列的股票代號。
+        dates (np.ndarray): (股票數, K棒數) 的 datetime64, 補上的空值為 NaT。
+        data (dict): 欄位名稱對應 (股票數, K棒數) 的陣列。
+    """
+
+    def __init__(self, codes, dates, data):
+        self.codes = list(codes)
+        self.dates = dates
+        self.data = data
+
+    @property
+    def columns(self):
+        return list(self.data)
+
+    @property
+    def shape(self):
+        return self.dates.shape
+
+    def __len__(self):
+        # 規則的訊號沿著最後一個軸, 長度是K棒數
+        return self.dates.shape[1]
+
+    def __getitem__(self, col):
+        try:
+            return _TailColumn(self.data[col])
+        except KeyError:
+            raise KeyError(col) from None
+
+    def __contains__(self, col):
+        return col in self.data
+
+    def take(self, rows):
+        """
+        取出部分股票。
+        """
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        return TailFrame([self.codes[i] for i in rows], self.dates[rows],
+                         {col: values[rows] for col, values in self.data.items()})
+
+    def tail(self, bars):
+        """
+        取出每檔股票最後 bars 根K棒。
+        """
+        return TailFrame(self.codes, self.dates[:, -bars:], {col: values[:, -bars:] for col, values in self.data.items()})
+
+
+# 一檔股票最後幾根K棒: dates 是 datetime64 陣列, data 是欄位名稱對應精簡格式的陣列
+_Tail = namedtuple('_Tail', ['dates', 'data'])
+
+
+def read_tail(csv_path, bars, end_date=None, columns=None):
+    """
+    讀取一檔股票到 end_date (含) 為止的最後 bars 根K棒 (精簡格式)。
+
+    有 day_cache 時直接從 memory map 取出陣列, 不組成 DataFrame; 沒有時以 day_cache.read_day_tail 讀取 CSV。
+
+    Returns:
+        _Tail: 日期與欄位陣列。
+    """
+    cache = day_cache.DayCache.open(csv_path)
+    if cache is not None:
+        rows = cache.tail_rows(bars, end_date)
+        names = cache.columns if columns is None else [col for col in columns if col in cache.columns]
+        return _Tail(cache.index[rows].to_numpy(dtype='datetime64[ns]'), cache.arrays(names, rows))
+    df = day_cache.read_day_tail(csv_path, bars, end_date, columns, compact=True)
+    return _Tail(df.index.to_numpy(dtype='datetime64[ns]'), {col: df[col].to_numpy() for col in df.columns})
+
+
+def _frame_row(tail, data, dates, i, width):
+    """
+    將一檔股票的K棒靠右填進第 i 列的最後 width 格, 欄位型別不同時以 day_schema.array_values 轉換。
+    """
+    n = min(len(tail.dates), width)
+    if n == 0:
+        return
+    dates[i, width - n:] = tail.dates[-n:]
+    for col, array in data.items():
+        values = tail.data.get(col)
+        if values is None:
+            continue
+        if values.dtype != array.dtype:
+            values = day_schema.array_values(values).astype(array.dtype)
+        array[i, width - n:] = values[-n:]
+
+
+def _ref_reach(data, rows, pos):
+    """
+    rows 中每檔股票在 pos 那一根的參照欄位最遠指到往前第幾根, 回傳需要的K棒數 (至少 1)。
+    """
+    reach = np.ones(len(rows), dtype=np.int64)
+    for col in day_schema.REF_COLUMNS:
+        if col in data and len(rows):
+            offsets = data[col][rows, pos].astype(np.int64)
+            reach = np.maximum(reach, offsets + 1)
+    return reach
+
+
+def _last_reach(tail):
+    """
+    單一股票最後一根的參照欄位需要的K棒數。
+    """
+    data = {col: tail.data[col][None, :] for col in day_schema.REF_COLUMNS if col in tail.data}
+    return int(_ref_reach(data, np.zeros(1, dtype=np.int64), np.array([len(tail.dates) - 1]))[0])
+
+
+def _empty(columns, size, width):
+    """
+    建立填滿空值的 (size, width) 陣列。
+    """
+    data = {col: np.full((size, width), _fill_value(col, dtype), dtype=dtype) for col, dtype in columns.items()}
+    return np.full((size, width), np.datetime64('NaT'), dtype='datetime64[ns]'), data
+
+
+def _merge_dtypes(columns, tail):
+    """
+    合併欄位型別, float32 的價格與 float64 放在一起時改用 float64。
+    """
+    for col, values in tail.data.items():
+        dtype = values.dtype
+        if col not in columns:
+            columns[col] = dtype
+        elif columns[col] != dtype:
+            columns[col] = np.promote_types(columns[col], dtype)
+
+
+class TailCache:
+    """
+    資料夾中所有股票最後幾根日K的快取。
+
+    Attributes:
+        data_dir (str): 日K資料夾。
+        bars (int): 每檔股票保存的K棒數。
+        codes (list): 股票代號。
+        paths (list): 每檔股票的 _day.csv 檔名。
+        stats (np.ndarray): (股票數, 2) 的 _day.csv mtime 與大小。
+        truncated (np.ndarray): 原始資料比 bars 根多, 前面的K棒沒有保存的股票。
+        frame (TailFrame): 保存的K棒。
+    """
+
+    def __init__(self, data_dir, bars, codes, paths, stats, truncated, frame):
+        self.data_dir = data_dir
+        self.bars = bars
+        self.codes = list(codes)
+        self.paths = list(paths)
+        self.stats = stats
+        self.truncated = truncated
+        self.frame = frame
+        self.code_pos = {code: i for i, code in enumerate(self.codes)}
+
+    @staticmethod
+    def path(data_dir):
+        return os.path.join(data_dir, TAIL_FILE)
+
+    @classmethod
+    def read(cls, data_dir):
+        """
+        讀取資料夾中的快取, 不存在或格式不符時回傳 None。
+        """
+        try:
+            with np.load(cls.path(data_dir), allow_pickle=False) as npz:
+                meta = json.loads(str(npz['meta']))
+                if meta.get('version') != CACHE_VERSION or meta.get('day_cache_version') != day_cache.CACHE_VERSION:
+                    return None
+                data = {col: npz[f'c{i}'] for i, col in enumerate(meta['columns'])}
+                frame = TailFrame(meta['codes'], npz['dates'], data)
+                return cls(data_dir, meta['bars'], meta['codes'], meta['paths'], npz['stats'],
+                           npz['truncated'], frame)
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def write(self):
+        """
+        寫入快取, 先寫到暫存檔再改名。
+        """
+        meta = {
+            'version': CACHE_VERSION,
+            'day_cache_version': day_cache.CACHE_VERSION,
+            'bars': self.bars,
+            'codes': self.codes,
+            'paths': self.paths,
+            'columns': self.frame.columns,
+        }
+        arrays = {f'c{i}': self.frame.data[col] for i, col in enumerate(self.frame.columns)}
+        path = self.path(self.data_dir)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp.npz'
+        np.savez(tmp_path, meta=np.array(json.dumps(meta, ensure_ascii=False)), dates=self.frame.dates,
+                 stats=self.stats, truncated=self.truncated, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, data_dir, codes, paths, bars=DEFAULT_BARS):
+        """
+        取得 codes 的快取, 沒有快取、K棒數不夠或 _day.csv 變動過的股票重新讀取並寫回。
+
+        快取中沒有被選到的股票會原樣保留, 換一組股票選股時不需要重建。
+
+        Args:
+            data_dir (str): 日K資料夾。
+            codes (iterable): 股票代號。
+            paths (iterable): 每檔股票的 _day.csv 檔名。
+            bars (int): 至少需要的K棒數。
+
+        Returns:
+            tuple: (只包含 codes 的 TailCache, 重新讀取的股票數)。
+        """
+        codes = list(codes)
+        paths = list(paths)
+        width = max(bars, DEFAULT_BARS)
+        stats = np.array([_source_stat(os.path.join(data_dir, path)) for path in paths],
+                         dtype=np.int64).reshape(-1, 2)
+
+        old = cls.read(data_dir)
+        if old is not None and old.bars < width:
+            old = None
+        if old is not None:
+            width = old.bars
+            old_pos = np.array([old.code_pos.get(code, -1) for code in codes], dtype=np.int64)
+            found = old_pos >= 0
+            fresh = found.copy()
+            fresh[found] = (old.stats[old_pos[found]] == stats[found]).all(axis=1)
+            fresh &= np.array([j >= 0 and old.paths[j] == path for j, path in zip(old_pos, paths)], dtype=bool)
+        else:
+            old_pos = np.full(len(codes), -1, dtype=np.int64)
+            fresh = np.zeros(len(codes), dtype=bool)
+
+        stale = np.flatnonzero(~fresh)
+        if len(stale) == 0:
+            return old._subset(old_pos, stats), 0
+
+        # 重新讀取過期的股票
+        tails = {i: read_tail(os.path.join(data_dir, paths[i]), width + 1) for i in stale}
+        columns = dict(zip(old.frame.columns, (old.frame.data[col].dtype for col in old.frame.columns))) \
+            if old is not None else {}
+        for tail in tails.values():
+            _merge_dtypes(columns, tail)
+
+        # 合併: 選到的股票在前, 快取中其他的股票保留在後
+        selected = set(codes)
+        others = [] if old is None else [j for j, code in enumerate(old.codes) if code not in selected]
+        size = len(codes) + len(others)
+        dates, data = _empty(columns, size, width)
+        truncated = np.zeros(size, dtype=bool)
+        all_stats = np.zeros((size, 2), dtype=np.int64)
+        all_stats[:len(codes)] = stats
+        if old is not None:
+            # 沿用的列: 型別改變的欄位 (float32 的價格遇到 float64) 以 day_schema.array_values 轉換
+            kept = np.concatenate([old_pos[fresh], np.array(others, dtype=np.int64)])
+            rows = np.concatenate([np.flatnonzero(fresh), len(codes) + np.arange(len(others))])
+            dates[rows] = old.frame.dates[kept]
+            for col, array in data.items():
+                if col not in old.frame.data:
+                    continue
+                values = old.frame.data[col]
+                if values.dtype != array.dtype:
+                    values = day_schema.array_values(values).astype(array.dtype)
+                array[rows] = values[kept]
+            truncated[rows] = old.truncated[kept]
+            all_stats[len(codes):] = old.stats[np.array(others, dtype=np.int64)]
+        for i in stale:
+            truncated[i] = len(tails[i].dates) > width
+            _frame_row(tails[i], data, dates, i, width)
+
+        all_codes = codes + [old.codes[j] for j in others]
+        all_paths = paths + [old.paths[j] for j in others]
+        cache = cls(data_dir, width, all_codes, all_paths, all_stats, truncated,
+                    TailFrame(all_codes, dates, data))
+        cache.write()
+        return cache._subset(np.arange(len(codes)), stats), len(stale)
+
+    def _subset(self, pos, stats):
+        frame = self.frame.take(pos)
+        return TailCache(self.data_dir, self.bars, frame.codes, [self.paths[j] for j in pos], stats,
+                         self.truncated[pos], frame)
+
+    @property
+    def last_date(self):
+        """
+        所有股票中最新的日期。
+        """
+        last = self.frame.dates[:, -1]
+        last = last[~np.isnat(last)]
+        return last.max() if len(last) else None
+
+    def window(self, date, bars):
+        """
+        取出在 date 有K棒的股票, 以 date 為最後一根的K棒。
+
+        K棒數至少 bars 根, 而且涵蓋 date 那一根的參照欄位 (前高、前低 ...) 所指到的K棒, 讓 at() 在選股日的結果
+        與整段歷史相同; 有參照比 bars 更早的股票時, 所有股票一起延長到最早的參照。
+        快取中 date 之前的K棒不夠 (或最早的K棒比 date 晚)、而原始資料還有更早的K棒時, 改從 day_cache 讀取該股票。
+
+        Args:
+            date (np.datetime64): 選股日期。
+            bars (int): 至少需要的K棒數。
+
+        Returns:
+            TailFrame: 只包含在 date 有K棒的股票。
+        """
+        date = np.datetime64(date, 'ns')
+        dates = self.frame.dates
+        pad = np.isnat(dates).sum(axis=1)
+        count = (dates <= date).sum(axis=1)
+        pos = pad + count - 1
+        in_cache = (count > 0) & (dates[np.arange(len(dates)), np.maximum(pos, 0)] == date)
+        rows = np.flatnonzero(in_cache)
+        need = np.maximum(_ref_reach(self.frame.data, rows, pos[rows]), bars)
+        reload = self.truncated[rows] & (need > pos[rows] - pad[rows] + 1)
+
+        # 快取保存的K棒不夠的股票, 以及快取最早的K棒比 date 晚的股票, 從 day_cache 讀取
+        loaded = {}
+        for i, n in zip(rows[reload], need[reload]):
+            loaded[i] = self._read_tail(i, n, date)
+        loaded_need = list(need)
+        for i in np.flatnonzero(self.truncated & (count == 0)):
+            size = max(bars, self.bars)
+            tail = self._read_tail(i, size, date)
+            if len(tail.dates) == 0 or tail.dates[-1] != date:
+                continue
+            n = max(_last_reach(tail), bars)
+            loaded[i] = tail if n <= size else self._read_tail(i, n, date)
+            loaded_need.append(n)
+
+        rows = np.union1d(rows, np.array(list(loaded), dtype=np.int64)).astype(np.int64)
+        width = max([bars, *loaded_need])
+        index = pos[rows, None] - width + 1 + np.arange(width)
+        inside = index >= 0
+        index = np.clip(index, 0, dates.shape[1] - 1)
+        out_dates = np.where(inside, np.take_along_axis(dates[rows], index, axis=1), np.datetime64('NaT'))
+        out = {}
+        for col, values in self.frame.data.items():
+            taken = np.take_along_axis(values[rows], index, axis=1)
+            out[col] = np.where(inside, taken, np.array(_fill_value(col, values.dtype), dtype=values.dtype))
+        frame = TailFrame([self.codes[i] for i in rows], out_dates, out)
+
+        for k, i in enumerate(rows):
+            if i in loaded:
+                frame.dates[k] = np.datetime64('NaT')
+                for col in frame.data:
+                    frame.data[col][k] = _fill_value(col, frame.data[col].dtype)
+                _frame_row(loaded[i], frame.data, frame.dates, k, width)
+        return frame
+
+    def _read_tail(self, i, bars, date):
+        return read_tail(os.path.join(self.data_dir, self.paths[i]), bars, date, self.frame.columns)
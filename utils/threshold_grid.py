@@ -0,0 +1,215 @@
+#!/usr/bin/python3
+"""
+一次回測整個門檻網格。
+
+均線聚集的門檻、ESMA20死亡交叉的誤差與停損不再逐組重跑: 均線包絡線與均線只算一次,
+訊號以 NumPy broadcasting 對整個門檻向量一起算出 (門檻數, 天數) 的陣列, 回測則把每組門檻當成
+(組數, 股票數) 陣列的一列, 每天對所有組合做同一次陣列運算。
+
+只模擬不限金額 (初始金額 0) 的回測: 每個買進訊號都會買, 各檔股票之間互不影響, 結果與
+backtest_all.backtest() 不限金額時的總獲利與所需最大現金相同。
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+from utils import indicators
+from utils.backtest_struct import buy_rule_vec_dict, sell_signal, liquidity_mask
+
+# 買賣手續費率, 與 backtest_all.backtest() 相同
+BUY_FEE_RATE = 0.001425
+SELL_FEE_RATE = 0.004425
+
+# 回測在某一天結束時各組門檻的狀態, block_cash_needed 是從上一個 checkpoint 到這一天所需的最大現金
+Checkpoint = namedtuple('Checkpoint', ['t', 'equity', 'max_cash_needed', 'block_cash_needed', 'count_buy',
+                                       'count_sell'])
+
+
+class _GridColumn:
+    """
+    GridFrame 中被取代的欄位, 只提供規則用到的 to_numpy()。
+    """
+    __slots__ = ('array',)
+
+    def __init__(self, array):
+        self.array = array
+
+    def to_numpy(self, dtype=None):
+        return self.array if dtype is None else self.array.astype(dtype, copy=False)
+
+
+class GridFrame:
+    """
+    日K資料中幾個欄位換成 (K, len(df)) 的陣列, buy_rule_vec_dict 的規則不用修改,
+    運算時自然 broadcast 出 K 組門檻的訊號。
+    """
+
+    def __init__(self, df, overrides):
+        self.df = df
+        self.index = df.index
+        self.overrides = overrides
+
+    def __getitem__(self, col):
+        if col in self.overrides:
+            return _GridColumn(self.overrides[col])
+        return self.df[col]
+
+
+def buy_signal_grid(buy_rule, df, bands, investment_per_trade):
+    """
+    計算每個均線聚集門檻的購買訊號, 已經包含流動性篩選。
+
+    Args:
+        buy_rule (str): buy_rule_vec_dict 中的規則名稱。
+        df (pd.DataFrame): 有均線欄位的日K資料。
+        bands (np.ndarray): 均線聚集的門檻向量。
+        investment_per_trade (int): 每次購買金額。
+
+    Returns:
+        tuple: ((len(bands), len(df)) 的布林陣列, 每張價格的 int64 陣列)。
+    """
+    env = {}
+    concentrated = indicators.concentrated_masks(df, env, np.asarray(bands)[:, None])
+    overrides = {**concentrated, **indicators.breakthrough_masks(df, concentrated, env)}
+    liquid, price_unit = liquidity_mask(df, investment_per_trade)
+    signal = liquid & buy_rule_vec_dict[buy_rule](GridFrame(df, overrides))
+    return np.broadcast_to(signal, (len(bands), len(df))), price_unit
+
+
+def sell_signal_grid(sell_rule, df, deviations):
+    """
+    計算每個 ESMA20死亡交叉誤差的賣出訊號, 不使用誤差的規則每一列都相同。
+
+    Returns:
+        np.ndarray: (len(deviations), len(df)) 的布林陣列。
+    """
+    signal = sell_signal(sell_rule, df, {'death_cross_deviation': np.asarray(deviations)[:, None]})
+    return np.broadcast_to(signal, (len(deviations), len(df)))
+
+
+def align_grid(panel, signals_by_code):
+    """
+    將每檔股票的 (K, len(df)) 訊號對齊到 Panel 的交易日。
+
+    Returns:
+        np.ndarray: (交易日數, K, 股票數) 的布林陣列, 每天取一列就是當天所有組合與股票的訊號。
+    """
+    size = next(iter(signals_by_code.values())).shape[0] if signals_by_code else 0
+    array = np.zeros((len(panel.dates), size, len(panel.codes)), dtype=bool)
+    for code, signal in signals_by_code.items():
+        j = panel.code_pos[code]
+        pos, found = panel.rows[j]
+        array[pos, :, j] = signal[:, found].T
+    return array
+
+
+def simulate(panel, buy, sell, buy_pos, sell_pos, stop_loss, investment_per_trade, checkpoints):
+    """
+    同時回測 K 組門檻 (不限金額)。
+
+    Args:
+        panel (Panel): 有 'Close' 與 'price_unit' 欄位的 Panel。
+        buy (np.ndarray): align_grid 的購買訊號 (交易日數, 購買門檻數, 股票數)。
+        sell (np.ndarray): align_grid 的賣出訊號 (交易日數, 賣出門檻數, 股票數)。
+        buy_pos (np.ndarray): 每組使用的購買訊號位置, 長度 K。
+        sell_pos (np.ndarray): 每組使用的賣出訊號位置, 長度 K。
+        stop_loss (np.ndarray): 每組的停損倍數, 長度 K。
+        investment_per_trade (int): 每次購買金額。
+        checkpoints (iterable): 要記錄狀態的交易日位置。
+
+    Returns:
+        list: 每個 checkpoint 的 Checkpoint, 依日期排列。
+
+    max_cash_needed 是從第一天開始累計的最大現金; block_cash_needed 只看上一個 checkpoint 之後的這一段:
+    段開始時持有股票的市值 (視為在段開始時買進) 加上這一段中現金最多比段開始時少多少。
+    """
+    size = (len(buy_pos), len(panel.codes))
+    num = np.zeros(size, dtype=np.int64)
+    cost = np.zeros(size, dtype=np.int64)
+    fee = np.zeros(size, dtype=np.int64)
+    price_unit = np.zeros(size, dtype=np.int64)
+    held = np.zeros(size, dtype=bool)
+    amount = np.zeros(size[0], dtype=np.int64)
+    max_cash_needed = np.zeros(size[0], dtype=np.int64)
+    count_buy = np.zeros(size[0], dtype=np.int64)
+    count_sell = np.zeros(size[0], dtype=np.int64)
+    block_amount = np.zeros(size[0], dtype=np.int64)
+    block_value = np.zeros(size[0], dtype=np.int64)
+    block_draw = np.zeros(size[0], dtype=np.int64)
+    stop_loss = np.asarray(stop_loss, dtype=np.float64)[:, None]
+    close = panel['Close']
+    buy_price_unit = panel['price_unit']
+    checkpoints = set(checkpoints)
+    states = []
+
+    for t in range(len(panel.dates)):
+        valid_row = panel.valid[t]
+
+        # 更新最後收盤價
+        mask = held & valid_row
+        close_unit = (np.where(valid_row, close[t], 0) * 1000).astype(np.int64)
+        price_unit = np.where(mask, close_unit, price_unit)
+        value = price_unit * num
+
+        # 賣: 賣出訊號或市值跌破成本的 stop_loss 倍
+        ratio = np.divide(value, cost, out=np.ones(size), where=held)
+        selling = mask & (sell[t][sell_pos] | (ratio < stop_loss))
+        if selling.any():
+            sell_fee = (value * SELL_FEE_RATE).astype(np.int64)
+            amount += np.where(selling, value - sell_fee, 0).sum(axis=1)
+            count_sell += selling.sum(axis=1)
+            keep = ~selling
+            num *= keep
+            cost *= keep
+            fee *= keep
+            price_unit *= keep
+            held &= keep
+
+        # 買: 不限金額時每個訊號都買
+        buying = buy[t][buy_pos]
+        if buying.any():
+            unit = np.where(buying, buy_price_unit[t], 0)
+            lots = np.floor_divide(investment_per_trade, unit, out=np.zeros(size, dtype=np.int64), where=buying)
+            spent = unit * lots
+            buy_fee = (spent * BUY_FEE_RATE).astype(np.int64)
+            price_unit = np.where(buying & ~held, unit, price_unit)
+            num += lots
+            cost += spent
+            fee += buy_fee
+            held |= buying
+            amount -= (spent + buy_fee).sum(axis=1)
+            count_buy += buying.sum(axis=1)
+            np.maximum(max_cash_needed, -amount, out=max_cash_needed)
+            np.maximum(block_draw, block_amount - amount, out=block_draw)
+
+        if t in checkpoints:
+            held_value = (price_unit * num).sum(axis=1)
+            states.append(Checkpoint(t, amount + held_value, max_cash_needed.copy(), block_value + block_draw,
+                                     count_buy.copy(), count_sell.copy()))
+            block_amount = amount.copy()
+            block_value = held_value
+            block_draw = np.zeros(size[0], dtype=np.int64)
+    return states
+
+
+def annualized_returns(profit, max_cash_needed, days):
+    """
+    與 backtest_all.backtest() 不限金額時相同的報酬率: 總獲利除以所需最大現金, 再依天數換算成年化。
+
+    Returns:
+        tuple: (總報酬 %, 年化報酬 %) 兩個陣列。
+    """
+    total = np.divide(profit * 100.0, max_cash_needed, out=np.zeros(len(profit)), where=max_cash_needed > 0)
+    annualized = total / days * 365 if days > 0 else np.zeros(len(profit))
+    return total, annualized
+
+
+def walk_forward_blocks(days, folds):
+    """
+    將交易日切成 folds + 1 段, 第 f 折以前 f 段為訓練期、第 f + 1 段為測試期。
+
+    Returns:
+        list: 每一段最後一天的位置。
+    """
+    return [block[-1] for block in np.array_split(np.arange(days), folds + 1) if len(block)]
@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+"""
+交易日曆。
+
+process_kbars 產生日K時, 把所有股票日K日期的聯集存成資料夾中的 trading_calendar.csv;
+回測時直接用這份日曆決定要跑哪幾天, 不用再逐日產生日曆日。
+"""
+
+import os
+import pandas as pd
+
+# 交易日曆檔名
+CALENDAR_FILE = 'trading_calendar.csv'
+
+
+def calendar_path(data_dir):
+    """
+    回傳資料夾中的交易日曆路徑。
+    """
+    return os.path.join(data_dir, CALENDAR_FILE)
+
+
+def union_calendar(indexes):
+    """
+    取所有日期索引的聯集。
+
+    Args:
+        indexes (iterable): 多個 DatetimeIndex。
+
+    Returns:
+        pd.DatetimeIndex: 排序後的交易日。
+    """
+    calendar = pd.DatetimeIndex([], name='ts')
+    for index in indexes:
+        calendar = calendar.union(pd.DatetimeIndex(index))
+    return calendar.sort_values().rename('ts')
+
+
+def read_calendar(data_dir):
+    """
+    讀取交易日曆, 不存在時回傳 None。
+    """
+    path = calendar_path(data_dir)
+    if not os.path.isfile(path):
+        return None
+    return pd.DatetimeIndex(pd.read_csv(path)['ts'], name='ts')
+
+
+def write_calendar(data_dir, calendar):
+    """
+    寫入交易日曆。
+    """
+    path = calendar_path(data_dir)
+    tmp_path = path + '.tmp'
+    pd.DataFrame(index=calendar.rename('ts')).to_csv(tmp_path, date_format='%Y-%m-%d')
+    os.replace(tmp_path, path)
+
+
+def load_calendar(data_dir, df_dict, date_range=None):
+    """
+    取得 df_dict 所有股票的交易日。
+
+    先讀資料夾中的交易日曆; 日曆不存在或沒有涵蓋某檔股票的某一天時, 改用 df_dict 日期的聯集。
+
+    Args:
+        data_dir (str): 資料夾。
+        df_dict (dict): 股票代號對應以 DatetimeIndex 為索引的日K資料。
+        date_range (tuple): manifest.csv 記錄的 (第一天, 最後一天); 有給時日曆與清單都是
+            process_kbars 同一次產生的, 直接取這段日曆而不檢查每檔股票的日期。
+
+    Returns:
+        pd.DatetimeIndex: 排序後的交易日。
+    """
+    calendar = read_calendar(data_dir)
+    if calendar is not None and date_range is not None and not pd.isna(date_range[0]):
+        first, last = date_range
+        return calendar[(calendar >= first) & (calendar <= last)]
+    if calendar is not None and all(df.index.isin(calendar).all() for df in df_dict.values()):
+        # 日曆可能包含其他股票的交易日, 只保留 df_dict 有用到的範圍
+        first = min((df.index[0] for df in df_dict.values() if len(df)), default=None)
+        last = max((df.index[-1] for df in df_dict.values() if len(df)), default=None)
+        if first is None:
+            return calendar[:0]
+        return calendar[(calendar >= first) & (calendar <= last)]
+    return union_calendar(df.index for df in df_dict.values())